@@ -103,7 +103,8 @@ buzhash_update(uint32_t sum, unsigned char remove, unsigned char add, size_t len
 typedef struct {
     uint32_t chunk_mask;
     uint32_t *table;
-    uint8_t *data;
+    uint8_t *data;  /* the contents of buffer */
+    PyObject *buffer, *spare;  /* bytearrays, see chunker_fill */
     PyObject *fd;
     int fh;
     int done, eof;
@@ -120,7 +121,13 @@ chunker_init(size_t window_size, uint32_t chunk_mask, size_t min_size, size_t ma
     c->min_size = min_size;
     c->table = buzhash_init_table(seed);
     c->buf_size = max_size;
-    c->data = malloc(c->buf_size);
+    c->buffer = PyByteArray_FromStringAndSize(NULL, c->buf_size);
+    if(!c->buffer) {
+        free(c->table);
+        free(c);
+        return NULL;
+    }
+    c->data = (uint8_t *)PyByteArray_AS_STRING(c->buffer);
     c->fh = -1;
     return c;
 }
@@ -145,8 +152,9 @@ static void
 chunker_free(Chunker *c)
 {
     Py_XDECREF(c->fd);
+    Py_XDECREF(c->buffer);
+    Py_XDECREF(c->spare);
     free(c->table);
-    free(c->data);
     free(c);
 }
 
@@ -154,10 +162,32 @@ static int
 chunker_fill(Chunker *c)
 {
     ssize_t n;
-    PyObject *data;
+    size_t keep = c->position + c->remaining - c->last;
+    PyObject *data, *buffer;
     PyThreadState *thread_state;
 
-    memmove(c->data, c->data + c->last, c->position + c->remaining - c->last);
+    if(Py_REFCNT(c->buffer) > 1) {
+        /* chunks we returned (memoryviews of the buffer) are still in use, e.g. they are
+         * hashed or compressed by other threads. do not overwrite their data, but continue
+         * in the spare buffer (if it is not in use any more) or in a new buffer. */
+        if(c->spare && Py_REFCNT(c->spare) == 1) {
+            buffer = c->spare;
+        }
+        else {
+            buffer = PyByteArray_FromStringAndSize(NULL, c->buf_size);
+            if(!buffer) {
+                return 0;
+            }
+            Py_XDECREF(c->spare);
+        }
+        memcpy(PyByteArray_AS_STRING(buffer), c->data + c->last, keep);
+        c->spare = c->buffer;
+        c->buffer = buffer;
+        c->data = (uint8_t *)PyByteArray_AS_STRING(buffer);
+    }
+    else {
+        memmove(c->data, c->data + c->last, keep);
+    }
     c->position -= c->last;
     c->last = 0;
     n = c->buf_size - c->position - c->remaining;
@@ -165,6 +195,16 @@ chunker_fill(Chunker *c)
         return 1;
     }
     if(c->fh >= 0) {
+        // Only do it once per run.
+        if (pagemask == 0)
+            pagemask = getpagesize() - 1;
+
+        // read whole pages (if the buffer is big enough), so all reads start at a page
+        // boundary of the file.
+        off_t read_end = (c->bytes_read + n) & ~(off_t)pagemask;
+        if (read_end > c->bytes_read)
+            n = read_end - c->bytes_read;
+
         thread_state = PyEval_SaveThread();
 
         #if ( ( _XOPEN_SOURCE >= 600 || _POSIX_C_SOURCE >= 200112L ) && defined(POSIX_FADV_DONTNEED) )
@@ -190,10 +230,6 @@ chunker_fill(Chunker *c)
         #if ( ( _XOPEN_SOURCE >= 600 || _POSIX_C_SOURCE >= 200112L ) && defined(POSIX_FADV_DONTNEED) )
         off_t length = c->bytes_read - offset;
 
-        // Only do it once per run.
-        if (pagemask == 0)
-            pagemask = getpagesize() - 1;
-
         // We tell the OS that we do not need the data that we just have read any
         // more (that it maybe has in the cache). This avoids that we spoil the
         // complete cache with data that we only read once and (due to cache
@@ -245,6 +281,27 @@ chunker_fill(Chunker *c)
     return 1;
 }
 
+static PyObject *
+chunker_view(Chunker *c, size_t offset, size_t length)
+{
+    /* return a read-only memoryview of length bytes at offset of the buffer.
+     * it keeps the buffer alive and the data is not changed while it exists, see chunker_fill. */
+    PyObject *view, *slice, *chunk;
+
+    view = PyMemoryView_FromObject(c->buffer);
+    if(!view) {
+        return NULL;
+    }
+    slice = PySequence_GetSlice(view, offset, offset + length);
+    Py_DECREF(view);
+    if(!slice) {
+        return NULL;
+    }
+    chunk = PyObject_CallMethod(slice, "toreadonly", NULL);
+    Py_DECREF(slice);
+    return chunk;
+}
+
 static PyObject *
 chunker_process(Chunker *c)
 {
@@ -268,7 +325,7 @@ chunker_process(Chunker *c)
         c->done = 1;
         if(c->remaining) {
             c->bytes_yielded += c->remaining;
-            return PyMemoryView_FromMemory((char *)(c->data + c->position), c->remaining, PyBUF_READ);
+            return chunker_view(c, c->position, c->remaining);
         }
         else {
             if(c->bytes_read == c->bytes_yielded)
@@ -311,5 +368,5 @@ chunker_process(Chunker *c)
     c->last = c->position;
     n = c->last - old_last;
     c->bytes_yielded += n;
-    return PyMemoryView_FromMemory((char *)(c->data + old_last), n, PyBUF_READ);
+    return chunker_view(c, old_last, n);
 }
@@ -134,6 +134,7 @@ static const unsigned char *hashindex_get(HashIndex *index, const unsigned char
 static int hashindex_set(HashIndex *index, const unsigned char *key, const void *value);
 static int hashindex_delete(HashIndex *index, const unsigned char *key);
 static unsigned char *hashindex_next_key(HashIndex *index, const unsigned char *key);
+static void hashindex_prefetch(HashIndex *index, const unsigned char *key);
 
 /* Private API */
 static void hashindex_free(HashIndex *index);
@@ -144,6 +145,8 @@ hashindex_free_buckets(HashIndex *index)
 #ifndef BORK_NO_PYTHON
     if(index->buckets_buffer.buf) {
         PyBuffer_Release(&index->buckets_buffer);
+        /* the buckets of a resized index are malloc()ed, see hashindex_resize */
+        index->buckets_buffer.buf = NULL;
     } else
 #endif
     {
@@ -151,12 +154,32 @@ hashindex_free_buckets(HashIndex *index)
     }
 }
 
+/* Return whether the buckets are backed by a Python buffer (freeing them then needs the GIL). */
+static int
+hashindex_buckets_buffered(HashIndex *index)
+{
+#ifndef BORK_NO_PYTHON
+    return index->buckets_buffer.buf != NULL;
+#else
+    return 0;
+#endif
+}
+
 static int
 hashindex_index(HashIndex *index, const unsigned char *key)
 {
     return _le32toh(*((uint32_t *)key)) % index->num_buckets;
 }
 
+/* Hint the CPU to load the bucket *key* would be looked up at first, so batched lookups do not wait for memory. */
+static void
+hashindex_prefetch(HashIndex *index, const unsigned char *key)
+{
+#if defined(__GNUC__) || defined(__clang__)
+    __builtin_prefetch(BUCKET_ADDR(index, hashindex_index(index, key)));
+#endif
+}
+
 static int
 hashindex_lookup(HashIndex *index, const unsigned char *key, int *start_idx)
 {
@@ -304,7 +327,7 @@ count_empty(HashIndex *index)
 HashIndex *
 read_hashheader1(PyObject *file_py)
 {
-    Py_ssize_t bytes_read, length, buckets_length;
+    Py_ssize_t length, buckets_length;
     Py_buffer header_buffer;
     PyObject *header_bytes, *length_object, *tmp;
     HashIndex *index = NULL;
@@ -316,17 +339,17 @@ read_hashheader1(PyObject *file_py)
         goto fail;
     }
 
-    bytes_read = PyBytes_Size(header_bytes);
-    if(PyErr_Occurred()) {
-        /* TypeError, not a bytes() object */
+    /* read() may return bytes() or any other buffer, e.g. a memoryview of a mapped file (see MappedFile) */
+    if(PyObject_GetBuffer(header_bytes, &header_buffer, PyBUF_SIMPLE) < 0) {
+        /* TypeError, not a buffer */
         goto fail_decref_header;
     }
-    if(bytes_read != sizeof(*header)) {
+    if(header_buffer.len != sizeof(*header)) {
         /* Truncated file */
         /* Note: %zd is the format for Py_ssize_t, %zu is for size_t */
         PyErr_Format(PyExc_ValueError, "Could not read header (expected %zu, but read %zd bytes)",
-                     sizeof(*header), bytes_read);
-        goto fail_decref_header;
+                     sizeof(*header), header_buffer.len);
+        goto fail_release_header_buffer;
     }
 
     /*
@@ -340,50 +363,45 @@ read_hashheader1(PyObject *file_py)
             /* Be able to work with regular file objects which do not have a hash_part method. */
             PyErr_Clear();
         } else {
-            goto fail_decref_header;
+            goto fail_release_header_buffer;
         }
     }
 
     /* Find length of file */
     length_object = PyObject_CallMethod(file_py, "seek", "ni", (Py_ssize_t)0, SEEK_END);
     if(PyErr_Occurred()) {
-        goto fail_decref_header;
+        goto fail_release_header_buffer;
     }
     length = PyNumber_AsSsize_t(length_object, PyExc_OverflowError);
     Py_DECREF(length_object);
     if(PyErr_Occurred()) {
         /* This shouldn't generally happen; but can if seek() returns something that's not a number */
-        goto fail_decref_header;
+        goto fail_release_header_buffer;
     }
 
     tmp = PyObject_CallMethod(file_py, "seek", "ni", (Py_ssize_t)sizeof(*header), SEEK_SET);
     Py_XDECREF(tmp);
     if(PyErr_Occurred()) {
-        goto fail_decref_header;
+        goto fail_release_header_buffer;
     }
 
     /* Set up the in-memory header */
     if(!(index = malloc(sizeof(HashIndex)))) {
         PyErr_NoMemory();
-        goto fail_decref_header;
-    }
-
-    PyObject_GetBuffer(header_bytes, &header_buffer, PyBUF_SIMPLE);
-    if(PyErr_Occurred()) {
-        goto fail_free_index;
+        goto fail_release_header_buffer;
     }
 
     header = (HashHeader1*) header_buffer.buf;
     if(memcmp(header->magic, MAGIC1, MAGIC_LEN)) {
         PyErr_Format(PyExc_ValueError, "Unknown MAGIC in header");
-        goto fail_release_header_buffer;
+        goto fail_free_index;
     }
 
     buckets_length = (Py_ssize_t)_le32toh(header->num_buckets) * (header->key_size + header->value_size);
     if((Py_ssize_t)length != (Py_ssize_t)sizeof(*header) + buckets_length) {
         PyErr_Format(PyExc_ValueError, "Incorrect file length (expected %zd, got %zd)",
                      sizeof(*header) + buckets_length, length);
-        goto fail_release_header_buffer;
+        goto fail_free_index;
     }
 
     index->num_entries = _le32toh(header->num_entries);
@@ -392,13 +410,13 @@ read_hashheader1(PyObject *file_py)
     index->key_size = header->key_size;
     index->value_size = header->value_size;
 
-fail_release_header_buffer:
-    PyBuffer_Release(&header_buffer);
 fail_free_index:
     if(PyErr_Occurred()) {
         free(index);
         index = NULL;
     }
+fail_release_header_buffer:
+    PyBuffer_Release(&header_buffer);
 fail_decref_header:
     Py_DECREF(header_bytes);
 fail:
@@ -408,7 +426,7 @@ fail:
 HashIndex *
 read_hashheader(PyObject *file_py)
 {
-    Py_ssize_t bytes_read, length, buckets_length;
+    Py_ssize_t length, buckets_length;
     Py_buffer header_buffer;
     PyObject *header_bytes, *length_object, *tmp;
     HashIndex *index = NULL;
@@ -420,17 +438,17 @@ read_hashheader(PyObject *file_py)
         goto fail;
     }
 
-    bytes_read = PyBytes_Size(header_bytes);
-    if(PyErr_Occurred()) {
-        /* TypeError, not a bytes() object */
+    /* read() may return bytes() or any other buffer, e.g. a memoryview of a mapped file (see MappedFile) */
+    if(PyObject_GetBuffer(header_bytes, &header_buffer, PyBUF_SIMPLE) < 0) {
+        /* TypeError, not a buffer */
         goto fail_decref_header;
     }
-    if(bytes_read != sizeof(*header)) {
+    if(header_buffer.len != sizeof(*header)) {
         /* Truncated file */
         /* Note: %zd is the format for Py_ssize_t, %zu is for size_t */
         PyErr_Format(PyExc_ValueError, "Could not read header (expected %zu, but read %zd bytes)",
-                     sizeof(*header), bytes_read);
-        goto fail_decref_header;
+                     sizeof(*header), header_buffer.len);
+        goto fail_release_header_buffer;
     }
 
     /*
@@ -444,43 +462,38 @@ read_hashheader(PyObject *file_py)
             /* Be able to work with regular file objects which do not have a hash_part method. */
             PyErr_Clear();
         } else {
-            goto fail_decref_header;
+            goto fail_release_header_buffer;
         }
     }
 
     /* Find length of file */
     length_object = PyObject_CallMethod(file_py, "seek", "ni", (Py_ssize_t)0, SEEK_END);
     if(PyErr_Occurred()) {
-        goto fail_decref_header;
+        goto fail_release_header_buffer;
     }
     length = PyNumber_AsSsize_t(length_object, PyExc_OverflowError);
     Py_DECREF(length_object);
     if(PyErr_Occurred()) {
         /* This shouldn't generally happen; but can if seek() returns something that's not a number */
-        goto fail_decref_header;
+        goto fail_release_header_buffer;
     }
 
     tmp = PyObject_CallMethod(file_py, "seek", "ni", (Py_ssize_t)sizeof(*header), SEEK_SET);
     Py_XDECREF(tmp);
     if(PyErr_Occurred()) {
-        goto fail_decref_header;
+        goto fail_release_header_buffer;
     }
 
     /* Set up the in-memory header */
     if(!(index = malloc(sizeof(HashIndex)))) {
         PyErr_NoMemory();
-        goto fail_decref_header;
-    }
-
-    PyObject_GetBuffer(header_bytes, &header_buffer, PyBUF_SIMPLE);
-    if(PyErr_Occurred()) {
-        goto fail_free_index;
+        goto fail_release_header_buffer;
     }
 
     header = (HashHeader*) header_buffer.buf;
     if(memcmp(header->magic, MAGIC, MAGIC_LEN)) {
         PyErr_Format(PyExc_ValueError, "Unknown MAGIC in header");
-        goto fail_release_header_buffer;
+        goto fail_free_index;
     }
 
     buckets_length = (Py_ssize_t)_le32toh(header->num_buckets) *
@@ -488,7 +501,7 @@ read_hashheader(PyObject *file_py)
     if ((Py_ssize_t)length != (Py_ssize_t)sizeof(*header) + buckets_length) {
         PyErr_Format(PyExc_ValueError, "Incorrect file length (expected %zd, got %zd)",
                      sizeof(*header) + buckets_length, length);
-        goto fail_release_header_buffer;
+        goto fail_free_index;
     }
 
     index->num_entries = _le32toh(header->num_entries);
@@ -501,16 +514,16 @@ read_hashheader(PyObject *file_py)
     if (header_version != 2) {
         PyErr_Format(PyExc_ValueError, "Unsupported header version (expected %d, got %d)",
                      2, header_version);
-        goto fail_release_header_buffer;
+        goto fail_free_index;
     }
 
-fail_release_header_buffer:
-    PyBuffer_Release(&header_buffer);
 fail_free_index:
     if(PyErr_Occurred()) {
         free(index);
         index = NULL;
     }
+fail_release_header_buffer:
+    PyBuffer_Release(&header_buffer);
 fail_decref_header:
     Py_DECREF(header_bytes);
 fail:
@@ -523,7 +536,7 @@ fail:
 static HashIndex *
 hashindex_read(PyObject *file_py, int permit_compact, int legacy)
 {
-    Py_ssize_t buckets_length, bytes_read;
+    Py_ssize_t buckets_length;
     PyObject *bucket_bytes;
     HashIndex *index = NULL;
 
@@ -541,8 +554,10 @@ hashindex_read(PyObject *file_py, int permit_compact, int legacy)
 
     /*
      * For indices read from disk we don't malloc() the buckets ourselves,
-     * we have them backed by a Python bytes() object instead, and go through
-     * Python I/O.
+     * we have them backed by a Python buffer instead, and go through
+     * Python I/O. Usually this is a bytes() object, but if file_py is a
+     * MappedFile, it is a (copy-on-write) memory mapping of the file, so
+     * nothing is read until the buckets are accessed.
      *
      * Note: Issuing read(buckets_length) is okay here, because buffered readers
      * will issue multiple underlying reads if necessary. This supports indices
@@ -554,19 +569,14 @@ hashindex_read(PyObject *file_py, int permit_compact, int legacy)
         assert(PyErr_Occurred());
         goto fail_free_index;
     }
-    bytes_read = PyBytes_Size(bucket_bytes);
-    if(PyErr_Occurred()) {
-        /* TypeError, not a bytes() object */
-        goto fail_decref_buckets;
-    }
-    if(bytes_read != buckets_length) {
-        PyErr_Format(PyExc_ValueError, "Could not read buckets (expected %zd, got %zd)", buckets_length, bytes_read);
+    if(PyObject_GetBuffer(bucket_bytes, &index->buckets_buffer, PyBUF_SIMPLE) < 0) {
+        /* TypeError, not a buffer */
         goto fail_decref_buckets;
     }
-
-    PyObject_GetBuffer(bucket_bytes, &index->buckets_buffer, PyBUF_SIMPLE);
-    if(PyErr_Occurred()) {
-        goto fail_decref_buckets;
+    if(index->buckets_buffer.len != buckets_length) {
+        PyErr_Format(PyExc_ValueError, "Could not read buckets (expected %zd, got %zd)",
+                     buckets_length, index->buckets_buffer.len);
+        goto fail_free_buckets;
     }
     index->buckets = index->buckets_buffer.buf;
 
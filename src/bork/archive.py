@@ -3,12 +3,16 @@
 import os
 import stat
 import sys
+import tempfile
+import threading
 import time
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import timedelta
 from functools import partial
 from getpass import getuser
+from hashlib import sha256
 from io import BytesIO
 from itertools import groupby, zip_longest
 from typing import Iterator
@@ -23,14 +27,15 @@
 from .chunker import get_chunker, Chunk
 from .cache import ChunkListEntry
 from .crypto.key import key_factory, UnsupportedPayloadError
-from .compress import CompressionSpec
+from .compress import CompressionSpec, Auto, CompressionMemo, ZSTD_DICT_MAGIC, train_zstd_dict
 from .constants import *  # NOQA
 from .crypto.low_level import IntegrityError as IntegrityErrorBase
 from .hashindex import ChunkIndex, ChunkIndexEntry, CacheSynchronizer
 from .helpers import HardLinkManager
 from .helpers import ChunkIteratorFileWrapper, open_item
-from .helpers import Error, IntegrityError, set_ec
+from .helpers import Error, IntegrityError, DictionaryMissingError, set_ec
 from .platform import uid2user, user2uid, gid2group, group2gid
+from .platform import clone_file
 from .helpers import parse_timestamp, archive_ts_now
 from .helpers import OutputTimestamp, format_timedelta, format_file_size, file_status, FileSize
 from .helpers import safe_encode, make_path_safe, remove_surrogates, text_to_json, join_cmd, remove_dotdot_prefixes
@@ -38,8 +43,9 @@
 from .helpers import bin_to_hex
 from .helpers import safe_ns
 from .helpers import ellipsis_truncate, ProgressIndicatorPercent, log_multi
-from .helpers import os_open, flags_normal, flags_dir
+from .helpers import os_open, flags_normal, flags_noatime, flags_dir
 from .helpers import os_stat
+from .helpers import get_security_dir
 from .helpers import msgpack
 from .helpers import sig_int
 from .helpers.lrucache import LRUCache
@@ -47,6 +53,7 @@
 from .patterns import PathPrefixPattern, FnmatchPattern, IECommand
 from .item import Item, ArchiveItem, ItemDiff
 from .platform import acl_get, acl_set, set_flags, get_flags, swidth, hostname
+from .platform import SaveFile
 from .remote import cache_if_remote
 from .repository import Repository, LIST_SCAN_LIMIT
 from .repoobj import RepoObj
@@ -212,7 +219,8 @@ def __str__(self):
             return str(self.os_error)
 
 
-class BackupIO:
+class BackupIO(threading.local):
+    # thread-local, so the op is correct if files are extracted in multiple threads.
     op = ""
 
     def __call__(self, op=""):
@@ -279,10 +287,67 @@ def OsOpen(*, flags, path=None, parent_fd=None, name=None, noatime=False, op="op
             os.close(fd)
 
 
+class FileCloner:
+    """
+    Keeps track of extracted files with the same content (chunk list) as files which are extracted later.
+
+    These later files are created as copies of the already extracted file (sharing the data blocks if the
+    file system supports it) instead of fetching and writing their chunks again. Only files with at least
+    EXTRACT_CLONE_MIN_SIZE bytes are considered. The files with the same content are counted in advance
+    (see add), so only files which have later copies are remembered.
+    """
+
+    def __init__(self):
+        self.refs = ChunkIndex()  # key -> (number of files with that key not extracted yet, 0)
+        self.sources = {}  # key -> (path, st_dev, st_ino, st_size, st_mtime_ns) of an extracted file
+
+    @staticmethod
+    def key(item):
+        """Return the key for the content of *item* or None if it should not be cloned."""
+        if "chunks" not in item or item.get_size() < EXTRACT_CLONE_MIN_SIZE:
+            return None
+        return sha256(b"".join(c.id for c in item.chunks)).digest()
+
+    def add(self, item):
+        """Count *item*, which will get extracted later."""
+        key = self.key(item)
+        if key is not None:
+            self.refs.add(key, 1, 0)
+
+    def get(self, key):
+        """Return the source to clone a file with *key* from or None."""
+        return self.sources.get(key)
+
+    def done(self, key, path=None):
+        """Count the file with *key* as extracted, remember *path* as source for later files with that key."""
+        entry = self.refs.get(key)
+        if entry is None or entry.refcount <= 1:
+            # this was the last file with that key.
+            if entry is not None:
+                del self.refs[key]
+            self.sources.pop(key, None)
+            return
+        self.refs.decref(key)
+        if path is not None and key not in self.sources:
+            try:
+                st = os.stat(path, follow_symlinks=False)
+            except OSError:
+                return
+            self.sources[key] = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def remove(self, key):
+        """Forget the source for *key*, e.g. because it was modified or removed."""
+        self.sources.pop(key, None)
+
+
 class DownloadPipeline:
     def __init__(self, repository, repo_objs):
         self.repository = repository
         self.repo_objs = repo_objs
+        # if set, the data chunks of items are fetched via this ExtractChunkCache
+        self.chunk_cache = None
+        # if set, files with the same content as an already extracted file are cloned by this FileCloner
+        self.file_cloner = None
 
     def unpack_many(self, ids, *, filter=None, preload=False):
         """
@@ -295,30 +360,72 @@ def unpack_many(self, ids, *, filter=None, preload=False):
         otherwise preloaded chunks will accumulate in RemoteRepository and create a memory leak.
         """
         hlids_preloaded = set()
+        for item in self.unpack_items(self.fetch_many(ids)):
+            if filter and not filter(item):
+                continue
+            if preload:
+                self.preload_item_chunks(item, hlids_preloaded)
+            yield item
+
+    @staticmethod
+    def unpack_items(datas):
+        """Return iterator of items unpacked from *datas*, an iterable of msgpacked item stream data."""
         unpacker = msgpack.Unpacker(use_list=False)
-        for data in self.fetch_many(ids):
+        for data in datas:
             unpacker.feed(data)
             for _item in unpacker:
                 item = Item(internal_dict=_item)
                 if "chunks" in item:
                     item.chunks = [ChunkListEntry(*e) for e in item.chunks]
-                if filter and not filter(item):
-                    continue
-                if preload and "chunks" in item:
-                    hlid = item.get("hlid", None)
-                    if hlid is None:
-                        preload_chunks = True
-                    elif hlid in hlids_preloaded:
-                        preload_chunks = False
-                    else:
-                        # not having the hardlink's chunks already preloaded for other hardlink to same inode
-                        preload_chunks = True
-                        hlids_preloaded.add(hlid)
-                    if preload_chunks:
-                        self.repository.preload([c.id for c in item.chunks])
                 yield item
 
+    def preload_item_chunks(self, item, hlids_preloaded):
+        """Preload the data chunks of *item*, unless they were already preloaded for another hardlink."""
+        if "chunks" in item:
+            hlid = item.get("hlid", None)
+            if hlid is None:
+                preload_chunks = True
+            elif hlid in hlids_preloaded:
+                preload_chunks = False
+            else:
+                # not having the hardlink's chunks already preloaded for other hardlink to same inode
+                preload_chunks = True
+                hlids_preloaded.add(hlid)
+            if preload_chunks and self.file_cloner is not None:
+                key = self.file_cloner.key(item)
+                if key is not None and self.file_cloner.get(key) is not None:
+                    # the file will be cloned from an already extracted file, see Archive.extract_item().
+                    preload_chunks = False
+            if preload_chunks:
+                ids = [c.id for c in item.chunks]
+                if self.chunk_cache is not None:
+                    # the cached chunks are not fetched from the repository, see fetch_many().
+                    ids = [id for id in ids if id not in self.chunk_cache]
+                if ids:
+                    self.repository.preload(ids)
+
     def fetch_many(self, ids, is_preloaded=False):
+        chunk_cache = self.chunk_cache
+        if chunk_cache is None:
+            yield from self._fetch_many(ids, is_preloaded=is_preloaded)
+            return
+        # the chunks which are cached now were not preloaded by preload_item_chunks(), all others were.
+        # get them all now, so they can not get evicted while fetching the others.
+        cached = [chunk_cache.get(id_) for id_ in ids]
+        fetched = self._fetch_many([id_ for id_, data in zip(ids, cached) if data is None], is_preloaded=is_preloaded)
+        for id_, data in zip(ids, cached):
+            if data is None:
+                data = next(fetched)
+            chunk_cache.use(id_, data)
+            yield data
+
+    def discard_many(self, ids):
+        """Like fetch_many() for chunks which are not needed (and were not preloaded), but fetch nothing."""
+        if self.chunk_cache is not None:
+            for id_ in ids:
+                self.chunk_cache.use(id_, None)
+
+    def _fetch_many(self, ids, is_preloaded=False):
         for id_, cdata in zip(ids, self.repository.get_many(ids, is_preloaded=is_preloaded)):
             _, data = self.repo_objs.parse(id_, cdata)
             yield data
@@ -347,15 +454,15 @@ def flush(self, flush=False):
         if self.buffer.tell() == 0:
             return
         self.buffer.seek(0)
-        # The chunker returns a memoryview to its internal buffer,
-        # thus a copy is needed before resuming the chunker iterator.
+        # The chunker returns a memoryview of its internal buffer,
+        # it stays valid after resuming the chunker iterator.
         # the metadata stream may produce all-zero chunks, so deal
         # with CH_ALLOC (and CH_HOLE, for completeness) here.
         chunks = []
         for chunk in self.chunker.chunkify(self.buffer):
             alloc = chunk.meta["allocation"]
             if alloc == CH_DATA:
-                data = bytes(chunk.data)
+                data = chunk.data
             elif alloc in (CH_ALLOC, CH_HOLE):
                 data = zeros[: chunk.meta["size"]]
             else:
@@ -391,9 +498,38 @@ def __init__(self, cache, key, stats, chunker_params=ITEMS_CHUNKER_PARAMS):
         super().__init__(key, chunker_params)
         self.cache = cache
         self.stats = stats
+        self.samples = None  # list of packed items to collect for training a zstd dictionary, see Archive.save
+        self.samples_size = 0
+
+    def add(self, item):
+        if self.samples is None or self.samples_size >= METADATA_DICT_SAMPLES_SIZE:
+            return super().add(item)
+        packed = self.packer.pack(item.as_dict())
+        self.samples.append(packed)
+        self.samples_size += len(packed)
+        self.buffer.write(packed)
+        if self.is_full():
+            self.flush()
 
     def write_chunk(self, chunk):
-        id_, _ = self.cache.add_chunk(self.key.id_hash(chunk), {}, chunk, stats=self.stats, wait=False)
+        id_ = self.key.id_hash(chunk)
+        compressor = self.cache.repo_objs.metadata_compressor
+        if compressor is None or self.cache.seen_chunk(id_, len(chunk)):
+            id_, _ = self.cache.add_chunk(id_, {}, chunk, stats=self.stats, wait=False)
+        else:
+            # compress using the zstd dictionary of the repository
+            meta, data = compressor.compress({}, chunk)
+            id_, _ = self.cache.add_chunk(
+                id_,
+                {},
+                data,
+                stats=self.stats,
+                wait=False,
+                compress=False,
+                size=len(chunk),
+                ctype=meta["ctype"],
+                clevel=meta["clevel"],
+            )
         logger.debug(f"writing item metadata stream chunk {bin_to_hex(id_)}")
         self.cache.repository.async_response(wait=False)
         return id_
@@ -479,6 +615,7 @@ def __init__(
         end=None,
         log_json=False,
         iec=False,
+        metadata_dict=False,
     ):
         self.cwd = os.getcwd()
         assert isinstance(manifest, Manifest)
@@ -515,6 +652,10 @@ def __init__(
         self.create = create
         if self.create:
             self.items_buffer = CacheChunkBuffer(self.cache, self.key, self.stats)
+            if metadata_dict and self.repo_objs.metadata_zstd is not None and self.repo_objs.metadata_dict is None:
+                # zstd is used, but the repository does not have a dictionary for the items metadata stream yet.
+                # training one is opt-in, as older clients can not use the repository afterwards.
+                self.items_buffer.samples = []
             if name in manifest.archives:
                 raise self.AlreadyExists(name)
             i = 0
@@ -630,6 +771,51 @@ def iter_items(self, filter=None, preload=False):
             self.metadata.items, preload=preload, filter=lambda item: self.item_filter(item, filter)
         )
 
+    def iter_items_with_size(self, filter=None, preload=False):
+        """
+        Return (total size, iterator of items) like iter_items(), reading the item metadata stream only once.
+
+        The selected items are spooled to a temporary file (kept in memory while small) while summing up
+        their sizes, the iterator then yields them from there. *preload* works like for iter_items().
+
+        If the pipeline has a chunk cache (or file cloner), the references to the data chunks (the files
+        with the same chunks) are counted.
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=ITEMS_SPOOL_MAX_MEMORY)
+        chunk_cache = self.pipeline.chunk_cache
+        file_cloner = self.pipeline.file_cloner
+        hlids_seen = set()
+        try:
+            packer = msgpack.Packer()
+            total_size = 0
+            for item in self.iter_items(filter):
+                total_size += item.get_size()
+                spool.write(packer.pack(item.as_dict()))
+                if (chunk_cache is not None or file_cloner is not None) and "chunks" in item:
+                    hlid = item.get("hlid", None)
+                    if hlid is None or hlid not in hlids_seen:
+                        # only the first hardlink to the same inode gets its chunks fetched.
+                        if hlid is not None:
+                            hlids_seen.add(hlid)
+                        if chunk_cache is not None:
+                            chunk_cache.add_refs(c.id for c in item.chunks)
+                        if file_cloner is not None:
+                            file_cloner.add(item)
+            spool.seek(0)
+        except BaseException:
+            spool.close()
+            raise
+
+        def iter_spooled():
+            hlids_preloaded = set()
+            with spool:
+                for item in self.pipeline.unpack_items(iter(partial(spool.read, 1024 * 1024), b"")):
+                    if preload:
+                        self.pipeline.preload_item_chunks(item, hlids_preloaded)
+                    yield item
+
+        return total_size, iter_spooled()
+
     def add_item(self, item, show_progress=True, stats=None):
         if show_progress and self.show_progress:
             if stats is None:
@@ -712,6 +898,14 @@ def save(self, name=None, comment=None, timestamp=None, stats=None, additional_m
                 raise
         while self.repository.async_response(wait=True) is not None:
             pass
+        samples = self.items_buffer.samples
+        if samples is not None and len(samples) >= METADATA_DICT_MIN_SAMPLES:
+            # the items metadata stream of later archives will be compressed using this dictionary
+            try:
+                self.manifest.add_metadata_dict(train_zstd_dict(samples, METADATA_DICT_SIZE))
+            except ValueError as err:
+                logger.debug("Could not train a metadata dictionary: %s", err)
+            self.items_buffer.samples = None
         self.manifest.archives[name] = (self.id, metadata.time)
         self.manifest.write()
         self.repository.commit(compact=False)
@@ -785,6 +979,7 @@ def extract_item(
         hlm=None,
         pi=None,
         continue_extraction=False,
+        executor=None,
     ):
         """
         Extract archive item.
@@ -797,6 +992,12 @@ def extract_item(
         :param hlm: maps hlid to link_target for extracting subtrees with hardlinks correctly
         :param pi: ProgressIndicatorPercent (or similar) for file extraction progress (in bytes)
         :param continue_extraction: continue a previously interrupted extraction of same archive
+        :param executor: if given, a regular file (not hardlinked, not bigger than EXTRACT_ASYNC_MAX_SIZE)
+                         is created and written and its attributes are restored by this executor, a Future
+                         for that is returned. The file's chunks are still fetched by the calling thread.
+
+        If the pipeline has a file cloner, a regular file with the same content as an already extracted file
+        is created as a copy of that file (sharing the data blocks if the file system supports it).
         """
 
         def same_item(item, st):
@@ -867,6 +1068,72 @@ def make_parent(path):
             if not os.path.exists(parent_dir):
                 os.makedirs(parent_dir)
 
+        def fetch_chunks(ids, is_preloaded=True):
+            for data in self.pipeline.fetch_many(ids, is_preloaded=is_preloaded):
+                if pi:
+                    pi.show(increase=len(data), info=[remove_surrogates(item.path)])
+                yield data
+
+        def write_file(chunks):
+            # note: this might run in a worker thread, so it must not access the repository.
+            with backup_io("open"):
+                fd = open(path, "wb")
+            with fd:
+                for data in chunks:
+                    with backup_io("write"):
+                        if sparse and zeros.startswith(data):
+                            # all-zero chunk: create a hole in a sparse file
+                            fd.seek(len(data), 1)
+                        else:
+                            fd.write(data)
+                with backup_io("truncate_and_attrs"):
+                    pos = item_chunks_size = fd.tell()
+                    fd.truncate(pos)
+                    fd.flush()
+                    self.restore_attrs(path, item, fd=fd.fileno())
+            if "size" in item:
+                item_size = item.size
+                if item_size != item_chunks_size:
+                    raise BackupError(f"Size inconsistency detected: size {item_size}, chunks size {item_chunks_size}")
+            if has_damaged_chunks:
+                raise BackupError("File has damaged (all-zero) chunks. Try running bork check --repair.")
+
+        def clone_from(source):
+            # create the file as a copy of an already extracted file with the same content.
+            # return False if that file was modified or cloning is not supported.
+            src_path, st_dev, st_ino, st_size, st_mtime_ns = source
+            if flags_noatime == flags_normal:
+                # reading the source file would change its (already restored) atime.
+                self.pipeline.file_cloner = None
+                return False
+            try:
+                src_fd = os.open(src_path, flags_noatime)
+            except OSError:
+                return False
+            try:
+                st = os.fstat(src_fd)
+                if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) != (st_dev, st_ino, st_size, st_mtime_ns):
+                    return False
+                with backup_io("open"):
+                    fd = open(path, "wb")
+                with fd:
+                    try:
+                        clone_file(src_fd, fd.fileno(), st_size)
+                    except OSError as err:
+                        logger.debug("extract: cloning files is not supported (%s), writing them.", err)
+                        self.pipeline.file_cloner = None
+                        return False
+                    with backup_io("truncate_and_attrs"):
+                        fd.flush()
+                        self.restore_attrs(path, item, fd=fd.fileno())
+            finally:
+                os.close(src_fd)
+            if pi:
+                pi.show(increase=st_size, info=[remove_surrogates(item.path)])
+            if has_damaged_chunks:
+                raise BackupError("File has damaged (all-zero) chunks. Try running bork check --repair.")
+            return True
+
         mode = item.mode
         if stat.S_ISREG(mode):
             with backup_io("makedirs"):
@@ -874,32 +1141,29 @@ def make_parent(path):
             with self.extract_helper(item, path, hlm) as hardlink_set:
                 if hardlink_set:
                     return
-                with backup_io("open"):
-                    fd = open(path, "wb")
-                with fd:
-                    ids = [c.id for c in item.chunks]
-                    for data in self.pipeline.fetch_many(ids, is_preloaded=True):
-                        if pi:
-                            pi.show(increase=len(data), info=[remove_surrogates(item.path)])
-                        with backup_io("write"):
-                            if sparse and zeros.startswith(data):
-                                # all-zero chunk: create a hole in a sparse file
-                                fd.seek(len(data), 1)
-                            else:
-                                fd.write(data)
-                    with backup_io("truncate_and_attrs"):
-                        pos = item_chunks_size = fd.tell()
-                        fd.truncate(pos)
-                        fd.flush()
-                        self.restore_attrs(path, item, fd=fd.fileno())
-                if "size" in item:
-                    item_size = item.size
-                    if item_size != item_chunks_size:
-                        raise BackupError(
-                            f"Size inconsistency detected: size {item_size}, chunks size {item_chunks_size}"
-                        )
-                if has_damaged_chunks:
-                    raise BackupError("File has damaged (all-zero) chunks. Try running bork check --repair.")
+                ids = [c.id for c in item.chunks]
+                file_cloner = self.pipeline.file_cloner
+                clone_key = file_cloner.key(item) if file_cloner is not None else None
+                source = file_cloner.get(clone_key) if clone_key is not None else None
+                if source is not None:
+                    # the chunks were not preloaded, see DownloadPipeline.preload_item_chunks().
+                    if clone_from(source):
+                        self.pipeline.discard_many(ids)
+                    else:
+                        file_cloner.remove(clone_key)
+                        write_file(fetch_chunks(ids, is_preloaded=False))
+                    file_cloner.done(clone_key)
+                    return
+                chunks = fetch_chunks(ids)
+                if executor is not None and "hlid" not in item and item.get_size() <= EXTRACT_ASYNC_MAX_SIZE:
+                    # hardlinks are extracted synchronously, so following links to the same file find it.
+                    # files written by the executor are no clone sources, they might not be complete yet.
+                    if clone_key is not None:
+                        file_cloner.done(clone_key)
+                    return executor.submit(write_file, list(chunks))
+                write_file(chunks)
+                if clone_key is not None:
+                    file_cloner.done(clone_key, path)
             return
         with backup_io:
             # No repository access beyond this point.
@@ -1066,6 +1330,15 @@ def chunk_decref(id, stats):
             else:
                 fetch_async_response(wait=False)
 
+        def chunks_decref(ids, stats):
+            try:
+                self.cache.chunks_decref(ids, stats, wait=False)
+            except KeyError as err:
+                cid = bin_to_hex(err.args[0])
+                raise ChunksIndexError(cid)
+            else:
+                fetch_async_response(wait=False)
+
         error = False
         try:
             unpacker = msgpack.Unpacker(use_list=False)
@@ -1083,8 +1356,7 @@ def chunk_decref(id, stats):
                     for item in unpacker:
                         item = Item(internal_dict=item)
                         if "chunks" in item:
-                            for chunk_id, size in item.chunks:
-                                chunk_decref(chunk_id, stats)
+                            chunks_decref([chunk_id for chunk_id, _ in item.chunks], stats)
                 except (TypeError, ValueError):
                     # if items metadata spans multiple chunks and one chunk got dropped somehow,
                     # it could be that unpacker yields bad types
@@ -1268,6 +1540,7 @@ def __init__(
         checkpoint_interval,
         checkpoint_volume,
         rechunkify,
+        workers=1,
     ):
         self.key = key
         self.cache = cache
@@ -1275,6 +1548,10 @@ def __init__(
         self.prepare_checkpoint = prepare_checkpoint
         self.write_checkpoint = write_checkpoint
         self.rechunkify = rechunkify
+        # hashing and compressing the chunks can be offloaded to worker threads,
+        # the expensive parts of both are done without holding the GIL.
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chunks") if workers > 1 else None
         # time interval based checkpointing
         self.checkpoint_interval = checkpoint_interval
         self.last_checkpoint = time.monotonic()
@@ -1312,14 +1589,49 @@ def maybe_checkpoint(self, item):
                 logger.info("checkpoint requested: finished checkpoint creation!")
         return checkpoint_done  # whether a checkpoint archive was created
 
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    @staticmethod
+    def file_compressor(cache):
+        """
+        Return the compress function for the chunks of one file.
+
+        For auto compression, it remembers whether the chunks of the file compress at all.
+        """
+        compressor = cache.repo_objs.compressor
+        if isinstance(compressor, Auto):
+            return partial(compressor.compress, memo=CompressionMemo())
+        return compressor.compress
+
     def process_file_chunks(self, item, cache, stats, show_progress, chunk_iter, chunk_processor=None):
+        if not chunk_processor and self.executor is not None:
+            return self.process_file_chunks_parallel(item, cache, stats, show_progress, chunk_iter)
         if not chunk_processor:
+            compress = self.file_compressor(cache)
 
             def chunk_processor(chunk):
                 started_hashing = time.monotonic()
                 chunk_id, data = cached_hash(chunk, self.key.id_hash)
                 stats.hashing_time += time.monotonic() - started_hashing
-                chunk_entry = cache.add_chunk(chunk_id, {}, data, stats=stats, wait=False)
+                size = len(data)
+                if cache.seen_chunk(chunk_id, size):
+                    chunk_entry = cache.chunk_incref(chunk_id, stats, size=size)
+                else:
+                    meta, data = compress({}, data)
+                    chunk_entry = cache.add_chunk(
+                        chunk_id,
+                        meta,
+                        data,
+                        stats=stats,
+                        wait=False,
+                        compress=False,
+                        size=size,
+                        ctype=meta["ctype"],
+                        clevel=meta["clevel"],
+                    )
                 self.cache.repository.async_response(wait=False)
                 return chunk_entry
 
@@ -1336,6 +1648,99 @@ def chunk_processor(chunk):
                 stats.show_progress(item=item, dt=0.2)
             self.maybe_checkpoint(item)
 
+    def process_file_chunks_parallel(self, item, cache, stats, show_progress, chunk_iter):
+        """
+        Like process_file_chunks, but chunk hashing and compression is done by the worker threads.
+
+        The chunks index and the repository are only used from the calling thread and always in
+        chunk order, so item.chunks, the statistics and the checkpoints are the same as when
+        processing the chunks serially. Encryption also stays in the calling thread.
+        """
+        id_hash = self.key.id_hash
+        compress = self.file_compressor(cache)
+        max_inflight = 2 * self.workers
+        hashing = deque()  # (size, data, future -> (chunk_id, hashing_time)), in chunk order
+        ready = deque()  # (chunk_id, size, future -> (meta, compressed data) or None if known chunk), in chunk order
+        new_ids = set()  # ids of the new chunks in ready, they are not in the chunks index yet
+
+        def hash_chunk(data):
+            started_hashing = time.monotonic()
+            chunk_id = id_hash(data)
+            return chunk_id, time.monotonic() - started_hashing
+
+        def dedup(block):
+            # decide about the oldest hashed chunks whether they need to get compressed and stored.
+            while hashing and (block or hashing[0][2].done()):
+                size, data, hashed = hashing.popleft()
+                chunk_id, hashing_time = hashed.result()
+                stats.hashing_time += hashing_time
+                if chunk_id in new_ids or cache.seen_chunk(chunk_id, size):
+                    ready.append((chunk_id, size, None))
+                else:
+                    new_ids.add(chunk_id)
+                    ready.append((chunk_id, size, self.executor.submit(compress, {}, data)))
+                block = False
+
+        def finish():
+            chunk_id, size, compressed = ready.popleft()
+            if compressed is None:
+                chunk_entry = cache.chunk_incref(chunk_id, stats, size=size)
+            else:
+                meta, data = compressed.result()
+                new_ids.discard(chunk_id)
+                chunk_entry = cache.add_chunk(
+                    chunk_id,
+                    meta,
+                    data,
+                    stats=stats,
+                    wait=False,
+                    compress=False,
+                    size=size,
+                    ctype=meta["ctype"],
+                    clevel=meta["clevel"],
+                )
+                self.cache.repository.async_response(wait=False)
+            item.chunks.append(chunk_entry)
+            self.current_volume += chunk_entry[1]
+            if show_progress:
+                stats.show_progress(item=item, dt=0.2)
+            self.maybe_checkpoint(item)
+
+        def drain(limit):
+            while len(hashing) + len(ready) > limit:
+                dedup(block=not ready)
+                if ready:
+                    finish()
+
+        item.chunks = []
+        if self.rechunkify and "chunks_healthy" in item:
+            del item.chunks_healthy
+        try:
+            for chunk in chunk_iter:
+                if chunk.meta["allocation"] == CH_DATA:
+                    # the chunker returns a memoryview of its internal buffer,
+                    # it stays valid while the workers still use it.
+                    data = chunk.data
+                    hashed = self.executor.submit(hash_chunk, data)
+                else:
+                    # all-zero chunks, their ids are usually cached, see cached_hash.
+                    hashed = Future()
+                    chunk_id, data = cached_hash(chunk, id_hash)
+                    hashed.set_result((chunk_id, 0.0))
+                hashing.append((len(data), data, hashed))
+                dedup(block=False)
+                drain(max_inflight - 1)
+            drain(0)
+        except BaseException:
+            # nothing of the pending chunks was added to the chunks index or the repository yet,
+            # thus just forgetting about them is fine.
+            for _, _, hashed in hashing:
+                hashed.cancel()
+            for _, _, compressed in ready:
+                if compressed is not None:
+                    compressed.cancel()
+            raise
+
 
 class FilesystemObjectProcessors:
     # When ported to threading, then this doesn't need chunker, cache, key any more.
@@ -1492,11 +1897,8 @@ def process_file(self, *, path, parent_fd, name, st, cache, flags=flags_normal,
                 # which might require cleanup (see except-branch):
                 try:
                     if hl_chunks is not None:  # create_helper gave us chunks from a previous hardlink
-                        item.chunks = []
-                        for chunk_id, chunk_size in hl_chunks:
-                            # process one-by-one, so we will know in item.chunks how far we got
-                            chunk_entry = cache.chunk_incref(chunk_id, self.stats)
-                            item.chunks.append(chunk_entry)
+                        # this adds all references or none, so there is nothing to clean up if it fails.
+                        item.chunks = cache.chunks_incref([chunk_id for chunk_id, _ in hl_chunks], self.stats)
                     else:  # normal case, no "2nd+" hardlink
                         if not is_special_file:
                             hashed_path = safe_encode(os.path.join(self.cwd, path))
@@ -1512,17 +1914,12 @@ def process_file(self, *, path, parent_fd, name, st, cache, flags=flags_normal,
                             known, ids = False, None
                         if ids is not None:
                             # Make sure all ids are available
-                            for id_ in ids:
-                                if not cache.seen_chunk(id_):
-                                    # cache said it is unmodified, but we lost a chunk: process file like modified
-                                    status = "M"
-                                    break
+                            if 0 in cache.seen_chunks(ids):
+                                # cache said it is unmodified, but we lost a chunk: process file like modified
+                                status = "M"
                             else:
-                                item.chunks = []
-                                for chunk_id in ids:
-                                    # process one-by-one, so we will know in item.chunks how far we got
-                                    chunk_entry = cache.chunk_incref(chunk_id, self.stats)
-                                    item.chunks.append(chunk_entry)
+                                # this adds all references or none, so there is nothing to clean up if it fails.
+                                item.chunks = cache.chunks_incref(ids, self.stats)
                                 status = "U"  # regular file, unchanged
                         else:
                             status = "M" if known else "A"  # regular file, modified or added
@@ -1774,6 +2171,8 @@ def check(
         repository,
         *,
         verify_data=False,
+        workers=1,
+        max_duration=0,
         repair=False,
         match=None,
         sort_by="",
@@ -1792,6 +2191,9 @@ def check(
         :param older/newer: only check archives older/newer than timedelta from now
         :param oldest/newest: only check archives older/newer than timedelta from oldest/newest archive timestamp
         :param verify_data: integrity verification of data referenced by archives
+        :param workers: number of threads used for verifying data
+        :param max_duration: only do a partial verification of data for max. max_duration seconds,
+                             the other checks are skipped then
         """
         logger.info("Starting archive consistency check...")
         self.check_all = not any((first, last, match, older, newer, oldest, newest))
@@ -1804,7 +2206,9 @@ def check(
         self.key = self.make_key(repository)
         self.repo_objs = RepoObj(self.key)
         if verify_data:
-            self.verify_data()
+            self.verify_data(workers=workers, max_duration=max_duration)
+            if max_duration:
+                return self.repair or not self.error_found
         if Manifest.MANIFEST_ID not in self.chunks:
             logger.error("Repository manifest not found!")
             self.error_found = True
@@ -1863,7 +2267,27 @@ def make_key(self, repository):
             msg = "make_key: failed to create the key (tried %d chunks)" % attempt
         raise IntegrityError(msg)
 
-    def verify_data(self):
+    def verify_data(self, *, workers=1, max_duration=0):
+        """
+        Verify the data of all chunks, in on-disk order.
+
+        Fetching the chunks is done by the calling thread, decrypting, decompressing and verifying the
+        chunk ids can be offloaded to *workers* threads (decompression and hashing do not hold the GIL).
+
+        With *max_duration* seconds, only a partial verification is done: the scan position is persisted
+        in the security dir when the time is over, so the next partial verification can continue there.
+        """
+        partial = bool(max_duration)
+        state_file = os.path.join(get_security_dir(self.repository.id_str), "verify-data-state")
+        state = None
+        if partial:
+            # continue a past partial verification (if any) or start one from beginning
+            state = self.load_verify_data_state(state_file)
+            if state is not None:
+                logger.info("Continuing data verification at segment %d, offset %d", state[0], state[1])
+        else:
+            # start from the beginning and also forget about any potential past partial verification
+            self.clear_verify_data_state(state_file)
         logger.info("Starting cryptographic data integrity verification...")
         chunks_count_index = len(self.chunks)
         chunks_count_segments = 0
@@ -1872,40 +2296,77 @@ def verify_data(self):
         pi = ProgressIndicatorPercent(
             total=chunks_count_index, msg="Verifying data %6.2f%%", step=0.01, msgid="check.verify_data"
         )
-        state = None
-        while True:
-            chunk_ids, state = self.repository.scan(limit=100, state=state)
-            if not chunk_ids:
-                break
-            chunks_count_segments += len(chunk_ids)
-            chunk_data_iter = self.repository.get_many(chunk_ids)
-            chunk_ids_revd = list(reversed(chunk_ids))
-            while chunk_ids_revd:
-                pi.show()
-                chunk_id = chunk_ids_revd.pop(-1)  # better efficiency
-                try:
-                    encrypted_data = next(chunk_data_iter)
-                except (Repository.ObjectNotFound, IntegrityErrorBase) as err:
-                    self.error_found = True
-                    errors += 1
-                    logger.error("chunk %s: %s", bin_to_hex(chunk_id), err)
-                    if isinstance(err, IntegrityErrorBase):
-                        defect_chunks.append(chunk_id)
-                    # as the exception killed our generator, make a new one for remaining chunks:
-                    if chunk_ids_revd:
-                        chunk_ids = list(reversed(chunk_ids_revd))
-                        chunk_data_iter = self.repository.get_many(chunk_ids)
-                else:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify") if workers > 1 else None
+        max_inflight = 2 * workers
+        verifying = deque()  # (chunk_id, future -> integrity error or None), in on-disk order
+
+        def verify_chunk(chunk_id, encrypted_data):
+            try:
+                # we must decompress, so it'll call assert_id() in there:
+                self.repo_objs.parse(chunk_id, encrypted_data, decompress=True)
+            except IntegrityErrorBase as integrity_error:
+                return integrity_error
+
+        def verified(chunk_id, integrity_error):
+            nonlocal errors
+            if integrity_error is not None:
+                self.error_found = True
+                errors += 1
+                logger.error("chunk %s, integrity error: %s", bin_to_hex(chunk_id), integrity_error)
+                defect_chunks.append(chunk_id)
+
+        def drain(limit):
+            while len(verifying) > limit or verifying and verifying[0][1].done():
+                chunk_id, future = verifying.popleft()
+                verified(chunk_id, future.result())
+
+        t_start = time.monotonic()
+        try:
+            while True:
+                chunk_ids, next_state = self.repository.scan(limit=100, state=state)
+                if not chunk_ids:
+                    if partial:
+                        logger.info("Finished partial data verification, all segments verified.")
+                        self.clear_verify_data_state(state_file)
+                    break
+                state = next_state
+                chunks_count_segments += len(chunk_ids)
+                chunk_data_iter = self.repository.get_many(chunk_ids)
+                chunk_ids_revd = list(reversed(chunk_ids))
+                while chunk_ids_revd:
+                    pi.show()
+                    chunk_id = chunk_ids_revd.pop(-1)  # better efficiency
                     try:
-                        # we must decompress, so it'll call assert_id() in there:
-                        self.repo_objs.parse(chunk_id, encrypted_data, decompress=True)
-                    except IntegrityErrorBase as integrity_error:
+                        encrypted_data = next(chunk_data_iter)
+                    except (Repository.ObjectNotFound, IntegrityErrorBase) as err:
                         self.error_found = True
                         errors += 1
-                        logger.error("chunk %s, integrity error: %s", bin_to_hex(chunk_id), integrity_error)
-                        defect_chunks.append(chunk_id)
+                        logger.error("chunk %s: %s", bin_to_hex(chunk_id), err)
+                        if isinstance(err, IntegrityErrorBase):
+                            defect_chunks.append(chunk_id)
+                        # as the exception killed our generator, make a new one for remaining chunks:
+                        if chunk_ids_revd:
+                            chunk_ids = list(reversed(chunk_ids_revd))
+                            chunk_data_iter = self.repository.get_many(chunk_ids)
+                    else:
+                        if executor is None:
+                            verified(chunk_id, verify_chunk(chunk_id, encrypted_data))
+                        else:
+                            verifying.append((chunk_id, executor.submit(verify_chunk, chunk_id, encrypted_data)))
+                            drain(max_inflight)
+                if partial and time.monotonic() > t_start + max_duration:
+                    # all chunks up to state are verified after draining, the next partial verification
+                    # continues after them.
+                    drain(0)
+                    logger.info("Finished partial data verification, last segment verified is %d", state[0])
+                    self.save_verify_data_state(state_file, state)
+                    break
+            drain(0)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
         pi.finish()
-        if chunks_count_index != chunks_count_segments:
+        if not partial and chunks_count_index != chunks_count_segments:
             logger.error("Repo/Chunks index object count vs. segment files object count mismatch.")
             logger.error(
                 "Repo/Chunks index: %d objects != segment files: %d objects", chunks_count_index, chunks_count_segments
@@ -1952,6 +2413,30 @@ def verify_data(self):
             errors,
         )
 
+    @staticmethod
+    def load_verify_data_state(state_file):
+        try:
+            with open(state_file) as fd:
+                segment, offset, end_segment = json.load(fd)["state"]
+            return int(segment), int(offset), int(end_segment)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError, KeyError) as exc:
+            logger.warning("Could not read/parse data verification state file: %s", exc)
+            return None
+
+    @staticmethod
+    def save_verify_data_state(state_file, state):
+        with SaveFile(state_file) as fd:
+            json.dump({"state": list(state)}, fd)
+
+    @staticmethod
+    def clear_verify_data_state(state_file):
+        try:
+            os.unlink(state_file)
+        except FileNotFoundError:
+            pass
+
     def rebuild_manifest(self):
         """Rebuild the manifest object if it is missing
 
@@ -1979,10 +2464,21 @@ def valid_archive(obj):
             cdata = self.repository.get(chunk_id)
             try:
                 _, data = self.repo_objs.parse(chunk_id, cdata)
+            except DictionaryMissingError:
+                # an items metadata stream chunk (not an archive), its dictionary was not found yet
+                continue
             except IntegrityErrorBase as exc:
                 logger.error("Skipping corrupted chunk: %s", exc)
                 self.error_found = True
                 continue
+            if data[:4] == ZSTD_DICT_MAGIC:
+                try:
+                    manifest.add_metadata_dict(data, id=chunk_id)
+                except ValueError:
+                    pass  # not a zstd dictionary
+                else:
+                    logger.info("Found metadata dictionary %s", bin_to_hex(chunk_id))
+                continue
             if not valid_msgpacked_dict(data, archive_keys_serialized):
                 continue
             if b"command_line" not in data or b"\xa7version\x02" not in data:
@@ -2036,6 +2532,13 @@ def rebuild_refcounts(
         """
         # Exclude the manifest from chunks (manifest entry might be already deleted from self.chunks)
         self.chunks.pop(Manifest.MANIFEST_ID, None)
+        # the zstd dictionaries for the items metadata stream chunks are referenced by the manifest
+        for id_ in self.manifest.config.get("metadata_dicts", []):
+            if id_ in self.chunks:
+                self.chunks.incref(id_)
+            else:
+                logger.error("Metadata dictionary %s is missing.", bin_to_hex(id_))
+                self.error_found = True
 
         def mark_as_possibly_superseded(id_):
             if self.chunks.get(id_, ChunkIndexEntry(0, 0)).refcount == 0:
@@ -2081,54 +2584,62 @@ def replacement_chunk(size):
                 del item.chunks_healthy
                 has_chunks_healthy = False
                 chunks_healthy = chunks_current
-            for chunk_current, chunk_healthy in zip(chunks_current, chunks_healthy):
-                chunk_id, size = chunk_healthy
-                if chunk_id not in self.chunks:
-                    # a chunk of the healthy list is missing
-                    if chunk_current == chunk_healthy:
-                        logger.error(
-                            "{}: {}: New missing file chunk detected (Byte {}-{}, Chunk {}). "
-                            "Replacing with all-zero chunk.".format(
-                                archive_name, item.path, offset, offset + size, bin_to_hex(chunk_id)
-                            )
-                        )
-                        self.error_found = chunks_replaced = True
-                        chunk_id, size, cdata = replacement_chunk(size)
-                        add_reference(chunk_id, size, cdata)
-                    else:
-                        logger.info(
-                            "{}: {}: Previously missing file chunk is still missing (Byte {}-{}, Chunk {}). "
-                            "It has an all-zero replacement chunk already.".format(
-                                archive_name, item.path, offset, offset + size, bin_to_hex(chunk_id)
-                            )
-                        )
-                        chunk_id, size = chunk_current
-                        if chunk_id in self.chunks:
-                            add_reference(chunk_id, size)
-                        else:
-                            logger.warning(
-                                "{}: {}: Missing all-zero replacement chunk detected (Byte {}-{}, Chunk {}). "
-                                "Generating new replacement chunk.".format(
+            chunk_ids = b"".join(chunk_id for chunk_id, _ in chunks_current)
+            if not has_chunks_healthy and 0 not in self.chunks.contains_many(chunk_ids):
+                # normal case, all fine: add the references to all chunks at once.
+                self.chunks.incref_many(chunk_ids)
+                chunk_list = [[chunk_id, size] for chunk_id, size in chunks_current]
+            else:
+                for chunk_current, chunk_healthy in zip(chunks_current, chunks_healthy):
+                    chunk_id, size = chunk_healthy
+                    if chunk_id not in self.chunks:
+                        # a chunk of the healthy list is missing
+                        if chunk_current == chunk_healthy:
+                            logger.error(
+                                "{}: {}: New missing file chunk detected (Byte {}-{}, Chunk {}). "
+                                "Replacing with all-zero chunk.".format(
                                     archive_name, item.path, offset, offset + size, bin_to_hex(chunk_id)
                                 )
                             )
                             self.error_found = chunks_replaced = True
                             chunk_id, size, cdata = replacement_chunk(size)
                             add_reference(chunk_id, size, cdata)
-                else:
-                    if chunk_current == chunk_healthy:
-                        # normal case, all fine.
-                        add_reference(chunk_id, size)
+                        else:
+                            logger.info(
+                                "{}: {}: Previously missing file chunk is still missing (Byte {}-{}, Chunk {}). "
+                                "It has an all-zero replacement chunk already.".format(
+                                    archive_name, item.path, offset, offset + size, bin_to_hex(chunk_id)
+                                )
+                            )
+                            chunk_id, size = chunk_current
+                            if chunk_id in self.chunks:
+                                add_reference(chunk_id, size)
+                            else:
+                                logger.warning(
+                                    "{}: {}: Missing all-zero replacement chunk detected (Byte {}-{}, Chunk {}). "
+                                    "Generating new replacement chunk.".format(
+                                        archive_name, item.path, offset, offset + size, bin_to_hex(chunk_id)
+                                    )
+                                )
+                                self.error_found = chunks_replaced = True
+                                chunk_id, size, cdata = replacement_chunk(size)
+                                add_reference(chunk_id, size, cdata)
                     else:
-                        logger.info(
-                            "{}: {}: Healed previously missing file chunk! (Byte {}-{}, Chunk {}).".format(
-                                archive_name, item.path, offset, offset + size, bin_to_hex(chunk_id)
+                        if chunk_current == chunk_healthy:
+                            # normal case, all fine.
+                            add_reference(chunk_id, size)
+                        else:
+                            logger.info(
+                                "{}: {}: Healed previously missing file chunk! (Byte {}-{}, Chunk {}).".format(
+                                    archive_name, item.path, offset, offset + size, bin_to_hex(chunk_id)
+                                )
                             )
-                        )
-                        add_reference(chunk_id, size)
-                        mark_as_possibly_superseded(chunk_current[0])  # maybe orphaned the all-zero replacement chunk
-                chunk_list.append([chunk_id, size])  # list-typed element as chunks_healthy is list-of-lists
-                offset += size
+                            add_reference(chunk_id, size)
+                            mark_as_possibly_superseded(
+                                chunk_current[0]
+                            )  # maybe orphaned the all-zero replacement chunk
+                    chunk_list.append([chunk_id, size])  # list-typed element as chunks_healthy is list-of-lists
+                    offset += size
             if chunks_replaced and not has_chunks_healthy:
                 # if this is first repair, remember the correct chunk IDs, so we can maybe heal the file later
                 item.chunks_healthy = item.chunks
@@ -2423,8 +2934,7 @@ def process_item(self, archive, target, item):
 
     def process_chunks(self, archive, target, item):
         if not target.recreate_rechunkify:
-            for chunk_id, size in item.chunks:
-                self.cache.chunk_incref(chunk_id, target.stats)
+            self.cache.chunks_incref([chunk_id for chunk_id, _ in item.chunks], target.stats)
             return item.chunks
         chunk_iterator = self.iter_chunks(archive, target, list(item.chunks))
         chunk_processor = partial(self.chunk_processor, target)
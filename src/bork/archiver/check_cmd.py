@@ -4,6 +4,7 @@
 from ..constants import *  # NOQA
 from ..helpers import EXIT_SUCCESS, EXIT_WARNING, EXIT_ERROR
 from ..helpers import yes
+from ..helpers import positive_int_validator
 
 from ..logger import create_logger
 
@@ -39,19 +40,23 @@ def do_check(self, args, repository):
         if args.repair and args.max_duration:
             self.print_error("--repair does not allow --max-duration argument.")
             return EXIT_ERROR
-        if args.max_duration and not args.repo_only:
+        if args.max_duration and not (args.repo_only or args.archives_only and args.verify_data):
             # when doing a partial repo check, we can only check crc32 checksums in segment files,
             # we can't build a fresh repo index in memory to verify the on-disk index against it.
             # thus, we should not do an archives check based on a unknown-quality on-disk repo index.
-            # also, there is no max_duration support in the archives check code anyway.
-            self.print_error("--repository-only is required for --max-duration support.")
+            # also, the archives check code only supports max_duration for the data verification.
+            self.print_error(
+                "--repository-only or --archives-only --verify-data is required for --max-duration support."
+            )
             return EXIT_ERROR
         if not args.archives_only:
-            if not repository.check(repair=args.repair, max_duration=args.max_duration):
+            if not repository.check(repair=args.repair, max_duration=args.max_duration, workers=args.workers):
                 return EXIT_WARNING
         if not args.repo_only and not ArchiveChecker().check(
             repository,
             verify_data=args.verify_data,
+            workers=args.workers,
+            max_duration=args.max_duration,
             repair=args.repair,
             match=args.match_archives,
             sort_by=args.sort_by or "ts",
@@ -79,7 +84,9 @@ def build_parser_check(self, subparsers, common_parser, mid_common_parser):
            the segments. The read data is checked by size and CRC. Bit rot and other
            types of accidental damage can be detected this way. Running the repository
            check can be split into multiple partial checks using ``--max-duration``.
-           When checking a remote repository, please note that the checks run on the
+           With ``--workers``, multiple segment files are read and verified at the same
+           time, which helps on fast storage where the check is CPU bound. When
+           checking a remote repository, please note that the checks run on the
            server and do not cause significant network traffic.
 
         2. Checking consistency and correctness of the archive metadata and optionally
@@ -122,7 +129,16 @@ def build_parser_check(self, subparsers, common_parser, mid_common_parser):
         cryptographic verification and hence very time consuming, but will detect any
         accidental and malicious corruption. Tamper-resistance is only guaranteed for
         encrypted repositories against attackers without access to the keys. You can
-        not use ``--verify-data`` with ``--repository-only``.
+        not use ``--verify-data`` with ``--repository-only``. Use ``--workers`` to
+        decrypt, decompress and verify the data with multiple threads, while the
+        data is still read from the repository in on-disk order.
+
+        The data verification can be split into multiple partial verifications by
+        passing ``--archives-only --verify-data --max-duration=SECONDS``. Like for the
+        partial repository check, the next partial verification will continue where the
+        previous one stopped (the position is stored in the local security directory of
+        the repository) and a verification without ``--max-duration`` starts from the
+        beginning again. Partial data verifications skip all other archive checks.
 
         About repair mode
         +++++++++++++++++
@@ -217,6 +233,16 @@ def build_parser_check(self, subparsers, common_parser, mid_common_parser):
             type=int,
             default=0,
             action=Highlander,
-            help="do only a partial repo check for max. SECONDS seconds (Default: unlimited)",
+            help="do only a partial repo check or data verification for max. SECONDS seconds (Default: unlimited)",
+        )
+        subparser.add_argument(
+            "--workers",
+            metavar="N",
+            dest="workers",
+            type=positive_int_validator,
+            default=1,
+            action=Highlander,
+            help="use N threads for reading and verifying segment files in the repository check and for "
+            "decrypting, decompressing and verifying data with ``--verify-data`` (Default: 1, no extra threads)",
         )
         define_archive_filters_group(subparser)
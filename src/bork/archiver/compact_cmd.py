@@ -18,7 +18,7 @@ def do_compact(self, args, repository):
         data = repository.get(Manifest.MANIFEST_ID)
         repository.put(Manifest.MANIFEST_ID, data)
         threshold = args.threshold / 100
-        repository.commit(compact=True, threshold=threshold)
+        repository.commit(compact=True, threshold=threshold, max_duration=args.max_duration)
         return EXIT_SUCCESS
 
     def build_parser_compact(self, subparsers, common_parser, mid_common_parser):
@@ -42,6 +42,13 @@ def build_parser_compact(self, subparsers, common_parser, mid_common_parser):
         given by the ``--threshold`` option. If omitted, a threshold of 10% is used.
         When using ``--verbose``, bork will output an estimate of the freed space.
 
+        The segments freeing the most space per amount of data that needs to be copied are
+        compacted first. The data still used is copied as it is, without reading it into
+        bork (within the kernel, if supported). Using ``--max-duration``, the compaction
+        stops after the given number of seconds and the remaining segments are compacted by
+        a later compaction, e.g. ``bork compact --max-duration=600`` frees as much space as
+        possible within about 10 minutes.
+
         See :ref:`separate_compaction` in Additional Notes for more details.
         """
         )
@@ -64,3 +71,12 @@ def build_parser_compact(self, subparsers, common_parser, mid_common_parser):
             action=Highlander,
             help="set minimum threshold for saved space in PERCENT (Default: 10)",
         )
+        subparser.add_argument(
+            "--max-duration",
+            metavar="SECONDS",
+            dest="max_duration",
+            type=int,
+            default=0,
+            action=Highlander,
+            help="do only a partial compaction for max. SECONDS seconds (Default: unlimited)",
+        )
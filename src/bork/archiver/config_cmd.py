@@ -43,7 +43,7 @@ def repo_validate(section, name, value=None, check_value=True):
                     elif name == "max_segment_size":
                         if parse_file_size(value) >= MAX_SEGMENT_SIZE_LIMIT:
                             raise ValueError("Invalid value: max_segment_size >= %d" % MAX_SEGMENT_SIZE_LIMIT)
-            elif name in ["append_only"]:
+            elif name in ["append_only", "index_deltas"]:
                 if check_value and value not in ["0", "1"]:
                     raise ValueError("Invalid value")
             elif name in ["id"]:
@@ -74,6 +74,7 @@ def list_config(config):
                 "additional_free_space": "0",
                 "storage_quota": repository.storage_quota,
                 "append_only": repository.append_only,
+                "index_deltas": "0",
             }
             print("[repository]")
             for key in [
@@ -83,9 +84,10 @@ def list_config(config):
                 "storage_quota",
                 "additional_free_space",
                 "append_only",
+                "index_deltas",
                 "id",
             ]:
-                value = config.get("repository", key, fallback=False)
+                value = config.get("repository", key, fallback=None)
                 if value is None:
                     value = default_values.get(key)
                     if value is None:
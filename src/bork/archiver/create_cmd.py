@@ -6,6 +6,8 @@
 import stat
 import subprocess
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from io import TextIOWrapper
 
 from ._common import with_repository, Highlander
@@ -16,7 +18,7 @@
 from ..cache import Cache
 from ..constants import *  # NOQA
 from ..compress import CompressionSpec
-from ..helpers import comment_validator, ChunkerParams
+from ..helpers import comment_validator, ChunkerParams, positive_int_validator
 from ..helpers import archivename_validator, FilesCacheMode
 from ..helpers import eval_escapes
 from ..helpers import timestamp, archive_ts_now
@@ -207,72 +209,123 @@ def create_inner(archive, cache, fso):
         self.noacls = args.noacls
         self.noxattrs = args.noxattrs
         self.exclude_nodump = args.exclude_nodump
+        # the walker can prefetch the stat() results of upcoming directory entries in threads,
+        # this hides the syscall latency on network filesystems.
+        self.stat_prefetch_executor = (
+            ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="stat") if args.workers > 1 else None
+        )
+        self.stat_prefetch_max = 16 * args.workers  # max. number of directory entries to prefetch
         dry_run = args.dry_run
         t0 = archive_ts_now()
         t0_monotonic = time.monotonic()
         logger.info('Creating archive at "%s"' % args.location.processed)
-        if not dry_run:
-            with Cache(
-                repository,
-                manifest,
-                progress=args.progress,
-                lock_wait=self.lock_wait,
-                permit_adhoc_cache=args.no_cache_sync,
-                cache_mode=args.files_cache_mode,
-                iec=args.iec,
-            ) as cache:
-                archive = Archive(
+        try:
+            if not dry_run:
+                with Cache(
+                    repository,
                     manifest,
-                    args.name,
-                    cache=cache,
-                    create=True,
-                    numeric_ids=args.numeric_ids,
-                    noatime=not args.atime,
-                    noctime=args.noctime,
                     progress=args.progress,
-                    chunker_params=args.chunker_params,
-                    start=t0,
-                    start_monotonic=t0_monotonic,
-                    log_json=args.log_json,
-                    iec=args.iec,
-                )
-                metadata_collector = MetadataCollector(
-                    noatime=not args.atime,
-                    noctime=args.noctime,
-                    noflags=args.noflags,
-                    noacls=args.noacls,
-                    noxattrs=args.noxattrs,
-                    numeric_ids=args.numeric_ids,
-                    nobirthtime=args.nobirthtime,
-                )
-                cp = ChunksProcessor(
-                    cache=cache,
-                    key=key,
-                    add_item=archive.add_item,
-                    prepare_checkpoint=archive.prepare_checkpoint,
-                    write_checkpoint=archive.write_checkpoint,
-                    checkpoint_interval=args.checkpoint_interval,
-                    checkpoint_volume=args.checkpoint_volume,
-                    rechunkify=False,
-                )
-                fso = FilesystemObjectProcessors(
-                    metadata_collector=metadata_collector,
-                    cache=cache,
-                    key=key,
-                    process_file_chunks=cp.process_file_chunks,
-                    add_item=archive.add_item,
-                    chunker_params=args.chunker_params,
-                    show_progress=args.progress,
-                    sparse=args.sparse,
-                    log_json=args.log_json,
+                    lock_wait=self.lock_wait,
+                    permit_adhoc_cache=args.no_cache_sync,
+                    cache_mode=args.files_cache_mode,
                     iec=args.iec,
-                    file_status_printer=self.print_file_status,
-                )
-                create_inner(archive, cache, fso)
-        else:
-            create_inner(None, None, None)
+                ) as cache:
+                    archive = Archive(
+                        manifest,
+                        args.name,
+                        cache=cache,
+                        create=True,
+                        numeric_ids=args.numeric_ids,
+                        noatime=not args.atime,
+                        noctime=args.noctime,
+                        progress=args.progress,
+                        chunker_params=args.chunker_params,
+                        start=t0,
+                        start_monotonic=t0_monotonic,
+                        log_json=args.log_json,
+                        iec=args.iec,
+                        metadata_dict=args.metadata_dict,
+                    )
+                    metadata_collector = MetadataCollector(
+                        noatime=not args.atime,
+                        noctime=args.noctime,
+                        noflags=args.noflags,
+                        noacls=args.noacls,
+                        noxattrs=args.noxattrs,
+                        numeric_ids=args.numeric_ids,
+                        nobirthtime=args.nobirthtime,
+                    )
+                    cp = ChunksProcessor(
+                        cache=cache,
+                        key=key,
+                        add_item=archive.add_item,
+                        prepare_checkpoint=archive.prepare_checkpoint,
+                        write_checkpoint=archive.write_checkpoint,
+                        checkpoint_interval=args.checkpoint_interval,
+                        checkpoint_volume=args.checkpoint_volume,
+                        rechunkify=False,
+                        workers=args.workers,
+                    )
+                    fso = FilesystemObjectProcessors(
+                        metadata_collector=metadata_collector,
+                        cache=cache,
+                        key=key,
+                        process_file_chunks=cp.process_file_chunks,
+                        add_item=archive.add_item,
+                        chunker_params=args.chunker_params,
+                        show_progress=args.progress,
+                        sparse=args.sparse,
+                        log_json=args.log_json,
+                        iec=args.iec,
+                        file_status_printer=self.print_file_status,
+                    )
+                    try:
+                        create_inner(archive, cache, fso)
+                    finally:
+                        cp.close()
+            else:
+                create_inner(None, None, None)
+        finally:
+            if self.stat_prefetch_executor is not None:
+                self.stat_prefetch_executor.shutdown()
+                self.stat_prefetch_executor = None
         return self.exit_code
 
+    def _iter_prefetched_stats(self, *, path, entries, parent_fd):
+        """
+        Yield (dirent, st) for the directory *entries* (in the same order).
+
+        st is the os_stat result for the entry, prefetched by the stat_prefetch_executor, or None
+        if it was not prefetched or the prefetching failed (the caller then stats again, so errors
+        get reported as usual).
+        """
+        if self.stat_prefetch_executor is None:
+            for dirent in entries:
+                yield dirent, None
+            return
+
+        def prefetch_stat(name):
+            try:
+                return os_stat(path=os.path.join(path, name), parent_fd=parent_fd, name=name, follow_symlinks=False)
+            except OSError:
+                return None
+
+        pending = deque()
+        try:
+            for dirent in entries:
+                pending.append((dirent, self.stat_prefetch_executor.submit(prefetch_stat, dirent.name)))
+                if len(pending) >= self.stat_prefetch_max:
+                    dirent, future = pending.popleft()
+                    yield dirent, future.result()
+            while pending:
+                dirent, future = pending.popleft()
+                yield dirent, future.result()
+        finally:
+            # parent_fd will get closed by our caller, so no prefetching must use it after we return.
+            for dirent, future in pending:
+                future.cancel()
+            wait([future for dirent, future in pending])
+
     def _process_any(self, *, path, parent_fd, name, st, fso, cache, read_special, dry_run):
         """
         Call the right method on the given FilesystemObjectProcessor.
@@ -400,10 +453,13 @@ def _rec_walk(
         restrict_dev,
         read_special,
         dry_run,
+        st=None,
     ):
         """
         Process *path* (or, preferably, parent_fd/name) recursively according to the various parameters.
 
+        *st* may be given if the stat result for *path* is already known (prefetched).
+
         This should only raise on critical errors. Per-item errors must be handled within this method.
         """
         if sig_int and sig_int.action_done():
@@ -414,8 +470,9 @@ def _rec_walk(
         try:
             recurse_excluded_dir = False
             if matcher.match(path):
-                with backup_io("stat"):
-                    st = os_stat(path=path, parent_fd=parent_fd, name=name, follow_symlinks=False)
+                if st is None:
+                    with backup_io("stat"):
+                        st = os_stat(path=path, parent_fd=parent_fd, name=name, follow_symlinks=False)
             else:
                 self.print_file_status("-", path)  # excluded
                 # get out here as quickly as possible:
@@ -425,8 +482,9 @@ def _rec_walk(
                 if not matcher.recurse_dir:
                     return
                 recurse_excluded_dir = True
-                with backup_io("stat"):
-                    st = os_stat(path=path, parent_fd=parent_fd, name=name, follow_symlinks=False)
+                if st is None:
+                    with backup_io("stat"):
+                        st = os_stat(path=path, parent_fd=parent_fd, name=name, follow_symlinks=False)
                 if not stat.S_ISDIR(st.st_mode):
                     return
 
@@ -501,7 +559,9 @@ def _rec_walk(
                     if recurse:
                         with backup_io("scandir"):
                             entries = helpers.scandir_inorder(path=path, fd=child_fd)
-                        for dirent in entries:
+                        for dirent, dirent_st in self._iter_prefetched_stats(
+                            path=path, entries=entries, parent_fd=child_fd
+                        ):
                             normpath = os.path.normpath(os.path.join(path, dirent.name))
                             self._rec_walk(
                                 path=normpath,
@@ -517,6 +577,7 @@ def _rec_walk(
                                 restrict_dev=restrict_dev,
                                 read_special=read_special,
                                 dry_run=dry_run,
+                                st=dirent_st,
                             )
 
         except (BackupOSError, BackupError) as e:
@@ -929,6 +990,24 @@ def build_parser_create(self, subparsers, common_parser, mid_common_parser):
             action=Highlander,
             help="select compression algorithm, see the output of the " '"bork help compression" command for details.',
         )
+        archive_group.add_argument(
+            "--metadata-dict",
+            dest="metadata_dict",
+            action="store_true",
+            help="train a zstd dictionary for compressing the file metadata of this and later archives, "
+            "if zstd compression is used and the repository has none yet "
+            '(older bork versions can not use the repository afterwards, see "bork help compression")',
+        )
+        archive_group.add_argument(
+            "--workers",
+            metavar="N",
+            dest="workers",
+            type=positive_int_validator,
+            default=1,
+            action=Highlander,
+            help="use N threads for hashing and compressing file content chunks and for prefetching file metadata "
+            "(Default: 1, no extra threads)",
+        )
 
         subparser.add_argument("name", metavar="NAME", type=archivename_validator, help="specify the archive name")
         subparser.add_argument("paths", metavar="PATH", nargs="*", type=str, action="extend", help="paths to archive")
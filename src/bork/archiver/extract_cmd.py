@@ -3,15 +3,18 @@
 import logging
 import os
 import stat
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from ._common import with_repository, with_archive
+from ._common import with_repository, with_archive, Highlander
 from ._common import build_filter, build_matcher
-from ..archive import BackupError, BackupOSError
+from ..archive import BackupError, BackupOSError, FileCloner
 from ..constants import *  # NOQA
-from ..helpers import archivename_validator
+from ..helpers import archivename_validator, positive_int_validator
 from ..helpers import remove_surrogates
 from ..helpers import HardLinkManager
 from ..helpers import ProgressIndicatorPercent
+from ..helpers.chunkcache import ExtractChunkCache
 from ..manifest import Manifest
 
 from ..logger import create_logger
@@ -47,43 +50,102 @@ def do_extract(self, args, repository, manifest, archive):
         hlm = HardLinkManager(id_type=bytes, info_type=str)  # hlid -> path
 
         filter = build_filter(matcher, strip_components)
+        # chunks referenced by multiple files are fetched and decrypted once while they fit into the cache.
+        chunk_cache = archive.pipeline.chunk_cache = ExtractChunkCache(EXTRACT_CHUNK_CACHE_SIZE)
+        if not dry_run and not stdout:
+            # files with the same content as an already extracted file are cloned (e.g. reflinks on btrfs).
+            archive.pipeline.file_cloner = FileCloner()
         if progress:
             pi = ProgressIndicatorPercent(msg="%5.1f%% Extracting: %s", step=0.1, msgid="extract")
             pi.output("Calculating total archive size for the progress indicator (might take long for large archives)")
-            extracted_size = sum(item.get_size() for item in archive.iter_items(filter))
-            pi.total = extracted_size
         else:
             pi = None
+        total_size, items = archive.iter_items_with_size(filter, preload=True)
+        if pi:
+            pi.total = total_size
 
-        for item in archive.iter_items(filter, preload=True):
-            orig_path = item.path
-            if strip_components:
-                item.path = os.sep.join(orig_path.split(os.sep)[strip_components:])
-            if not args.dry_run:
-                while dirs and not item.path.startswith(dirs[-1].path):
-                    dir_item = dirs.pop(-1)
-                    try:
-                        archive.extract_item(dir_item, stdout=stdout)
-                    except BackupOSError as e:
-                        self.print_warning("%s: %s", remove_surrogates(dir_item.path), e)
-            if output_list:
-                logging.getLogger("bork.output.list").info(remove_surrogates(item.path))
+        def restore_dir_attrs(dir_item):
             try:
-                if dry_run:
-                    archive.extract_item(item, dry_run=True, hlm=hlm, pi=pi)
-                else:
-                    if stat.S_ISDIR(item.mode):
-                        dirs.append(item)
-                        archive.extract_item(item, stdout=stdout, restore_attrs=False)
+                archive.extract_item(dir_item, stdout=stdout)
+            except BackupOSError as e:
+                self.print_warning("%s: %s", remove_surrogates(dir_item.path), e)
+
+        # with --workers, files are created and written by worker threads, while their chunks are still
+        # fetched here, in archive order. the attributes of a directory are only restored when all files
+        # submitted before leaving that directory have been written.
+        executor = None
+        if args.workers > 1 and not dry_run and not stdout:
+            executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="extract")
+        writing = deque()  # (path, future) of the files written by the executor, in submission order
+        written = submitted = 0
+        restoring = deque()  # (submitted, dir_item) of directories to restore when that many files were written
+
+        def collect(max_writing):
+            # get the results of the written files (in submission order), wait until at most max_writing
+            # files are still being written, then restore the attributes of directories which are done.
+            nonlocal written
+            while writing and (len(writing) > max_writing or writing[0][1].done()):
+                path, future = writing.popleft()
+                try:
+                    future.result()
+                except (BackupOSError, BackupError) as e:
+                    self.print_warning("%s: %s", remove_surrogates(path), e)
+                written += 1
+            while restoring and restoring[0][0] <= written:
+                restore_dir_attrs(restoring.popleft()[1])
+
+        try:
+            for item in items:
+                orig_path = item.path
+                if strip_components:
+                    item.path = os.sep.join(orig_path.split(os.sep)[strip_components:])
+                if not args.dry_run:
+                    while dirs and not item.path.startswith(dirs[-1].path):
+                        dir_item = dirs.pop(-1)
+                        if executor is not None:
+                            restoring.append((submitted, dir_item))
+                            collect(2 * args.workers)
+                        else:
+                            restore_dir_attrs(dir_item)
+                if output_list:
+                    logging.getLogger("bork.output.list").info(remove_surrogates(item.path))
+                try:
+                    if dry_run:
+                        archive.extract_item(item, dry_run=True, hlm=hlm, pi=pi)
                     else:
-                        archive.extract_item(
-                            item, stdout=stdout, sparse=sparse, hlm=hlm, pi=pi, continue_extraction=continue_extraction
-                        )
-            except (BackupOSError, BackupError) as e:
-                self.print_warning("%s: %s", remove_surrogates(orig_path), e)
+                        if stat.S_ISDIR(item.mode):
+                            dirs.append(item)
+                            archive.extract_item(item, stdout=stdout, restore_attrs=False)
+                        else:
+                            future = archive.extract_item(
+                                item,
+                                stdout=stdout,
+                                sparse=sparse,
+                                hlm=hlm,
+                                pi=pi,
+                                continue_extraction=continue_extraction,
+                                executor=executor,
+                            )
+                            if future is not None:
+                                writing.append((orig_path, future))
+                                submitted += 1
+                                collect(2 * args.workers)
+                except (BackupOSError, BackupError) as e:
+                    self.print_warning("%s: %s", remove_surrogates(orig_path), e)
+            collect(0)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
 
         if pi:
             pi.finish()
+        logger.debug(
+            "extract chunk cache: %d hits, %d misses, %d evictions.",
+            chunk_cache.hits,
+            chunk_cache.misses,
+            chunk_cache.evictions,
+        )
+        chunk_cache.clear()
 
         if not args.dry_run:
             pi = ProgressIndicatorPercent(
@@ -91,11 +153,7 @@ def do_extract(self, args, repository, manifest, archive):
             )
             while dirs:
                 pi.show()
-                dir_item = dirs.pop(-1)
-                try:
-                    archive.extract_item(dir_item, stdout=stdout)
-                except BackupOSError as e:
-                    self.print_warning("%s: %s", remove_surrogates(dir_item.path), e)
+                restore_dir_attrs(dirs.pop(-1))
         for pattern in matcher.get_unmatched_include_patterns():
             self.print_warning("Include pattern '%s' never matched.", pattern)
         if pi:
@@ -120,8 +178,24 @@ def build_parser_extract(self, subparsers, common_parser, mid_common_parser):
         output data: reading metadata and data chunks from the repo, checking the hash/hmac,
         decrypting, decompressing.
 
-        ``--progress`` can be slower than no progress display, since it makes one additional
-        pass over the archive metadata.
+        Before extracting, the archive metadata is read once to compute the total size (for
+        ``--progress``) and to find the chunks shared by multiple files, meanwhile the selected
+        items are kept in memory or in a temporary file. Shared chunks are kept in a cache
+        (up to 64 MiB) after being fetched, so they are only read and decrypted again if they
+        did not fit into the cache.
+
+        Files (of at least 64 KiB) with the same content as an already extracted file are
+        created as a copy of that file within the kernel, without fetching and writing their
+        data again. On file systems supporting it (e.g. btrfs, xfs), the copy shares the data
+        blocks with the original file (reflink). If copying within the kernel is not supported,
+        the data is written as usual.
+
+        With ``--workers N``, creating and writing the files and restoring their metadata
+        is done by N threads, which helps if the latency of the file system operations is
+        the bottleneck (e.g. when extracting many small files). The data is still read from
+        the repository in archive order and the metadata of directories is restored after
+        their contents were written. Hardlinked files and files bigger than 4 MiB are written
+        without using the threads.
 
         .. note::
 
@@ -175,6 +249,16 @@ def build_parser_extract(self, subparsers, common_parser, mid_common_parser):
             action="store_true",
             help="continue a previously interrupted extraction of same archive",
         )
+        subparser.add_argument(
+            "--workers",
+            metavar="N",
+            dest="workers",
+            type=positive_int_validator,
+            default=1,
+            action=Highlander,
+            help="use N threads for creating and writing files and restoring their metadata "
+            "(Default: 1, no extra threads)",
+        )
         subparser.add_argument("name", metavar="NAME", type=archivename_validator, help="specify the archive name")
         subparser.add_argument(
             "paths", metavar="PATH", nargs="*", type=str, help="paths to extract; patterns are supported"
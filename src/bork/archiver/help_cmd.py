@@ -377,6 +377,12 @@ class HelpMixIn:
             Use zstd ("zstandard") compression, a modern wide-range algorithm.
             If you do not explicitly give the compression level L (ranging from 1
             to 22), it will use level 3.
+            If requested using ``bork create --metadata-dict``, an archive created using
+            zstd (also within auto) with at least 1000 files trains a zstd dictionary
+            from its file metadata and stores it in the repository. The file metadata
+            of later archives is compressed using that dictionary. This can not be
+            undone: older bork versions not supporting it can no longer use the
+            repository (neither to read nor to write or delete anything).
 
         zlib[,L]
             Use zlib ("gz") compression. Medium speed, medium compression.
@@ -398,7 +404,10 @@ class HelpMixIn:
             The heuristic tries with lz4 whether the data is compressible.
             For incompressible data, it will not use compression (uses "none").
             For compressible data, it uses the given C[,L] compression - with C[,L]
-            being any valid compression specifier.
+            being any valid compression specifier. For big chunks, only some samples
+            are tried with lz4 first. Once some consecutive chunks of a file did not
+            compress, the following chunks of that file are mostly stored without
+            trying to compress them (every 16th chunk is still tried).
 
         obfuscate,SPEC,C[,L]
             Use compressed-size obfuscation to make fingerprinting attacks based on
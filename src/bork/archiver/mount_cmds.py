@@ -101,11 +101,14 @@ def build_parser_mount_umount(self, subparsers, common_parser, mid_common_parser
         - ``ignore_permissions``: for security reasons the ``default_permissions`` mount
           option is internally enforced by bork. ``ignore_permissions`` can be given to
           not enforce ``default_permissions``.
-
-        The BORK_MOUNT_DATA_CACHE_ENTRIES environment variable is meant for advanced users
-        to tweak the performance. It sets the number of cached data chunks; additional
-        memory usage can be up to ~8 MiB times this number. The default is the number
-        of CPU cores.
+        - ``chunk_cache_size=SIZE``: memory budget for caching decrypted file content
+          chunks, e.g. ``chunk_cache_size=2G`` (default: 128M). Least recently used
+          chunks are evicted first.
+        - ``chunk_cache_disk_size=SIZE``: if given, chunks evicted from memory are kept
+          in a temporary directory on local disk (see TMPDIR) up to this size (default:
+          0, no disk tier). Note that this stores decrypted data on local disk.
+        - ``readahead=N``: when reading a file sequentially, also fetch the next N chunks
+          of it, all in one go (default: 4, ``readahead=0`` disables read-ahead).
 
         When the daemonized process receives a signal or crashes, it does not unmount.
         Unmounting in these cases could cause an active rsync or similar process
@@ -106,10 +106,10 @@ def _export_tar(self, args, archive, tarstream):
         if progress:
             pi = ProgressIndicatorPercent(msg="%5.1f%% Processing: %s", step=0.1, msgid="extract")
             pi.output("Calculating size")
-            extracted_size = sum(item.get_size() for item in archive.iter_items(filter))
-            pi.total = extracted_size
+            pi.total, items = archive.iter_items_with_size(filter, preload=True)
         else:
             pi = None
+            items = archive.iter_items(filter, preload=True)
 
         def item_content_stream(item):
             """
@@ -219,7 +219,7 @@ def item_to_paxheaders(format, item):
                 ph["BORK.item.meta"] = meta_text
             return ph
 
-        for item in archive.iter_items(filter, preload=True):
+        for item in items:
             orig_path = item.path
             if strip_components:
                 item.path = os.sep.join(orig_path.split(os.sep)[strip_components:])
@@ -380,8 +380,8 @@ def build_parser_tar(self, subparsers, common_parser, mid_common_parser):
 
         For more help on include/exclude patterns, see the :ref:`bork_patterns` command output.
 
-        ``--progress`` can be slower than no progress display, since it makes one additional
-        pass over the archive metadata.
+        ``--progress`` reads the archive metadata before exporting to compute the total size,
+        meanwhile the selected items are kept in memory or in a temporary file.
         """
         )
         subparser = subparsers.add_parser(
@@ -102,45 +102,52 @@ def do_transfer(self, args, *, repository, manifest, cache, other_repository=Non
                         continue
                     if "chunks" in item:
                         chunks = []
-                        for chunk_id, size in item.chunks:
-                            refcount = cache.seen_chunk(chunk_id, size)
-                            if refcount == 0:  # target repo does not yet have this chunk
-                                if not dry_run:
-                                    cdata = other_repository.get(chunk_id)
-                                    if args.recompress == "never":
-                                        # keep compressed payload same, verify via assert_id (that will
-                                        # decompress, but avoid needing to compress it again):
-                                        meta, data = other_manifest.repo_objs.parse(
-                                            chunk_id, cdata, decompress=True, want_compressed=True
-                                        )
-                                        meta, data = upgrader.upgrade_compressed_chunk(meta, data)
-                                        chunk_entry = cache.add_chunk(
-                                            chunk_id,
-                                            meta,
-                                            data,
-                                            stats=archive.stats,
-                                            wait=False,
-                                            compress=False,
-                                            size=size,
-                                            ctype=meta["ctype"],
-                                            clevel=meta["clevel"],
-                                        )
-                                    elif args.recompress == "always":
-                                        # always decompress and re-compress file data chunks
-                                        meta, data = other_manifest.repo_objs.parse(chunk_id, cdata)
-                                        chunk_entry = cache.add_chunk(
-                                            chunk_id, meta, data, stats=archive.stats, wait=False
-                                        )
-                                    else:
-                                        raise ValueError(f"unsupported recompress mode: {args.recompress}")
-                                    cache.repository.async_response(wait=False)
-                                    chunks.append(chunk_entry)
-                                transfer_size += size
-                            else:
-                                if not dry_run:
-                                    chunk_entry = cache.chunk_incref(chunk_id, archive.stats)
-                                    chunks.append(chunk_entry)
-                                present_size += size
+                        chunk_ids = [chunk_id for chunk_id, _ in item.chunks]
+                        if 0 not in cache.seen_chunks(chunk_ids, [size for _, size in item.chunks]):
+                            # target repo already has all chunks, add the references to all of them at once
+                            if not dry_run:
+                                chunks = cache.chunks_incref(chunk_ids, archive.stats)
+                            present_size += sum(size for _, size in item.chunks)
+                        else:
+                            for chunk_id, size in item.chunks:
+                                refcount = cache.seen_chunk(chunk_id, size)
+                                if refcount == 0:  # target repo does not yet have this chunk
+                                    if not dry_run:
+                                        cdata = other_repository.get(chunk_id)
+                                        if args.recompress == "never":
+                                            # keep compressed payload same, verify via assert_id (that will
+                                            # decompress, but avoid needing to compress it again):
+                                            meta, data = other_manifest.repo_objs.parse(
+                                                chunk_id, cdata, decompress=True, want_compressed=True
+                                            )
+                                            meta, data = upgrader.upgrade_compressed_chunk(meta, data)
+                                            chunk_entry = cache.add_chunk(
+                                                chunk_id,
+                                                meta,
+                                                data,
+                                                stats=archive.stats,
+                                                wait=False,
+                                                compress=False,
+                                                size=size,
+                                                ctype=meta["ctype"],
+                                                clevel=meta["clevel"],
+                                            )
+                                        elif args.recompress == "always":
+                                            # always decompress and re-compress file data chunks
+                                            meta, data = other_manifest.repo_objs.parse(chunk_id, cdata)
+                                            chunk_entry = cache.add_chunk(
+                                                chunk_id, meta, data, stats=archive.stats, wait=False
+                                            )
+                                        else:
+                                            raise ValueError(f"unsupported recompress mode: {args.recompress}")
+                                        cache.repository.async_response(wait=False)
+                                        chunks.append(chunk_entry)
+                                    transfer_size += size
+                                else:
+                                    if not dry_run:
+                                        chunk_entry = cache.chunk_incref(chunk_id, archive.stats)
+                                        chunks.append(chunk_entry)
+                                    present_size += size
                         if not dry_run:
                             item.chunks = chunks  # TODO: overwrite? IDs and sizes are same.
                             archive.stats.nfiles += 1
@@ -2,8 +2,12 @@
 import os
 import shutil
 import stat
+import threading
+from array import array
 from binascii import unhexlify
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from time import perf_counter
 
 from .logger import create_logger
@@ -12,7 +16,7 @@
 
 files_cache_logger = create_logger("bork.debug.files_cache")
 
-from .constants import CACHE_README, FILES_CACHE_MODE_DISABLED
+from .constants import CACHE_README, FILES_CACHE_MODE_DISABLED, SYNC_FETCH_BATCH_SIZE
 from .hashindex import ChunkIndex, ChunkIndexEntry, CacheSynchronizer
 from .helpers import Location
 from .helpers import Error
@@ -24,21 +28,19 @@
 from .helpers import remove_surrogates
 from .helpers import ProgressIndicatorPercent, ProgressIndicatorMessage
 from .helpers import set_ec, EXIT_WARNING
-from .helpers import safe_unlink
+from .helpers import safe_unlink, MappedFile
 from .helpers import msgpack
-from .helpers.msgpack import int_to_timestamp, timestamp_to_int
+from .helpers.msgpack import timestamp_to_int
 from .item import ArchiveItem, ChunkListEntry
 from .crypto.key import PlaintextKey
 from .crypto.file_integrity import IntegrityCheckedFile, DetachedIntegrityCheckedFile, FileIntegrityError
+from .filescache import FilesCache, FileCacheEntry
 from .locking import Lock
 from .manifest import Manifest
 from .platform import SaveFile
 from .remote import cache_if_remote
 from .repository import LIST_SCAN_LIMIT
 
-# note: cmtime might me either a ctime or a mtime timestamp
-FileCacheEntry = namedtuple("FileCacheEntry", "age inode size cmtime chunk_ids")
-
 
 class SecurityManager:
     """
@@ -556,11 +558,12 @@ def create(self):
             pass  # empty file
 
     def _do_open(self):
+        self._close_files()
         self.cache_config.load()
-        with IntegrityCheckedFile(
-            path=os.path.join(self.path, "chunks"),
-            write=False,
-            integrity_data=self.cache_config.integrity.get("chunks"),
+        chunks_path = os.path.join(self.path, "chunks")
+        # map the chunks index instead of reading it, only the buckets changed later are copied (see MappedFile).
+        with MappedFile(chunks_path, copy_on_write=True) as mapped, IntegrityCheckedFile(
+            path=chunks_path, write=False, integrity_data=self.cache_config.integrity.get("chunks"), override_fd=mapped
         ) as fd:
             self.chunks = ChunkIndex.read(fd)
         if "d" in self.cache_mode:  # d(isabled)
@@ -575,36 +578,39 @@ def open(self):
         self.rollback()
 
     def close(self):
+        self._close_files()
         if self.cache_config is not None:
             self.cache_config.close()
             self.cache_config = None
 
+    def _close_files(self):
+        if getattr(self, "files", None) is not None:
+            self.files.close()
+            self.files = None
+
     def _read_files(self):
-        self.files = {}
+        self.files = FilesCache(tmp_dir=self.path)
         self._newest_cmtime = None
         logger.debug("Reading files cache ...")
         files_cache_logger.debug("FILES-CACHE-LOAD: starting...")
+        path = os.path.join(self.path, files_cache_name())
         msg = None
         try:
+            # verify the integrity of the whole file before we map it, this only reads the file sequentially.
             with IntegrityCheckedFile(
-                path=os.path.join(self.path, files_cache_name()),
-                write=False,
-                integrity_data=self.cache_config.integrity.get(files_cache_name()),
+                path=path, write=False, integrity_data=self.cache_config.integrity.get(files_cache_name())
             ) as fd:
-                u = msgpack.Unpacker(use_list=True)
-                while True:
-                    data = fd.read(64 * 1024)
-                    if not data:
-                        break
-                    u.feed(data)
-                    try:
-                        for path_hash, item in u:
-                            entry = FileCacheEntry(*item)
-                            # in the end, this takes about 240 Bytes per file
-                            self.files[path_hash] = msgpack.packb(entry._replace(age=entry.age + 1))
-                    except (TypeError, ValueError) as exc:
-                        msg = "The files cache seems invalid. [%s]" % str(exc)
-                        break
+                data = fd.read(1024 * 1024)
+                is_files_cache = FilesCache.is_files_cache(data)
+                if is_files_cache:
+                    while fd.read(1024 * 1024):
+                        pass
+                else:
+                    self._read_legacy_files(data, fd)
+            if is_files_cache:
+                self.files = FilesCache(path, tmp_dir=self.path)
+        except (TypeError, ValueError) as exc:
+            msg = "The files cache seems invalid. [%s]" % str(exc)
         except OSError as exc:
             msg = "The files cache can't be read. [%s]" % str(exc)
         except FileIntegrityError as fie:
@@ -612,9 +618,22 @@ def _read_files(self):
         if msg is not None:
             logger.warning(msg)
             logger.warning("Continuing without files cache - expect lower performance.")
-            self.files = {}
+            self.files.close()
+            self.files = FilesCache(tmp_dir=self.path)
         files_cache_logger.debug("FILES-CACHE-LOAD: finished, %d entries loaded.", len(self.files))
 
+    def _read_legacy_files(self, data, fd):
+        # msgpacked (path_hash, FileCacheEntry) tuples, as written by older bork versions.
+        # this is converted to the current files cache format when the files cache is saved.
+        u = msgpack.Unpacker(use_list=True)
+        while data:
+            u.feed(data)
+            data = fd.read(64 * 1024)
+            for path_hash, item in u:
+                entry = FileCacheEntry(*item)
+                entry = entry._replace(age=entry.age + 1, cmtime=timestamp_to_int(entry.cmtime))
+                self.files.put(path_hash, entry)
+
     def begin_txn(self):
         # Initialize transaction snapshot
         pi = ProgressIndicatorMessage(msgid="cache.begin_transaction")
@@ -624,6 +643,10 @@ def begin_txn(self):
         shutil.copy(os.path.join(self.path, "config"), txn_dir)
         pi.output("Initializing cache transaction: Reading chunks")
         shutil.copy(os.path.join(self.path, "chunks"), txn_dir)
+        try:
+            shutil.copy(os.path.join(self.path, "chunks.archives"), txn_dir)
+        except FileNotFoundError:
+            pass  # written by the first commit
         pi.output("Initializing cache transaction: Reading files")
         try:
             shutil.copy(os.path.join(self.path, files_cache_name()), txn_dir)
@@ -647,31 +670,32 @@ def commit(self):
             ttl = int(os.environ.get("BORK_FILES_CACHE_TTL", 20))
             pi.output("Saving files cache")
             files_cache_logger.debug("FILES-CACHE-SAVE: starting...")
-            with IntegrityCheckedFile(path=os.path.join(self.path, files_cache_name()), write=True) as fd:
-                entry_count = 0
-                for path_hash, item in self.files.items():
-                    # Only keep files seen in this backup that are older than newest cmtime seen in this backup -
-                    # this is to avoid issues with filesystem snapshots and cmtime granularity.
-                    # Also keep files from older backups that have not reached BORK_FILES_CACHE_TTL yet.
-                    entry = FileCacheEntry(*msgpack.unpackb(item))
-                    if (
-                        entry.age == 0
-                        and timestamp_to_int(entry.cmtime) < self._newest_cmtime
-                        or entry.age > 0
-                        and entry.age < ttl
-                    ):
-                        msgpack.pack((path_hash, entry), fd)
-                        entry_count += 1
+            # the current files cache is still mapped, so write the new one next to it.
+            path = os.path.join(self.path, files_cache_name())
+            with IntegrityCheckedFile(path=path + ".tmp", filename=files_cache_name(), write=True) as fd:
+                entry_count = self.files.write(fd, ttl, self._newest_cmtime, tmp_dir=self.path)
+            self.files.close()
+            os.replace(path + ".tmp", path)
             files_cache_logger.debug("FILES-CACHE-KILL: removed all old entries with age >= TTL [%d]", ttl)
             files_cache_logger.debug(
                 "FILES-CACHE-KILL: removed all current entries with newest cmtime %d", self._newest_cmtime
             )
             files_cache_logger.debug("FILES-CACHE-SAVE: finished, %d remaining entries saved.", entry_count)
             self.cache_config.integrity[files_cache_name()] = fd.integrity_data
+            # the entries got their new age when saving them, so do not age them again.
+            self.files = FilesCache(path, aging=False, tmp_dir=self.path)
         pi.output("Saving chunks cache")
-        with IntegrityCheckedFile(path=os.path.join(self.path, "chunks"), write=True) as fd:
+        # the current chunks index is still mapped, so write the new one next to it.
+        path = os.path.join(self.path, "chunks")
+        with IntegrityCheckedFile(path=path + ".tmp", filename="chunks", write=True) as fd:
             self.chunks.write(fd)
+        os.replace(path + ".tmp", path)
         self.cache_config.integrity["chunks"] = fd.integrity_data
+        # remember which archives the chunks index refers to, so the next sync only needs to apply the changes.
+        with IntegrityCheckedFile(path=os.path.join(self.path, "chunks.archives"), write=True) as fd:
+            archive_ids = [info.id for info in self.manifest.archives.list()]
+            fd.write(msgpack.packb({"manifest_id": self.manifest.id, "archive_ids": archive_ids}))
+        self.cache_config.integrity["chunks.archives"] = fd.integrity_data
         pi.output("Saving cache config")
         self.cache_config.save(self.manifest, self.key)
         os.replace(os.path.join(self.path, "txn.active"), os.path.join(self.path, "txn.tmp"))
@@ -681,6 +705,14 @@ def commit(self):
 
     def rollback(self):
         """Roll back partial and aborted transactions"""
+        # the files cache file might get replaced below, so it must not be mapped any more.
+        self._close_files()
+        # Remove a partially written files cache / chunks index (commit was interrupted)
+        for name in files_cache_name(), "chunks":
+            try:
+                safe_unlink(os.path.join(self.path, name) + ".tmp")
+            except FileNotFoundError:
+                pass
         # Remove partial transaction
         if os.path.exists(os.path.join(self.path, "txn.tmp")):
             shutil.rmtree(os.path.join(self.path, "txn.tmp"))
@@ -688,7 +720,13 @@ def rollback(self):
         txn_dir = os.path.join(self.path, "txn.active")
         if os.path.exists(txn_dir):
             shutil.copy(os.path.join(txn_dir, "config"), self.path)
-            shutil.copy(os.path.join(txn_dir, "chunks"), self.path)
+            # the chunks index might still be mapped, so it must be replaced, not overwritten.
+            shutil.copy(os.path.join(txn_dir, "chunks"), os.path.join(self.path, "chunks.tmp"))
+            os.replace(os.path.join(self.path, "chunks.tmp"), os.path.join(self.path, "chunks"))
+            if os.path.exists(os.path.join(txn_dir, "chunks.archives")):
+                shutil.copy(os.path.join(txn_dir, "chunks.archives"), self.path)
+            else:
+                safe_unlink(os.path.join(self.path, "chunks.archives"))
             shutil.copy(os.path.join(txn_dir, discover_files_cache_name(txn_dir)), self.path)
             txn_tmp = os.path.join(self.path, "txn.tmp")
             os.replace(txn_dir, txn_tmp)
@@ -697,6 +735,30 @@ def rollback(self):
         self.txn_active = False
         self._do_open()
 
+    def read_synced_archives(self):
+        """
+        Return the set of archive ids the chunks index was last committed for.
+
+        Return None if that is unknown or can't be trusted.
+        """
+        try:
+            with IntegrityCheckedFile(
+                path=os.path.join(self.path, "chunks.archives"),
+                write=False,
+                integrity_data=self.cache_config.integrity.get("chunks.archives"),
+            ) as fd:
+                synced = msgpack.unpackb(fd.read())
+            manifest_id, archive_ids = synced["manifest_id"], synced["archive_ids"]
+        except FileNotFoundError:
+            return None
+        except (OSError, FileIntegrityError, msgpack.UnpackException, TypeError, ValueError, KeyError) as exc:
+            logger.warning("Ignoring invalid list of synchronized archives: %s", exc)
+            return None
+        if manifest_id != self.cache_config.manifest_id:
+            # the chunks index was modified by a transaction that did not write the list of archives.
+            return None
+        return set(archive_ids)
+
     def sync(self):
         """Re-synchronize chunks cache with repository.
 
@@ -704,8 +766,11 @@ def sync(self):
         needs to fetch infos from repo and build a chunk index once per backup
         archive.
         If out of sync, missing archive indexes get added, outdated indexes
-        get removed and a new master chunks index is built by merging all
-        archive indexes.
+        get removed and the master chunks index is updated by merging the
+        archive indexes of the added archives and subtracting the archive
+        indexes of the removed archives.
+        If the master chunks index can't be updated that way, a new one is
+        built by merging all archive indexes.
         """
         archive_path = os.path.join(self.path, "chunks.archive.d")
         # Instrumentation
@@ -750,12 +815,29 @@ def cleanup_cached_archive(id, cleanup_compact=True):
             except FileNotFoundError:
                 pass
 
-        def fetch_and_build_idx(archive_id, decrypted_repository, chunk_idx):
-            nonlocal processed_item_metadata_bytes
-            nonlocal processed_item_metadata_chunks
-            csize, data = decrypted_repository.get(archive_id)
+        def get_many(decrypted_repository, ids, repository_lock):
+            # yield (id, data) for the given ids.
+            # if a repository_lock is given, the repository is shared with concurrent index builds, then the
+            # data is fetched in batches while holding the lock, so we do not hold the lock while processing it.
+            if repository_lock is None:
+                for id, (csize, data) in zip(ids, decrypted_repository.get_many(ids)):
+                    yield id, data
+                return
+            for i in range(0, len(ids), SYNC_FETCH_BATCH_SIZE):
+                batch = ids[i : i + SYNC_FETCH_BATCH_SIZE]
+                with repository_lock:
+                    results = list(decrypted_repository.get_many(batch))
+                for id, (csize, data) in zip(batch, results):
+                    yield id, data
+
+        def fetch_and_build_idx(archive_id, decrypted_repository, chunk_idx, repository_lock=None):
+            """Build the chunk index of an archive, return the processed item metadata (bytes, chunks)."""
+            metadata_bytes = metadata_chunks = 0
+            with repository_lock or nullcontext():
+                # the key is shared with concurrent index builds also.
+                csize, data = decrypted_repository.get(archive_id)
+                archive, _ = self.key.unpack_and_verify_archive(data)
             chunk_idx.add(archive_id, 1, len(data))
-            archive, _ = self.key.unpack_and_verify_archive(data)
             archive = ArchiveItem(internal_dict=archive)
             if archive.version not in (1, 2):  # legacy
                 raise Exception("Unknown archive metadata version")
@@ -763,18 +845,17 @@ def fetch_and_build_idx(archive_id, decrypted_repository, chunk_idx):
                 items = archive.items
             elif archive.version == 2:
                 items = []
-                for chunk_id, (csize, data) in zip(archive.item_ptrs, decrypted_repository.get_many(archive.item_ptrs)):
+                for chunk_id, data in get_many(decrypted_repository, archive.item_ptrs, repository_lock):
                     chunk_idx.add(chunk_id, 1, len(data))
                     ids = msgpack.unpackb(data)
                     items.extend(ids)
             sync = CacheSynchronizer(chunk_idx)
-            for item_id, (csize, data) in zip(items, decrypted_repository.get_many(items)):
+            for item_id, data in get_many(decrypted_repository, items, repository_lock):
                 chunk_idx.add(item_id, 1, len(data))
-                processed_item_metadata_bytes += len(data)
-                processed_item_metadata_chunks += 1
+                metadata_bytes += len(data)
+                metadata_chunks += 1
                 sync.feed(data)
-            if self.do_cache:
-                write_archive_index(archive_id, chunk_idx)
+            return metadata_bytes, metadata_chunks
 
         def write_archive_index(archive_id, chunk_idx):
             nonlocal compact_chunks_archive_saved_space
@@ -832,6 +913,99 @@ def get_archive_ids_to_names(archive_ids):
             assert len(archive_names) == len(archive_ids)
             return archive_names
 
+        def build_archive_index(archive_id, repository_lock=None):
+            archive_chunk_idx = ChunkIndex()
+            metadata = fetch_and_build_idx(archive_id, decrypted_repository, archive_chunk_idx, repository_lock)
+            return archive_chunk_idx, metadata
+
+        def built_archive_index(archive_id, archive_name, archive_chunk_idx, metadata, pi):
+            nonlocal processed_item_metadata_bytes
+            nonlocal processed_item_metadata_chunks
+            # the progress is shown when an archive index is done, workers might still be busy with later archives.
+            pi.show(info=[remove_surrogates(archive_name)])  # legacy. bork2 always has pure unicode arch names.
+            processed_item_metadata_bytes += metadata[0]
+            processed_item_metadata_chunks += metadata[1]
+            if self.do_cache:
+                write_archive_index(archive_id, archive_chunk_idx)
+            return archive_chunk_idx
+
+        def iter_archive_indexes(archive_ids_to_names, cached_ids, pi):
+            # yield the archive chunk indexes of the given archives (not necessarily in the given order).
+            # archive indexes that are not cached get built, using sync_workers threads.
+            workers = self.sync_workers
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cache-sync") if workers > 1 else None
+            repository_lock = threading.Lock()
+            pending = deque()  # (archive_id, archive_name, future)
+            try:
+                for archive_id, archive_name in archive_ids_to_names.items():
+                    if archive_id in cached_ids:
+                        archive_chunk_idx = read_archive_index(archive_id, archive_name)
+                        if archive_chunk_idx is not None:
+                            pi.show(info=[remove_surrogates(archive_name)])
+                            yield archive_chunk_idx
+                            continue
+                        cached_ids.remove(archive_id)
+                    logger.info("Fetching and building archive index for %s.", archive_name)
+                    if executor is None:
+                        yield built_archive_index(archive_id, archive_name, *build_archive_index(archive_id), pi)
+                        continue
+                    future = executor.submit(build_archive_index, archive_id, repository_lock)
+                    pending.append((archive_id, archive_name, future))
+                    while len(pending) > workers or pending and pending[0][2].done():
+                        archive_id, archive_name, future = pending.popleft()
+                        yield built_archive_index(archive_id, archive_name, *future.result(), pi)
+                while pending:
+                    archive_id, archive_name, future = pending.popleft()
+                    yield built_archive_index(archive_id, archive_name, *future.result(), pi)
+            finally:
+                if executor is not None:
+                    for archive_id, archive_name, future in pending:
+                        future.cancel()
+                    executor.shutdown(wait=True)
+
+        def update_master_idx(chunk_idx, synced_ids):
+            # apply the archive changes since the last sync to chunk_idx, return whether that was possible.
+            # if not, chunk_idx might have been partially updated and must be rebuilt.
+            if not self.do_cache or synced_ids is None:
+                return False
+            logger.debug("Updating chunks index...")
+            cached_ids = cached_archives()
+            archive_ids = repo_archives()
+            added_ids = archive_ids - synced_ids
+            removed_ids = synced_ids - archive_ids
+            if not removed_ids <= cached_ids:
+                logger.info("Archive chunk indexes of removed archives are not cached, rebuilding chunks index.")
+                return False
+            logger.info(
+                "Updating chunks index: %d archives added, %d archives removed.", len(added_ids), len(removed_ids)
+            )
+            for archive_id in removed_ids:
+                archive_chunk_idx = read_archive_index(archive_id, bin_to_hex(archive_id))
+                if archive_chunk_idx is None:
+                    return False
+                logger.debug("Subtracting from master chunks index.")
+                try:
+                    chunk_idx.subtract(archive_chunk_idx)
+                except ValueError as exc:
+                    logger.warning(
+                        "Chunks index is inconsistent with the archive chunk indexes, rebuilding it: %s", exc
+                    )
+                    return False
+            cleanup_outdated(cached_ids - archive_ids)
+            if added_ids:
+                pi = ProgressIndicatorPercent(
+                    total=len(added_ids),
+                    step=0.1,
+                    msg="%3.0f%% Syncing chunks index. Processing archive %s.",
+                    msgid="cache.sync",
+                )
+                for archive_chunk_idx in iter_archive_indexes(get_archive_ids_to_names(added_ids), cached_ids, pi):
+                    logger.debug("Merging into master chunks index.")
+                    chunk_idx.merge(archive_chunk_idx)
+                pi.finish()
+            logger.debug("Chunks index update done.")
+            return True
+
         def create_master_idx(chunk_idx):
             logger.debug("Synchronizing chunks index...")
             cached_ids = cached_archives()
@@ -849,7 +1023,7 @@ def create_master_idx(chunk_idx):
             # due to hash table "resonance".
             master_index_capacity = len(self.repository)
             if archive_ids:
-                chunk_idx = None if not self.do_cache else ChunkIndex(usable=master_index_capacity)
+                chunk_idx = ChunkIndex(usable=master_index_capacity)
                 pi = ProgressIndicatorPercent(
                     total=len(archive_ids),
                     step=0.1,
@@ -857,25 +1031,15 @@ def create_master_idx(chunk_idx):
                     msgid="cache.sync",
                 )
                 archive_ids_to_names = get_archive_ids_to_names(archive_ids)
-                for archive_id, archive_name in archive_ids_to_names.items():
-                    pi.show(info=[remove_surrogates(archive_name)])  # legacy. bork2 always has pure unicode arch names.
-                    if self.do_cache:
-                        if archive_id in cached_ids:
-                            archive_chunk_idx = read_archive_index(archive_id, archive_name)
-                            if archive_chunk_idx is None:
-                                cached_ids.remove(archive_id)
-                        if archive_id not in cached_ids:
-                            # Do not make this an else branch; the FileIntegrityError exception handler
-                            # above can remove *archive_id* from *cached_ids*.
-                            logger.info("Fetching and building archive index for %s.", archive_name)
-                            archive_chunk_idx = ChunkIndex()
-                            fetch_and_build_idx(archive_id, decrypted_repository, archive_chunk_idx)
+                if self.do_cache or self.sync_workers > 1:
+                    for archive_chunk_idx in iter_archive_indexes(archive_ids_to_names, cached_ids, pi):
                         logger.debug("Merging into master chunks index.")
                         chunk_idx.merge(archive_chunk_idx)
-                    else:
-                        chunk_idx = chunk_idx or ChunkIndex(usable=master_index_capacity)
+                else:
+                    for archive_id, archive_name in archive_ids_to_names.items():
                         logger.info("Fetching archive index for %s.", archive_name)
-                        fetch_and_build_idx(archive_id, decrypted_repository, chunk_idx)
+                        metadata = fetch_and_build_idx(archive_id, decrypted_repository, chunk_idx)
+                        built_archive_index(archive_id, archive_name, chunk_idx, metadata, pi)
                 pi.finish()
                 logger.debug(
                     "Chunks index sync: processed %s (%d chunks) of metadata.",
@@ -894,13 +1058,20 @@ def create_master_idx(chunk_idx):
         # Since the sync will attempt to read archives, check compatibility with Manifest.Operation.READ.
         self.manifest.check_repository_compatibility((Manifest.Operation.READ,))
 
+        synced_ids = self.read_synced_archives()
         self.begin_txn()
         with cache_if_remote(self.repository, decrypted_cache=self.repo_objs) as decrypted_repository:
             # TEMPORARY HACK:
             # to avoid archive index caching, create a FILE named ~/.cache/bork/REPOID/chunks.archive.d -
             # this is only recommended if you have a fast, low latency connection to your repo (e.g. if repo is local).
             self.do_cache = os.path.isdir(archive_path)
-            self.chunks = create_master_idx(self.chunks)
+            try:
+                self.sync_workers = max(int(os.environ.get("BORK_CACHE_SYNC_WORKERS", 1)), 1)
+            except ValueError:
+                logger.warning("BORK_CACHE_SYNC_WORKERS must be an integer, using 1 worker.")
+                self.sync_workers = 1
+            if not update_master_idx(self.chunks, synced_ids):
+                self.chunks = create_master_idx(self.chunks)
 
     def check_cache_compatibility(self):
         my_features = Manifest.SUPPORTED_REPO_FEATURES
@@ -972,6 +1143,30 @@ def chunk_incref(self, id, stats, size=None):
         stats.update(_size, False)
         return ChunkListEntry(id, _size)
 
+    def seen_chunks(self, ids, sizes=None):
+        """Like seen_chunk() for each of the chunks *ids* (and *sizes*), return an array of the refcounts."""
+        refcounts, stored_sizes = self.chunks.get_many(b"".join(ids))
+        if sizes is not None and stored_sizes != array("I", sizes):
+            for id, refcount, size, stored_size in zip(ids, refcounts, sizes, stored_sizes):
+                if refcount and size != stored_size:
+                    # see seen_chunk
+                    raise Exception(
+                        "chunk has same id [%r], but different size (stored: %d new: %d)!" % (id, stored_size, size)
+                    )
+        return refcounts
+
+    def chunks_incref(self, ids, stats, sizes=None):
+        """
+        Like chunk_incref() for each of the chunks *ids*, return a list of their ChunkListEntry.
+
+        Raises KeyError without changing any refcount if one of the chunks is not in the index.
+        """
+        if not self.txn_active:
+            self.begin_txn()
+        sizes = self.chunks.incref_many(b"".join(ids))
+        stats.update(sum(sizes), False)
+        return [ChunkListEntry(id, size) for id, size in zip(ids, sizes)]
+
     def chunk_decref(self, id, stats, wait=True):
         if not self.txn_active:
             self.begin_txn()
@@ -983,6 +1178,21 @@ def chunk_decref(self, id, stats, wait=True):
         else:
             stats.update(-size, False)
 
+    def chunks_decref(self, ids, stats, wait=True):
+        """Like chunk_decref() for each of the chunks *ids*, but with one index lookup for all of them."""
+        if not self.txn_active:
+            self.begin_txn()
+        refcounts, sizes = self.chunks.decref_many(b"".join(ids))
+        unique_size = 0
+        if 0 in refcounts:
+            for id, count, size in zip(ids, refcounts, sizes):
+                if count == 0:
+                    del self.chunks[id]
+                    self.repository.delete(id, wait=wait)
+                    unique_size += size
+        stats.update(-(sum(sizes) - unique_size), False)
+        stats.update(-unique_size, True)
+
     def file_known_and_unchanged(self, hashed_path, path_hash, st):
         """
         Check if we know the file that has this path_hash (know == it is in our files cache) and
@@ -1011,17 +1221,16 @@ def file_known_and_unchanged(self, hashed_path, path_hash, st):
             files_cache_logger.debug("UNKNOWN: no file metadata in cache for: %r", hashed_path)
             return False, None
         # we know the file!
-        entry = FileCacheEntry(*msgpack.unpackb(entry))
         if "s" in cache_mode and entry.size != st.st_size:
             files_cache_logger.debug("KNOWN-CHANGED: file size has changed: %r", hashed_path)
             return True, None
         if "i" in cache_mode and entry.inode != st.st_ino:
             files_cache_logger.debug("KNOWN-CHANGED: file inode number has changed: %r", hashed_path)
             return True, None
-        if "c" in cache_mode and timestamp_to_int(entry.cmtime) != st.st_ctime_ns:
+        if "c" in cache_mode and entry.cmtime != st.st_ctime_ns:
             files_cache_logger.debug("KNOWN-CHANGED: file ctime has changed: %r", hashed_path)
             return True, None
-        elif "m" in cache_mode and timestamp_to_int(entry.cmtime) != st.st_mtime_ns:
+        elif "m" in cache_mode and entry.cmtime != st.st_mtime_ns:
             files_cache_logger.debug("KNOWN-CHANGED: file mtime has changed: %r", hashed_path)
             return True, None
         # we ignored the inode number in the comparison above or it is still same.
@@ -1032,7 +1241,7 @@ def file_known_and_unchanged(self, hashed_path, path_hash, st):
         # number comparison in a future backup run (and avoid chunking everything
         # again at that time), we need to update the inode number in the cache with what
         # we see in the filesystem.
-        self.files[path_hash] = msgpack.packb(entry._replace(inode=st.st_ino, age=0))
+        self.files.touch(path_hash, st.st_ino)
         return True, entry.chunk_ids
 
     def memorize_file(self, hashed_path, path_hash, st, ids):
@@ -1052,10 +1261,8 @@ def memorize_file(self, hashed_path, path_hash, st, ids):
         else:  # neither 'c' nor 'm' in cache_mode, avoid UnboundLocalError
             cmtime_type = "ctime"
             cmtime_ns = safe_ns(st.st_ctime_ns)
-        entry = FileCacheEntry(
-            age=0, inode=st.st_ino, size=st.st_size, cmtime=int_to_timestamp(cmtime_ns), chunk_ids=ids
-        )
-        self.files[path_hash] = msgpack.packb(entry)
+        entry = FileCacheEntry(age=0, inode=st.st_ino, size=st.st_size, cmtime=cmtime_ns, chunk_ids=ids)
+        self.files.put(path_hash, entry)
         self._newest_cmtime = max(self._newest_cmtime or 0, cmtime_ns)
         files_cache_logger.debug(
             "FILES-CACHE-UPDATE: put %r [has %s] <- %r",
@@ -1113,7 +1320,7 @@ def file_known_and_unchanged(self, hashed_path, path_hash, st):
     def memorize_file(self, hashed_path, path_hash, st, ids):
         pass
 
-    def add_chunk(self, id, meta, data, *, stats, wait=True, compress=True, size=None):
+    def add_chunk(self, id, meta, data, *, stats, wait=True, compress=True, size=None, ctype=None, clevel=None):
         if not self._txn_active:
             self.begin_txn()
         if size is None and compress:
@@ -1123,7 +1330,7 @@ def add_chunk(self, id, meta, data, *, stats, wait=True, compress=True, size=Non
         refcount = self.seen_chunk(id, size)
         if refcount:
             return self.chunk_incref(id, stats, size=size)
-        cdata = self.repo_objs.format(id, meta, data, compress=compress)
+        cdata = self.repo_objs.format(id, meta, data, compress=compress, size=size, ctype=ctype, clevel=clevel)
         self.repository.put(id, cdata, wait=wait)
         self.chunks.add(id, 1, size)
         stats.update(size, not refcount)
@@ -1151,6 +1358,33 @@ def chunk_incref(self, id, stats, size=None):
         stats.update(size, False)
         return ChunkListEntry(id, size)
 
+    def seen_chunks(self, ids, sizes=None):
+        """Like seen_chunk() for each of the chunks *ids* (and *sizes*), return an array of the refcounts."""
+        if not self._txn_active:
+            self.begin_txn()
+        refcounts, stored_sizes = self.chunks.get_many(b"".join(ids))
+        if sizes is not None and 0 in stored_sizes:
+            for id, refcount, size, stored_size in zip(ids, refcounts, sizes, stored_sizes):
+                if refcount and size and not stored_size:
+                    # see seen_chunk
+                    self.chunks[id] = ChunkIndexEntry(refcount, size)
+        return refcounts
+
+    def chunks_incref(self, ids, stats, sizes=None):
+        """
+        Like chunk_incref() for each of the chunks *ids* (and *sizes*), return a list of their ChunkListEntry.
+
+        Raises KeyError without changing any refcount if one of the chunks is not in the index.
+        """
+        if not self._txn_active:
+            self.begin_txn()
+        stored_sizes = self.chunks.incref_many(b"".join(ids))
+        # see chunk_incref
+        sizes = [_size or size for _size, size in zip(stored_sizes, sizes or [0] * len(ids))]
+        assert all(sizes)
+        stats.update(sum(sizes), False)
+        return [ChunkListEntry(id, size) for id, size in zip(ids, sizes)]
+
     def chunk_decref(self, id, stats, wait=True):
         if not self._txn_active:
             self.begin_txn()
@@ -1162,6 +1396,21 @@ def chunk_decref(self, id, stats, wait=True):
         else:
             stats.update(-size, False)
 
+    def chunks_decref(self, ids, stats, wait=True):
+        """Like chunk_decref() for each of the chunks *ids*, but with one index lookup for all of them."""
+        if not self._txn_active:
+            self.begin_txn()
+        refcounts, sizes = self.chunks.decref_many(b"".join(ids))
+        unique_size = 0
+        if 0 in refcounts:
+            for id, count, size in zip(ids, refcounts, sizes):
+                if count == 0:
+                    del self.chunks[id]
+                    self.repository.delete(id, wait=wait)
+                    unique_size += size
+        stats.update(-(sum(sizes) - unique_size), False)
+        stats.update(-unique_size, True)
+
     def commit(self):
         if not self._txn_active:
             return
@@ -8,7 +8,7 @@ from cpython.buffer cimport PyBUF_SIMPLE, PyObject_GetBuffer, PyBuffer_Release
 from cpython.bytes cimport PyBytes_FromStringAndSize
 
 
-cdef extern from "xxhash.h":
+cdef extern from "xxhash.h" nogil:
     ctypedef struct XXH64_canonical_t:
         char digest[8]
 
@@ -71,8 +71,15 @@ cdef class StreamingXXH64:
 
     def update(self, data):
         cdef Py_buffer data_buf = ro_buffer(data)
+        cdef XXH_errorcode rc
         try:
-            if XXH64_update(self.state, data_buf.buf, data_buf.len) != XXH_OK:
+            if data_buf.len >= 4096:
+                # bigger updates release the GIL, so e.g. segment files can be verified by multiple threads.
+                with nogil:
+                    rc = XXH64_update(self.state, data_buf.buf, data_buf.len)
+            else:
+                rc = XXH64_update(self.state, data_buf.buf, data_buf.len)
+            if rc != XXH_OK:
                 raise Exception('XXH64_update failed')
         finally:
             PyBuffer_Release(&data_buf)
@@ -285,6 +285,10 @@ cdef class Chunker:
     window contents. If the last n bits of the rolling hash are 0, a chunk is cut.
     Additionally it obeys some more criteria, like a minimum and maximum chunk size.
     It also uses a per-repo random seed to avoid some chunk length fingerprinting attacks.
+
+    The chunk data is a read-only memoryview of the chunker's read buffer (no copy is made).
+    The data of a chunk stays valid while the chunk is in use, also after getting the next
+    chunks: the chunker then continues reading into another buffer.
     """
     cdef _Chunker *chunker
     cdef readonly float chunking_time
@@ -297,6 +301,8 @@ cdef class Chunker:
         assert hash_window_size + min_size + 1 <= max_size, "too small max_size"
         hash_mask = (1 << hash_mask_bits) - 1
         self.chunker = chunker_init(hash_window_size, hash_mask, min_size, max_size, seed & 0xffffffff)
+        if self.chunker == NULL:
+            raise MemoryError
         self.chunking_time = 0.0
 
 
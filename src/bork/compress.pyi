@@ -1,4 +1,4 @@
-from typing import Any, Type, Dict, Tuple
+from typing import Any, Type, Dict, List, Tuple
 
 API_VERSION: str
 
@@ -55,9 +55,20 @@ class LZMA(DecidingCompressor):
     def __init__(self, level: int = ..., **kwargs) -> None: ...
     level: int
 
+ZSTD_DICT_MAGIC: bytes
+
+class ZstdDict:
+    def __init__(self, data: bytes) -> None: ...
+    data: bytes
+    id: int
+
+def add_zstd_dict(data: bytes) -> ZstdDict: ...
+def train_zstd_dict(samples: List[bytes], size: int) -> bytes: ...
+
 class ZSTD(DecidingCompressor):
-    def __init__(self, level: int = ..., **kwargs) -> None: ...
+    def __init__(self, level: int = ..., zstd_dict: ZstdDict = ..., **kwargs) -> None: ...
     level: int
+    zstd_dict: ZstdDict
 
 LZ4_COMPRESSOR: Type[LZ4]
 NONE_COMPRESSOR: Type[CNONE]
@@ -18,6 +18,7 @@ decompressor.
 from argparse import ArgumentTypeError
 import random
 from struct import Struct
+import threading
 import zlib
 
 try:
@@ -26,8 +27,11 @@ except ImportError:
     lzma = None
 
 
+from cpython.buffer cimport PyBUF_SIMPLE, PyObject_GetBuffer, PyBuffer_Release
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
 from .constants import MAX_DATA_SIZE
-from .helpers import Buffer, DecompressionError
+from .helpers import Buffer, DecompressionError, DictionaryMissingError
 
 API_VERSION = '1.2_02'
 
@@ -46,9 +50,54 @@ cdef extern from "zstd.h":
     unsigned long long ZSTD_getFrameContentSize(const void *src, size_t srcSize) nogil
     unsigned ZSTD_isError(size_t code) nogil
     const char* ZSTD_getErrorName(size_t code) nogil
-
-
-buffer = Buffer(bytearray, size=0)
+    ctypedef struct ZSTD_CCtx:
+        pass
+    ctypedef struct ZSTD_DCtx:
+        pass
+    ctypedef struct ZSTD_CDict:
+        pass
+    ctypedef struct ZSTD_DDict:
+        pass
+    ZSTD_CCtx* ZSTD_createCCtx() nogil
+    size_t ZSTD_freeCCtx(ZSTD_CCtx* cctx) nogil
+    ZSTD_DCtx* ZSTD_createDCtx() nogil
+    size_t ZSTD_freeDCtx(ZSTD_DCtx* dctx) nogil
+    ZSTD_CDict* ZSTD_createCDict(const void* dictBuffer, size_t dictSize, int compressionLevel) nogil
+    size_t ZSTD_freeCDict(ZSTD_CDict* CDict) nogil
+    ZSTD_DDict* ZSTD_createDDict(const void* dictBuffer, size_t dictSize) nogil
+    size_t ZSTD_freeDDict(ZSTD_DDict* ddict) nogil
+    size_t ZSTD_compress_usingCDict(ZSTD_CCtx* cctx, void* dst, size_t dstCapacity,
+                                    const void* src, size_t srcSize, const ZSTD_CDict* cdict) nogil
+    size_t ZSTD_decompress_usingDDict(ZSTD_DCtx* dctx, void* dst, size_t dstCapacity,
+                                      const void* src, size_t srcSize, const ZSTD_DDict* ddict) nogil
+    unsigned ZSTD_getDictID_fromDict(const void* dict, size_t dictSize) nogil
+    unsigned ZSTD_getDictID_fromFrame(const void* src, size_t srcSize) nogil
+
+
+cdef extern from "zdict.h":
+    size_t ZDICT_trainFromBuffer(void* dictBuffer, size_t dictBufferCapacity, const void* samplesBuffer,
+                                 const size_t* samplesSizes, unsigned nbSamples) nogil
+    unsigned ZDICT_isError(size_t errorCode) nogil
+    const char* ZDICT_getErrorName(size_t errorCode) nogil
+
+
+# the output buffers are per thread, so compressors can be used from multiple threads concurrently
+# (the lz4 / zstd work is done without holding the GIL, see the "with nogil" blocks below).
+_thread_local = threading.local()
+
+
+cdef Py_buffer ro_buffer(object data) except *:
+    cdef Py_buffer view
+    PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+    return view
+
+
+def _get_buffer(size):
+    try:
+        buffer = _thread_local.buffer
+    except AttributeError:
+        buffer = _thread_local.buffer = Buffer(bytearray, size=0)
+    return buffer.get(size)
 
 
 cdef class CompressorBase:
@@ -217,17 +266,20 @@ class LZ4(DecidingCompressor):
 
         *lz4_data* is the LZ4 result if *compressor* is LZ4 as well, otherwise it is None.
         """
-        if not isinstance(idata, bytes):
-            idata = bytes(idata)  # code below does not work with memoryview
-        cdef int isize = len(idata)
+        # idata might be a memoryview (e.g. of the chunker's buffer), it is used without copying it.
+        cdef Py_buffer ibuf = ro_buffer(idata)
+        cdef int isize = ibuf.len
         cdef int osize
-        cdef char *source = idata
+        cdef const char *source = <const char *> ibuf.buf
         cdef char *dest
-        osize = LZ4_compressBound(isize)
-        buf = buffer.get(osize)
-        dest = <char *> buf
-        with nogil:
-            osize = LZ4_compress_default(source, dest, isize, osize)
+        try:
+            osize = LZ4_compressBound(isize)
+            buf = _get_buffer(osize)
+            dest = <char *> buf
+            with nogil:
+                osize = LZ4_compress_default(source, dest, isize, osize)
+        finally:
+            PyBuffer_Release(&ibuf)
         if not osize:
             raise Exception('lz4 compress failed')
         # only compress if the result actually is smaller
@@ -250,7 +302,7 @@ class LZ4(DecidingCompressor):
         osize = max(int(1.1 * 2**23), isize * 3)
         while True:
             try:
-                buf = buffer.get(osize)
+                buf = _get_buffer(osize)
             except MemoryError:
                 raise DecompressionError('MemoryError')
             dest = <char *> buf
@@ -304,17 +356,107 @@ class LZMA(DecidingCompressor):
             raise DecompressionError(str(e)) from None
 
 
+# zstd dictionaries (as created by train_zstd_dict) start with these magic bytes
+ZSTD_DICT_MAGIC = b'\x37\xa4\x30\xec'
+
+
+cdef class ZstdDict:
+    """
+    zstd dictionary, used by ZSTD for compression if given and found by its id for decompression.
+
+    The digested dictionaries (per compression level for compression) are created once and
+    then reused for all chunks.
+    """
+    cdef readonly bytes data
+    cdef readonly unsigned id
+    cdef ZSTD_DDict *ddict
+    cdef ZSTD_CDict *cdicts[23]  # by compression level 1..22
+
+    def __cinit__(self, data):
+        self.data = bytes(data)
+        cdef const char *source = self.data
+        self.id = ZSTD_getDictID_fromDict(source, len(self.data))
+        if self.id == 0:
+            raise ValueError('not a zstd dictionary')
+        self.ddict = ZSTD_createDDict(source, len(self.data))
+        if self.ddict == NULL:
+            raise MemoryError('zstd: creating the decompression dictionary failed')
+
+    def __dealloc__(self):
+        cdef int level
+        for level in range(23):
+            if self.cdicts[level] != NULL:
+                ZSTD_freeCDict(self.cdicts[level])
+        if self.ddict != NULL:
+            ZSTD_freeDDict(self.ddict)
+
+    cdef ZSTD_CDict *get_cdict(self, int level) except NULL:
+        assert 1 <= level <= 22
+        cdef const char *source = self.data
+        if self.cdicts[level] == NULL:
+            self.cdicts[level] = ZSTD_createCDict(source, len(self.data), level)
+            if self.cdicts[level] == NULL:
+                raise MemoryError('zstd: creating the compression dictionary failed')
+        return self.cdicts[level]
+
+
+# the zstd dictionaries known for decompression, by dictionary id, see add_zstd_dict
+_zstd_dicts = {}
+
+
+def add_zstd_dict(data):
+    """
+    Return a ZstdDict for the zstd dictionary *data*.
+
+    The dictionary is also registered, so frames compressed using it can be decompressed.
+    """
+    zstd_dict = ZstdDict(data)
+    _zstd_dicts[zstd_dict.id] = zstd_dict
+    return zstd_dict
+
+
+def train_zstd_dict(samples, size_t size):
+    """
+    Return a zstd dictionary of at most *size* bytes, trained from *samples* (a list of bytes).
+
+    Raises ValueError if the training failed (e.g. not enough samples).
+    """
+    samples_data = b''.join(samples)
+    cdef const char *source = samples_data
+    cdef unsigned count = len(samples)
+    cdef size_t rsize
+    cdef char *dest
+    cdef size_t *sizes = <size_t *> PyMem_Malloc(max(count, 1) * sizeof(size_t))
+    if sizes == NULL:
+        raise MemoryError
+    try:
+        for i, sample in enumerate(samples):
+            sizes[i] = len(sample)
+        buf = _get_buffer(size)
+        dest = <char *> buf
+        with nogil:
+            rsize = ZDICT_trainFromBuffer(dest, size, source, sizes, count)
+        if ZDICT_isError(rsize):
+            raise ValueError('zstd dictionary training failed: %s' % ZDICT_getErrorName(rsize).decode())
+        return dest[:rsize]
+    finally:
+        PyMem_Free(sizes)
+
+
 class ZSTD(DecidingCompressor):
-    """zstd compression / decompression (pypi: zstandard, gh: python-zstandard)"""
-    # This is a NOT THREAD SAFE implementation.
-    # Only ONE python context must be created at a time.
-    # It should work flawlessly as long as bork will call ONLY ONE compression job at time.
+    """
+    zstd compression / decompression (pypi: zstandard, gh: python-zstandard)
+
+    If *zstd_dict* (a ZstdDict) is given, it is used for compression. For decompression,
+    the dictionary a frame was compressed with must be registered, see add_zstd_dict.
+    """
     ID = 0x03
     name = 'zstd'
 
-    def __init__(self, level=3, legacy_mode=False, **kwargs):
+    def __init__(self, level=3, legacy_mode=False, zstd_dict=None, **kwargs):
         super().__init__(level=level, legacy_mode=legacy_mode, **kwargs)
         self.level = level
+        self.zstd_dict = zstd_dict
 
     def _decide(self, meta, idata):
         """
@@ -322,18 +464,33 @@ class ZSTD(DecidingCompressor):
 
         *zstd_data* is the ZSTD result if *compressor* is ZSTD as well, otherwise it is None.
         """
-        if not isinstance(idata, bytes):
-            idata = bytes(idata)  # code below does not work with memoryview
-        cdef int isize = len(idata)
         cdef int osize
-        cdef char *source = idata
         cdef char *dest
         cdef int level = self.level
-        osize = ZSTD_compressBound(isize)
-        buf = buffer.get(osize)
-        dest = <char *> buf
-        with nogil:
-            osize = ZSTD_compress(dest, osize, source, isize, level)
+        cdef ZSTD_CDict *cdict = NULL
+        cdef ZSTD_CCtx *cctx = NULL
+        # idata might be a memoryview (e.g. of the chunker's buffer), it is used without copying it.
+        cdef Py_buffer ibuf = ro_buffer(idata)
+        cdef int isize = ibuf.len
+        cdef const char *source = <const char *> ibuf.buf
+        try:
+            if self.zstd_dict is not None:
+                cdict = (<ZstdDict> self.zstd_dict).get_cdict(level)
+                cctx = ZSTD_createCCtx()
+                if cctx == NULL:
+                    raise MemoryError('zstd: creating the compression context failed')
+            osize = ZSTD_compressBound(isize)
+            buf = _get_buffer(osize)
+            dest = <char *> buf
+            with nogil:
+                if cctx == NULL:
+                    osize = ZSTD_compress(dest, osize, source, isize, level)
+                else:
+                    osize = ZSTD_compress_usingCDict(cctx, dest, osize, source, isize, cdict)
+        finally:
+            PyBuffer_Release(&ibuf)
+            if cctx != NULL:
+                ZSTD_freeCCtx(cctx)
         if ZSTD_isError(osize):
             raise Exception('zstd compress failed: %s' % ZSTD_getErrorName(osize))
         # only compress if the result actually is smaller
@@ -351,18 +508,36 @@ class ZSTD(DecidingCompressor):
         cdef unsigned long long rsize
         cdef char *source = idata
         cdef char *dest
+        cdef unsigned dict_id
+        cdef ZSTD_DDict *ddict = NULL
+        cdef ZSTD_DCtx *dctx = NULL
         osize = ZSTD_getFrameContentSize(source, isize)
         if osize == ZSTD_CONTENTSIZE_ERROR:
             raise DecompressionError('zstd get size failed: data was not compressed by zstd')
         if osize == ZSTD_CONTENTSIZE_UNKNOWN:
             raise DecompressionError('zstd get size failed: original size unknown')
+        dict_id = ZSTD_getDictID_fromFrame(source, isize)
+        if dict_id != 0:
+            zstd_dict = _zstd_dicts.get(dict_id)
+            if zstd_dict is None:
+                raise DictionaryMissingError(dict_id)
+            ddict = (<ZstdDict> zstd_dict).ddict
+            dctx = ZSTD_createDCtx()
+            if dctx == NULL:
+                raise DecompressionError('MemoryError')
         try:
-            buf = buffer.get(osize)
+            buf = _get_buffer(osize)
         except MemoryError:
+            if dctx != NULL:
+                ZSTD_freeDCtx(dctx)
             raise DecompressionError('MemoryError')
         dest = <char *> buf
         with nogil:
-            rsize = ZSTD_decompress(dest, osize, source, isize)
+            if dctx == NULL:
+                rsize = ZSTD_decompress(dest, osize, source, isize)
+            else:
+                rsize = ZSTD_decompress_usingDDict(dctx, dest, osize, source, isize, ddict)
+                ZSTD_freeDCtx(dctx)
         if ZSTD_isError(rsize):
             raise DecompressionError('zstd decompress failed: %s' % ZSTD_getErrorName(rsize))
         if rsize != osize:
@@ -444,10 +619,26 @@ class ZLIB_legacy(CompressorBase):
             raise DecompressionError(str(e)) from None
 
 
+class CompressionMemo:
+    """
+    Remembers whether the chunks of one file compress, see Auto.compress.
+
+    The compression of the chunks of a file might happen in multiple threads concurrently,
+    the memo does not need to be exact, it is just a heuristic.
+    """
+
+    def __init__(self):
+        self.incompressible = 0  # number of consecutive incompressible chunks
+        self.skipped = 0  # number of chunks stored uncompressed without trying since the last check
+
+
 class Auto(CompressorBase):
     """
     Meta-Compressor that decides which compression to use based on LZ4's ratio.
 
+    For big chunks, LZ4 is first only applied to some samples of the chunk, so that
+    incompressible data is detected without compressing all of it.
+
     As a meta-Compressor the actual compression is deferred to other Compressors,
     therefore this Compressor has no ID, no detect() and no decompress().
     """
@@ -455,10 +646,25 @@ class Auto(CompressorBase):
     ID = None
     name = 'auto'
 
+    # chunks of at least SAMPLE_MIN_SIZE bytes are sampled by SAMPLE_COUNT blocks of SAMPLE_SIZE bytes
+    SAMPLE_MIN_SIZE = 128 * 1024
+    SAMPLE_COUNT = 8
+    SAMPLE_SIZE = 4096
+    # after MEMO_CHUNKS incompressible chunks of a file, only every MEMO_CHECK-th chunk is checked
+    MEMO_CHUNKS = 4
+    MEMO_CHECK = 16
+
     def __init__(self, compressor):
         super().__init__()
         self.compressor = compressor
 
+    def _sample_ratio(self, data):
+        """Return the LZ4 compression ratio of some samples of *data*."""
+        step = (len(data) - self.SAMPLE_SIZE) // (self.SAMPLE_COUNT - 1)
+        sample = b''.join(data[i * step:i * step + self.SAMPLE_SIZE] for i in range(self.SAMPLE_COUNT))
+        meta, compressed_data = LZ4_COMPRESSOR.compress({}, sample)
+        return len(compressed_data) / len(sample)
+
     def _decide(self, meta, data):
         """
         Decides what to do with *data*. Returns (compressor, compressed_data).
@@ -482,6 +688,9 @@ class Auto(CompressorBase):
         Note: While it makes no sense, the expensive compressor may well be set
         to the LZ4 compressor.
         """
+        if len(data) >= self.SAMPLE_MIN_SIZE and self._sample_ratio(data) >= 0.97:
+            # the samples do not compress, do not try to compress all the data.
+            return NONE_COMPRESSOR, NONE_COMPRESSOR.compress(meta, data)
         compressor, (meta, compressed_data) = LZ4_COMPRESSOR.decide_compress(meta, data)
         # compressed_data includes the compression type header, while data does not yet
         ratio = len(compressed_data) / (len(data) + 2)
@@ -493,13 +702,33 @@ class Auto(CompressorBase):
     def decide(self, meta, data):
         return self._decide(meta, data)[0]
 
-    def compress(self, meta, data):
+    def compress(self, meta, data, memo=None):
+        """
+        Compress *data* like the other compressors.
+
+        *memo* is an optional CompressionMemo for the chunks of one file: once some consecutive
+        chunks of a file did not compress, most of the remaining chunks are stored uncompressed
+        without trying to compress them.
+        """
         def get_meta(from_meta, to_meta):
             for key in "ctype", "clevel", "csize":
                 if key in from_meta:
                     to_meta[key] = from_meta[key]
 
+        if memo is not None and memo.incompressible >= self.MEMO_CHUNKS:
+            if memo.skipped < self.MEMO_CHECK - 1:
+                memo.skipped += 1
+                none_meta, none_compressed_data = NONE_COMPRESSOR.compress(dict(meta), data)
+                get_meta(none_meta, meta)
+                return meta, none_compressed_data
+            memo.skipped = 0  # check whether the data still does not compress
+
         compressor, (cheap_meta, cheap_compressed_data) = self._decide(dict(meta), data)
+        if memo is not None:
+            if compressor is NONE_COMPRESSOR:
+                memo.incompressible += 1
+            else:
+                memo.incompressible = memo.skipped = 0
         if compressor in (LZ4_COMPRESSOR, NONE_COMPRESSOR):
             # we know that trying to compress with expensive compressor is likely pointless,
             # so we fallback to return the cheap compressed data.
@@ -73,8 +73,42 @@
 # repo.list() / .scan() result count limit the bork client uses
 LIST_SCAN_LIMIT = 100000
 
+# number of item metadata chunks a parallel cache sync worker fetches at once
+SYNC_FETCH_BATCH_SIZE = 100
+
 FD_MAX_AGE = 4 * 60  # 4 minutes
 
+# extract --workers: max. size of a file that is fetched into memory and written by a worker thread
+EXTRACT_ASYNC_MAX_SIZE = 4 * 1024 * 1024
+
+# extract / export-tar --progress: max. size of the spooled item metadata kept in memory (more goes to a temp file)
+ITEMS_SPOOL_MAX_MEMORY = 64 * 1024 * 1024
+
+# extract: max. size of the cache for decrypted chunks that are referenced by multiple files
+EXTRACT_CHUNK_CACHE_SIZE = 64 * 1024 * 1024
+
+# extract: min. size of a file to be cloned from an already extracted file with the same content
+EXTRACT_CLONE_MIN_SIZE = 64 * 1024
+
+# max. total size of the committed segment files LoggedIO keeps memory-mapped (address space, not RAM)
+SEGMENT_MAP_BUDGET = 4 * 1024 * 1024 * 1024
+
+# Repository.get_many: max. number / total size of objects looked up and read as one batch,
+# neighbouring objects in a segment file are read with one read call, also reading over gaps
+# of up to READ_GAP_MAX bytes, but reading at most READ_SIZE_MAX bytes at once.
+GET_MANY_BATCH_SIZE = 100
+GET_MANY_BATCH_BYTES = 32 * 1024 * 1024
+READ_GAP_MAX = 64 * 1024
+READ_SIZE_MAX = 8 * 1024 * 1024
+
+# the repository index is committed as a delta (the changed entries) to the previous index file if the full
+# index file is at least INDEX_DELTA_MIN_SIZE bytes. a full index file is written again if the deltas would
+# get bigger than INDEX_DELTA_MAX_RATIO of the full index file or if there would be more than
+# INDEX_DELTA_MAX_COUNT of them.
+INDEX_DELTA_MIN_SIZE = 16 * 1024 * 1024
+INDEX_DELTA_MAX_RATIO = 0.25
+INDEX_DELTA_MAX_COUNT = 100
+
 # Some bounds on segment / segment_dir indexes
 MIN_SEGMENT_INDEX = 0
 MAX_SEGMENT_INDEX = 2**32 - 1
@@ -98,6 +132,12 @@
 # chunker params for the items metadata stream, finer granularity
 ITEMS_CHUNKER_PARAMS = (CH_BUZHASH, 15, 19, 17, HASH_WINDOW_SIZE)
 
+# zstd dictionary for the items metadata stream chunks: max. size of the dictionary, max. size
+# of the packed items used for training it and min. number of items needed for training it.
+METADATA_DICT_SIZE = 32 * 1024
+METADATA_DICT_SAMPLES_SIZE = 4 * 1024 * 1024
+METADATA_DICT_MIN_SAMPLES = 1000
+
 # normal on-disk data, allocated (but not written, all zeros), not allocated hole (all zeros)
 CH_DATA, CH_ALLOC, CH_HOLE = 0, 1, 2
 
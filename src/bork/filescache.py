@@ -0,0 +1,549 @@
+"""
+bork.filescache
+===============
+
+The files cache maps the hash of a file's path to the file's stat() infos (as seen when the file
+was backed up last time) and the list of the file's content chunk ids.
+
+As it has an entry for every file ever backed up (until the entry expires), it can get huge.
+Thus it is not loaded into memory, but memory-mapped and looked up / updated in place:
+
+- header: MAGIC, number of buckets
+- table: fixed size records (see RECORD), open addressing, sorted by key
+- delta: records without empty buckets, sorted by key (entries added since the table was written)
+- chunk ids: the concatenated 32-byte chunk ids of all files, referenced by the records
+- footer: table length and delta length (in records), number of entries, chunk ids length of the table
+  and of all records, cmtime limit of the last write (see FilesCache.write), MAGIC
+
+The home bucket of a key is computed from the key's leading bits, so the table is sorted if the
+entries get inserted in key order (colliding entries just go to the next free bucket). Because of
+that, a new files cache can be written sequentially by merging the (sorted) old table with the
+(sorted) new entries, without ever having all entries in memory.
+
+Most commits only change a few entries, but age all of them. Such commits copy the table and
+age it in bulk (see age_records), the new and changed entries go to the delta. Only if the delta
+or the deleted records in the table get too big, everything is merged into a new table.
+
+The mapping is copy-on-write: in-place updates (like marking an entry as seen in this backup)
+only affect our memory, the file is only replaced when the cache transaction gets committed.
+
+New entries are collected in memory. If they need more than MAX_NEW_SIZE bytes, they are spilled
+to a temporary file as a sorted run of records (see SortedRun), so the memory needed for a backup
+of many new or changed files stays bounded. Runs of similar size get merged, so there are only
+a few runs to look keys up in.
+"""
+
+import heapq
+import mmap
+import operator
+import os
+import tempfile
+from collections import namedtuple
+from operator import itemgetter
+from struct import Struct
+
+# note: cmtime might be either a ctime or a mtime timestamp (in ns)
+FileCacheEntry = namedtuple("FileCacheEntry", "age inode size cmtime chunk_ids")
+
+MAGIC = b"BORKFC02"
+MAGIC_PREFIX = b"BORKFC"  # all versions of this format, older versions get rejected as unknown format
+HEADER = Struct("<8sQ")  # magic, num_buckets
+# table_len, delta_len, num_entries, table_chunk_ids_len, chunk_ids_len, cmtime_limit, magic
+FOOTER = Struct("<QQQQQq8s")
+# key, inode, size, cmtime_ns, chunk_ids_offset, chunk_ids_count, age, flags, (padding)
+RECORD = Struct("<32sQQqQIBB2x")
+AGE_OFFSET = RECORD.size - 4
+FLAGS_OFFSET = RECORD.size - 3
+KEY_LEN = 32
+ID_LEN = 32
+
+FLAG_EMPTY = 1  # unused bucket
+FLAG_SEEN = 2  # the entry was seen (file known and unchanged) in this backup, its age will be 0
+FLAG_DELETED = 4  # the entry was superseded by a new entry
+
+EMPTY_RECORD = RECORD.pack(bytes(KEY_LEN), 0, 0, 0, 0, 0, 0, FLAG_EMPTY)
+MAX_AGE = 255
+MAX_LOAD_FACTOR = 0.8
+# new entries kept in memory are spilled to disk when they use more than this (approximately, in bytes)
+MAX_NEW_SIZE = 32 * 1024 * 1024
+NEW_ENTRY_OVERHEAD = 300  # approx. memory needed for an entry in FilesCache.new (without the chunk ids)
+# write() merges everything into a new table if the delta would get bigger than this part of the table entries
+MAX_DELTA_RATIO = 1 / 8
+# ... or if more than this part of the records in the table are deleted
+MAX_DELETED_RATIO = 1 / 4
+AGE_BLOCK_SIZE = 65536  # records aged at once by age_records
+
+
+def byte_table(func):
+    return bytes(func(value) for value in range(256))
+
+
+# translation tables for ages and flags, see age_records
+AGED = byte_table(lambda age: min(age + 1, MAX_AGE))
+AGE_MASK = byte_table(lambda flags: 0 if flags & (FLAG_EMPTY | FLAG_SEEN | FLAG_DELETED) else 0xFF)
+CLEAR_SEEN = byte_table(lambda flags: flags & ~FLAG_SEEN)
+IS_LIVE = byte_table(lambda flags: 0 if flags & (FLAG_EMPTY | FLAG_DELETED) else 1)
+IS_DELETED = byte_table(lambda flags: 1 if flags & FLAG_DELETED else 0)
+
+
+def home_bucket(key, num_buckets):
+    return int.from_bytes(key[:8], "big") * num_buckets >> 64
+
+
+def write_empty_records(fd, count):
+    while count > 0:
+        n = min(count, 65536)
+        fd.write(EMPTY_RECORD * n)
+        count -= n
+
+
+def keep_entry(entry, ttl, newest_cmtime):
+    # Only keep files seen in this backup that are older than newest cmtime seen in this backup -
+    # this is to avoid issues with filesystem snapshots and cmtime granularity.
+    # Also keep files from older backups that have not reached the ttl yet.
+    return entry.age == 0 and entry.cmtime < newest_cmtime or 0 < entry.age < ttl
+
+
+def make_entry(record, aging):
+    key, inode, size, cmtime, chunk_ids_offset, chunk_ids_count, age, flags = record
+    if flags & FLAG_SEEN:
+        age = 0
+    elif aging:
+        age = min(age + 1, MAX_AGE)
+    return FileCacheEntry(age=age, inode=inode, size=size, cmtime=cmtime, chunk_ids=None)
+
+
+def pack_record(key, entry, chunk_ids_offset, chunk_ids):
+    return RECORD.pack(
+        key,
+        entry.inode,
+        entry.size,
+        entry.cmtime,
+        chunk_ids_offset,
+        len(chunk_ids) // ID_LEN,
+        min(entry.age, MAX_AGE),
+        0,
+    )
+
+
+def split_chunk_ids(chunk_ids):
+    return [chunk_ids[i : i + ID_LEN] for i in range(0, len(chunk_ids), ID_LEN)]
+
+
+def touch_record(map, offset, inode):
+    """Mark the record at *offset* as seen, return its cmtime."""
+    record = list(RECORD.unpack_from(map, offset))
+    record[1] = inode
+    record[7] |= FLAG_SEEN
+    RECORD.pack_into(map, offset, *record)
+    return record[3]
+
+
+def delete_record(map, offset):
+    map[offset + FLAGS_OFFSET] |= FLAG_DELETED
+
+
+def find_record(map, start, count, key):
+    """Return the offset of the record for *key* in the *count* sorted records at *start*, or None."""
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        offset = start + mid * RECORD.size
+        record_key = map[offset : offset + KEY_LEN]
+        if record_key < key:
+            lo = mid + 1
+        elif record_key > key:
+            hi = mid
+        else:
+            return None if map[offset + FLAGS_OFFSET] & FLAG_DELETED else offset
+    return None
+
+
+def bulk_op(op, a, b):
+    # apply the bitwise *op* to all bytes of *a* and *b* at once.
+    return op(int.from_bytes(a, "little"), int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+
+def age_records(records, aging, ttl):
+    """
+    Age the *records* (a bytearray) in place, return the number of live records.
+
+    Like make_entry and keep_entry would do, but for all records at once: seen entries get age 0, the others
+    get one generation older (if *aging* is True) and are deleted when they reach the *ttl*. The seen flags
+    get reset. The caller needs to make sure that no seen entry needs to be dropped because of its cmtime.
+    """
+    ages = records[AGE_OFFSET :: RECORD.size]
+    flags = records[FLAGS_OFFSET :: RECORD.size]
+    if aging:
+        ages = ages.translate(AGED)
+    ages = bulk_op(operator.and_, ages, flags.translate(AGE_MASK))
+    expired = byte_table(lambda age: FLAG_DELETED if 0 < age >= ttl else 0)
+    flags = bulk_op(operator.or_, flags.translate(CLEAR_SEEN), ages.translate(expired))
+    records[AGE_OFFSET :: RECORD.size] = ages
+    records[FLAGS_OFFSET :: RECORD.size] = flags
+    return flags.translate(IS_LIVE).count(1)
+
+
+def copy_file(src, dst):
+    src.seek(0)
+    while True:
+        data = src.read(1024 * 1024)
+        if not data:
+            break
+        dst.write(data)
+
+
+class SortedRun:
+    """
+    New files cache entries, spilled to temporary files.
+
+    The records (see RECORD, without empty buckets) are sorted by key, so a key is looked up by
+    binary search. Like in the files cache, the records can be updated in place.
+    """
+
+    def __init__(self, entries, tmp_dir=None):
+        """Write the *entries* ((key, FileCacheEntry, packed chunk ids) tuples, sorted by key)."""
+        self.count = 0
+        self.records_fd = tempfile.TemporaryFile(dir=tmp_dir)
+        self.chunk_ids_fd = tempfile.TemporaryFile(dir=tmp_dir)
+        chunk_ids_len = 0
+        for key, entry, chunk_ids in entries:
+            self.records_fd.write(pack_record(key, entry, chunk_ids_len, chunk_ids))
+            self.chunk_ids_fd.write(chunk_ids)
+            chunk_ids_len += len(chunk_ids)
+            self.count += 1
+        self.live = self.count  # number of records not deleted
+        self.map = self._map(self.records_fd)
+        self.chunk_ids_map = self._map(self.chunk_ids_fd)
+
+    @staticmethod
+    def _map(fd):
+        fd.flush()
+        if fd.tell() == 0:
+            return bytearray()  # empty files can't be mapped
+        return mmap.mmap(fd.fileno(), 0)
+
+    def close(self):
+        for map in (self.map, self.chunk_ids_map):
+            if isinstance(map, mmap.mmap):
+                map.close()
+        self.records_fd.close()
+        self.chunk_ids_fd.close()
+
+    def lookup(self, key):
+        """Return the offset of the record for *key*, or None."""
+        return find_record(self.map, 0, self.count, key)
+
+    def get(self, offset):
+        """Return (FileCacheEntry, packed chunk ids) for the record at *offset*."""
+        record = RECORD.unpack_from(self.map, offset)
+        start, count = record[4], record[5]
+        # spilled entries are new entries, their age is not incremented.
+        return make_entry(record, aging=False), self.chunk_ids_map[start : start + count * ID_LEN]
+
+    def touch(self, offset, inode):
+        touch_record(self.map, offset, inode)
+
+    def delete(self, offset):
+        delete_record(self.map, offset)
+        self.live -= 1
+
+    def items(self):
+        """Yield (key, FileCacheEntry, packed chunk ids) of the records not deleted, in key order."""
+        for offset in range(0, self.count * RECORD.size, RECORD.size):
+            if not self.map[offset + FLAGS_OFFSET] & FLAG_DELETED:
+                entry, chunk_ids = self.get(offset)
+                yield self.map[offset : offset + KEY_LEN], entry, chunk_ids
+
+
+class FilesCache:
+    """
+    Memory-mapped files cache, mapping path_hash -> FileCacheEntry.
+
+    Entries of files that were not seen by the current backup are reported one generation older
+    (age + 1) than stored, if *aging* is True.
+
+    Entries added by put() are kept in memory (or spilled to sorted runs in temporary files created
+    in *tmp_dir*, if they need more than *max_new_size* bytes) until write() writes them to a new
+    files cache.
+    """
+
+    def __init__(self, path=None, aging=True, tmp_dir=None, max_new_size=MAX_NEW_SIZE):
+        self.aging = aging
+        self.new = {}  # key -> (FileCacheEntry with cmtime_ns and packed chunk_ids)
+        self.new_size = 0  # approx. memory used by self.new
+        self.max_new_size = max_new_size
+        self.runs = []  # SortedRun, entries spilled from self.new, the older (bigger) runs first
+        self.tmp_dir = tmp_dir
+        self.fd = None
+        self.map = None
+        self.num_buckets = 0
+        self.table_len = 0
+        self.table_end = HEADER.size
+        self.delta_len = 0
+        self.chunk_ids_start = 0
+        self.table_chunk_ids_len = 0
+        self.cmtime_limit = None  # all entries of age 0 had a cmtime below this when they were written
+        self.touched_cmtime = None  # the newest cmtime of the mapped entries seen in this backup
+        self.num_entries = 0
+        self.num_deleted = 0
+        if path is not None:
+            self._open(path)
+
+    def _open(self, path):
+        self.fd = open(path, "rb")
+        size = os.fstat(self.fd.fileno()).st_size
+        if size == 0:  # a new, empty files cache
+            return
+        if size < HEADER.size + FOOTER.size:
+            raise ValueError("files cache file is too short")
+        self.map = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, self.num_buckets = HEADER.unpack_from(self.map, 0)
+        footer = FOOTER.unpack_from(self.map, size - FOOTER.size)
+        table_len, delta_len, self.num_entries, table_chunk_ids_len, chunk_ids_len, cmtime_limit, magic_footer = footer
+        if magic != MAGIC or magic_footer != MAGIC:
+            raise ValueError("files cache has unknown format")
+        if HEADER.size + (table_len + delta_len) * RECORD.size + chunk_ids_len + FOOTER.size != size:
+            raise ValueError("files cache has inconsistent size")
+        self.table_len = table_len
+        self.table_end = HEADER.size + table_len * RECORD.size
+        self.delta_len = delta_len
+        self.chunk_ids_start = self.table_end + delta_len * RECORD.size
+        self.table_chunk_ids_len = table_chunk_ids_len
+        self.cmtime_limit = cmtime_limit
+
+    @staticmethod
+    def is_files_cache(data):
+        """Return whether *data* (the start of a file) has the files cache format of this module."""
+        return data[: len(MAGIC_PREFIX)] == MAGIC_PREFIX
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def __len__(self):
+        return self.num_entries - self.num_deleted + len(self.new) + sum(run.live for run in self.runs)
+
+    def _lookup(self, key):
+        """Return the offset of the record for *key* in the mapping (table or delta), or None."""
+        offset = self._lookup_table(key)
+        if offset is None and self.delta_len:
+            offset = find_record(self.map, self.table_end, self.delta_len, key)
+        return offset
+
+    def _lookup_table(self, key):
+        if not self.num_buckets:
+            return None
+        pos = home_bucket(key, self.num_buckets)
+        offset = HEADER.size + pos * RECORD.size
+        while offset < self.table_end:
+            record_key = self.map[offset : offset + KEY_LEN]
+            flags = self.map[offset + FLAGS_OFFSET]
+            if flags & FLAG_EMPTY or record_key > key:
+                return None
+            if record_key == key:
+                return None if flags & FLAG_DELETED else offset
+            offset += RECORD.size
+        return None
+
+    def _chunk_ids(self, chunk_ids_offset, chunk_ids_count):
+        start = self.chunk_ids_start + chunk_ids_offset
+        return self.map[start : start + chunk_ids_count * ID_LEN]
+
+    def _lookup_runs(self, key):
+        """Return (run, offset) of the record for *key* in the spilled runs, or (None, None)."""
+        for run in self.runs:
+            offset = run.lookup(key)
+            if offset is not None:
+                return run, offset
+        return None, None
+
+    def get(self, key, default=None):
+        """Return the FileCacheEntry for *key* (cmtime in ns), or *default*."""
+        try:
+            entry, chunk_ids = self.new[key]
+        except KeyError:
+            run, offset = self._lookup_runs(key)
+            if run is not None:
+                entry, chunk_ids = run.get(offset)
+            else:
+                offset = self._lookup(key)
+                if offset is None:
+                    return default
+                record = RECORD.unpack_from(self.map, offset)
+                entry, chunk_ids = make_entry(record, self.aging), self._chunk_ids(record[4], record[5])
+        return entry._replace(chunk_ids=split_chunk_ids(chunk_ids))
+
+    def touch(self, key, inode):
+        """Mark the entry for *key* as seen in this backup (age 0) and update its inode number."""
+        try:
+            entry, chunk_ids = self.new[key]
+        except KeyError:
+            pass
+        else:
+            self.new[key] = entry._replace(inode=inode, age=0), chunk_ids
+            return
+        run, offset = self._lookup_runs(key)
+        if run is not None:
+            run.touch(offset, inode)
+            return
+        offset = self._lookup(key)
+        if offset is None:
+            raise KeyError(key)
+        cmtime = touch_record(self.map, offset, inode)
+        if self.touched_cmtime is None or cmtime > self.touched_cmtime:
+            self.touched_cmtime = cmtime
+
+    def put(self, key, entry):
+        """Add or replace the entry for *key*, *entry* is a FileCacheEntry (cmtime in ns)."""
+        try:
+            _, chunk_ids = self.new[key]
+        except KeyError:
+            run, offset = self._lookup_runs(key)
+            if run is not None:
+                run.delete(offset)
+            else:
+                offset = self._lookup(key)
+                if offset is not None:
+                    delete_record(self.map, offset)
+                    self.num_deleted += 1
+        else:
+            self.new_size -= NEW_ENTRY_OVERHEAD + len(chunk_ids)
+        chunk_ids = b"".join(entry.chunk_ids)
+        self.new[key] = entry._replace(chunk_ids=None), chunk_ids
+        self.new_size += NEW_ENTRY_OVERHEAD + len(chunk_ids)
+        if self.new_size > self.max_new_size:
+            self._spill()
+
+    def _spill(self):
+        # move the new entries to a sorted run on disk.
+        entries = ((key, entry, chunk_ids) for key, (entry, chunk_ids) in sorted(self.new.items()))
+        self.runs.append(SortedRun(entries, tmp_dir=self.tmp_dir))
+        self.new.clear()
+        self.new_size = 0
+        # merge runs of similar size, so lookups only need to search a logarithmic number of runs.
+        while len(self.runs) >= 2 and self.runs[-1].live >= self.runs[-2].live:
+            older, newer = self.runs[-2], self.runs[-1]
+            merged = SortedRun(heapq.merge(older.items(), newer.items(), key=itemgetter(0)), tmp_dir=self.tmp_dir)
+            older.close()
+            newer.close()
+            self.runs[-2:] = [merged]
+
+    def _iter_mapped(self):
+        # yields (key, entry, packed chunk_ids) of the valid records in the table and in the delta, in key order.
+        table = self._iter_records(HEADER.size, self.table_len)
+        delta = self._iter_records(self.table_end, self.delta_len)
+        return heapq.merge(table, delta, key=itemgetter(0))
+
+    def _iter_records(self, start, count):
+        for offset in range(start, start + count * RECORD.size, RECORD.size):
+            record = RECORD.unpack_from(self.map, offset)
+            flags = record[7]
+            if not flags & (FLAG_EMPTY | FLAG_DELETED):
+                yield record[0], make_entry(record, self.aging), self._chunk_ids(record[4], record[5])
+
+    def items(self):
+        """Yield (key, FileCacheEntry) for all entries, in key order."""
+        for key, entry, chunk_ids in self._merged():
+            yield key, entry._replace(chunk_ids=split_chunk_ids(chunk_ids))
+
+    def _new_items(self):
+        # the spilled runs and the new entries, all sorted by key.
+        new = ((key, entry, chunk_ids) for key, (entry, chunk_ids) in sorted(self.new.items()))
+        return [run.items() for run in self.runs] + [new]
+
+    def _merged(self):
+        # merge the mapped entries, the spilled runs and the new entries, all sorted by key.
+        # a key is in at most one of them, older entries for the key were deleted by put().
+        return heapq.merge(self._iter_mapped(), *self._new_items(), key=itemgetter(0))
+
+    def write(self, fd, ttl, newest_cmtime, tmp_dir=None):
+        """
+        Write a new files cache to *fd* (must be sequentially writable), return the number of entries.
+
+        Only the entries younger than *ttl* are kept, entries seen in this backup only if their cmtime is
+        older than *newest_cmtime*. The entries are written with the age they have now, the seen flags are
+        reset.
+        """
+        if self._table_reusable(newest_cmtime):
+            return self._write_delta(fd, ttl, newest_cmtime, tmp_dir)
+        return self._write_merged(fd, ttl, newest_cmtime, tmp_dir)
+
+    def _table_reusable(self, newest_cmtime):
+        # can the table be copied (and aged in bulk), with all other entries going to the delta?
+        if not self.table_len:
+            return False
+        if self.touched_cmtime is not None and self.touched_cmtime >= newest_cmtime:
+            return False  # entries seen in this backup need to be dropped
+        if not self.aging and newest_cmtime < self.cmtime_limit:
+            return False  # entries seen in the last backup (still age 0) might need to be dropped
+        flags = self.map[HEADER.size + FLAGS_OFFSET : self.table_end : RECORD.size]
+        table_live = flags.translate(IS_LIVE).count(1)
+        if flags.translate(IS_DELETED).count(1) > self.table_len * MAX_DELETED_RATIO:
+            return False
+        delta_len = self.delta_len + len(self.new) + sum(run.live for run in self.runs)
+        return delta_len <= table_live * MAX_DELTA_RATIO
+
+    def _write_delta(self, fd, ttl, newest_cmtime, tmp_dir):
+        # copy the table (aging it in bulk, the records keep their chunk ids) and write the delta entries after it.
+        fd.write(HEADER.pack(MAGIC, self.num_buckets))
+        num_entries = 0
+        block_size = AGE_BLOCK_SIZE * RECORD.size
+        for start in range(HEADER.size, self.table_end, block_size):
+            records = bytearray(self.map[start : min(start + block_size, self.table_end)])
+            num_entries += age_records(records, self.aging, ttl)
+            fd.write(records)
+        delta_len = chunk_ids_len = 0
+        with tempfile.TemporaryFile(dir=tmp_dir) as chunk_ids_fd:
+            delta = self._iter_records(self.table_end, self.delta_len)
+            for key, entry, chunk_ids in heapq.merge(delta, *self._new_items(), key=itemgetter(0)):
+                if not keep_entry(entry, ttl, newest_cmtime):
+                    continue
+                fd.write(pack_record(key, entry, self.table_chunk_ids_len + chunk_ids_len, chunk_ids))
+                delta_len += 1
+                chunk_ids_fd.write(chunk_ids)
+                chunk_ids_len += len(chunk_ids)
+            for start in range(0, self.table_chunk_ids_len, block_size):
+                end = min(start + block_size, self.table_chunk_ids_len)
+                fd.write(self.map[self.chunk_ids_start + start : self.chunk_ids_start + end])
+            copy_file(chunk_ids_fd, fd)
+        num_entries += delta_len
+        chunk_ids_len += self.table_chunk_ids_len
+        fd.write(
+            FOOTER.pack(
+                self.table_len, delta_len, num_entries, self.table_chunk_ids_len, chunk_ids_len, newest_cmtime, MAGIC
+            )
+        )
+        return num_entries
+
+    def _write_merged(self, fd, ttl, newest_cmtime, tmp_dir):
+        # merge all entries into a new table.
+        num_buckets = max(int(len(self) / MAX_LOAD_FACTOR), 1)
+        fd.write(HEADER.pack(MAGIC, num_buckets))
+        pos = num_entries = chunk_ids_len = 0
+        with tempfile.TemporaryFile(dir=tmp_dir) as chunk_ids_fd:
+            for key, entry, chunk_ids in self._merged():
+                if not keep_entry(entry, ttl, newest_cmtime):
+                    continue
+                home = home_bucket(key, num_buckets)
+                if home > pos:
+                    write_empty_records(fd, home - pos)
+                    pos = home
+                fd.write(pack_record(key, entry, chunk_ids_len, chunk_ids))
+                pos += 1
+                num_entries += 1
+                chunk_ids_fd.write(chunk_ids)
+                chunk_ids_len += len(chunk_ids)
+            if num_buckets > pos:
+                write_empty_records(fd, num_buckets - pos)
+                pos = num_buckets
+            copy_file(chunk_ids_fd, fd)
+        fd.write(FOOTER.pack(pos, 0, num_entries, chunk_ids_len, chunk_ids_len, newest_cmtime, MAGIC))
+        return num_entries
@@ -7,7 +7,10 @@
 import sys
 import tempfile
 import time
+from array import array
+from bisect import bisect_right
 from collections import defaultdict
+from itertools import accumulate
 from signal import SIGINT
 
 from .fuse_impl import llfuse, has_pyfuse3
@@ -38,9 +41,10 @@ def async_wrapper(fn):
 from .archiver._common import build_matcher, build_filter
 from .archive import Archive, get_item_uid_gid
 from .hashindex import FuseVersionsIndex
-from .helpers import daemonize, daemonizing, signal_handler, format_file_size
+from .helpers import daemonize, daemonizing, signal_handler, format_file_size, parse_file_size
 from .helpers import HardLinkManager
 from .helpers import msgpack
+from .helpers.chunkcache import ChunkCache
 from .helpers.lrucache import LRUCache
 from .item import Item
 from .platform import uid2user, gid2group
@@ -66,6 +70,10 @@ def fuse_main():
 #       thus, do not set FILES to high values.
 FILES = 4
 
+# default budget of the decrypted chunk data cache (bytes) and number of chunks to read ahead for sequential reads
+CHUNK_CACHE_SIZE = 128 * 1024 * 1024
+READAHEAD_CHUNKS = 4
+
 
 class ItemCache:
     """
@@ -444,10 +452,11 @@ def __init__(self, manifest, args, decrypted_repository):
         llfuse.Operations.__init__(self)
         FuseBackend.__init__(self, manifest, args, decrypted_repository)
         self.decrypted_repository = decrypted_repository
-        data_cache_capacity = int(os.environ.get("BORK_MOUNT_DATA_CACHE_ENTRIES", os.cpu_count() or 1))
-        logger.debug("mount data cache capacity: %d chunks", data_cache_capacity)
-        self.data_cache = LRUCache(capacity=data_cache_capacity)
-        self._last_pos = LRUCache(capacity=FILES)
+        self.chunk_cache = None  # created by mount(), the size is a mount option
+        self.readahead = 0
+        self._last_pos = LRUCache(capacity=FILES)  # fh -> in-file offset where the last read ended
+        self._open_count = {}  # fh -> number of open() calls not released yet
+        self._chunk_offsets = {}  # fh -> in-file offsets of the chunks (while the file is open), see read()
 
     def sig_info_handler(self, sig_no, stack):
         logger.debug(
@@ -467,12 +476,21 @@ def sig_info_handler(self, sig_no, stack):
             format_file_size(sys.getsizeof(self.cache.meta)),
             format_file_size(os.stat(self.cache.fd.fileno()).st_size),
         )
-        logger.debug(
-            "fuse: data cache: %d/%d entries, %s",
-            len(self.data_cache.items()),
-            self.data_cache._capacity,
-            format_file_size(sum(len(chunk) for key, chunk in self.data_cache.items())),
-        )
+        if self.chunk_cache is not None:
+            chunk_cache = self.chunk_cache
+            logger.debug(
+                "fuse: chunk cache: %d entries, memory %s / %s, disk %s / %s, "
+                "%d hits, %d disk hits, %d misses, %d evictions",
+                len(chunk_cache),
+                format_file_size(chunk_cache.size),
+                format_file_size(chunk_cache.size_limit),
+                format_file_size(chunk_cache.disk_size),
+                format_file_size(chunk_cache.disk_size_limit),
+                chunk_cache.hits,
+                chunk_cache.disk_hits,
+                chunk_cache.misses,
+                chunk_cache.evictions,
+            )
         self.decrypted_repository.log_instrumentation()
 
     def mount(self, mountpoint, mount_options, foreground=False):
@@ -532,6 +550,11 @@ def pop_option(options, key, present, not_present, wanted_type, int_base=0):
         self.uid_forced = pop_option(options, "uid", None, None, int)
         self.gid_forced = pop_option(options, "gid", None, None, int)
         self.umask = pop_option(options, "umask", 0, 0, int, int_base=8)  # umask is octal, e.g. 222 or 0222
+        chunk_cache_size = pop_option(options, "chunk_cache_size", None, CHUNK_CACHE_SIZE, parse_file_size)
+        chunk_cache_disk_size = pop_option(options, "chunk_cache_disk_size", None, 0, parse_file_size)
+        self.readahead = pop_option(options, "readahead", None, READAHEAD_CHUNKS, int)
+        if chunk_cache_size is None or chunk_cache_disk_size is None or self.readahead is None:
+            raise ValueError("chunk_cache_size, chunk_cache_disk_size and readahead options need a value")
         dir_uid = self.uid_forced if self.uid_forced is not None else self.default_uid
         dir_gid = self.gid_forced if self.gid_forced is not None else self.default_gid
         dir_user = uid2user(dir_uid)
@@ -559,6 +582,13 @@ def pop_option(options, key, present, not_present, wanted_type, int_base=0):
         # job - seeing the mountpoint empty, rsync would delete everything in the
         # mirror.
         umount = False
+        self.chunk_cache = ChunkCache(chunk_cache_size, disk_size=chunk_cache_disk_size)
+        logger.debug(
+            "fuse: chunk cache size %s, disk tier size %s, readahead %d chunks",
+            format_file_size(chunk_cache_size),
+            format_file_size(chunk_cache_disk_size),
+            self.readahead,
+        )
         try:
             with signal_handler("SIGUSR1", self.sig_info_handler), signal_handler("SIGINFO", self.sig_info_handler):
                 signal = fuse_main()
@@ -566,6 +596,7 @@ def pop_option(options, key, present, not_present, wanted_type, int_base=0):
             umount = signal is None or (signal == SIGINT and foreground)
         finally:
             llfuse.close(umount)
+            self.chunk_cache.close()
 
     @async_wrapper
     def statfs(self, ctx=None):
@@ -652,8 +683,20 @@ def open(self, inode, flags, ctx=None):
                     "Mount with allow_damaged_files to read damaged files."
                 )
                 raise llfuse.FUSEError(errno.EIO)
+        # the inode is used as file handle, so opening the same file multiple times gives the same fh.
+        self._open_count[inode] = self._open_count.get(inode, 0) + 1
         return llfuse.FileInfo(fh=inode) if has_pyfuse3 else inode
 
+    @async_wrapper
+    def release(self, fh):
+        count = self._open_count.pop(fh, 0) - 1
+        if count > 0:
+            self._open_count[fh] = count
+        else:
+            self._chunk_offsets.pop(fh, None)
+            if fh in self._last_pos:
+                del self._last_pos[fh]
+
     @async_wrapper
     def opendir(self, inode, ctx=None):
         self.check_pending_archive(inode)
@@ -663,46 +706,56 @@ def opendir(self, inode, ctx=None):
     def read(self, fh, offset, size):
         parts = []
         item = self.get_item(fh)
+        chunks = item.chunks
+        sequential = offset == 0 or offset == self._last_pos.get(fh)
+        if fh in self._last_pos:
+            self._last_pos.replace(fh, offset + size)
+        else:
+            self._last_pos[fh] = offset + size
 
-        # optimize for linear reads:
-        # we cache the chunk number and the in-file offset of the chunk in _last_pos[fh]
-        chunk_no, chunk_offset = self._last_pos.get(fh, (0, 0))
-        if chunk_offset > offset:
-            # this is not a linear read, so we lost track and need to start from beginning again...
-            chunk_no, chunk_offset = (0, 0)
+        # chunk_offsets[i] is the in-file offset of chunks[i], the last element is the file size.
+        # it is computed when a file is read first, so finding the chunk for an offset is a binary search.
+        chunk_offsets = self._chunk_offsets.get(fh)
+        if chunk_offsets is None:
+            chunk_offsets = array("Q", accumulate((s for _, s in chunks), initial=0))
+            self._chunk_offsets[fh] = chunk_offsets
+        chunk_no = bisect_right(chunk_offsets, offset) - 1
+        offset -= chunk_offsets[chunk_no]
 
-        offset -= chunk_offset
-        chunks = item.chunks
         # note: using index iteration to avoid frequently copying big (sub)lists by slicing
         for idx in range(chunk_no, len(chunks)):
             id, s = chunks[idx]
-            if s < offset:
-                offset -= s
-                chunk_offset += s
-                chunk_no += 1
-                continue
             n = min(size, s - offset)
-            if id in self.data_cache:
-                data = self.data_cache[id]
-                if offset + n == len(data):
-                    # evict fully read chunk from cache
-                    del self.data_cache[id]
-            else:
-                _, data = self.repo_objs.parse(id, self.repository_uncached.get(id))
-                if offset + n < len(data):
-                    # chunk was only partially read, cache it
-                    self.data_cache[id] = data
+            data = self.chunk_cache.get(id)
+            if data is None:
+                data = self._fetch_chunks(chunks, idx, readahead=self.readahead if sequential else 0)
             parts.append(data[offset : offset + n])
             offset = 0
             size -= n
             if not size:
-                if fh in self._last_pos:
-                    self._last_pos.replace(fh, (chunk_no, chunk_offset))
-                else:
-                    self._last_pos[fh] = (chunk_no, chunk_offset)
                 break
         return b"".join(parts)
 
+    def _fetch_chunks(self, chunks, idx, readahead=0):
+        """
+        Fetch chunks[idx] and add it to the chunk cache, return its data.
+
+        With *readahead*, the next *readahead* chunks are fetched too (if not cached yet), using
+        a single get_many call, so sequential readers do not wait for one chunk after the other.
+        """
+        ids = [chunks[idx][0]]
+        for next_idx in range(idx + 1, min(idx + 1 + readahead, len(chunks))):
+            id = chunks[next_idx][0]
+            if id not in self.chunk_cache and id not in ids:
+                ids.append(id)
+        result = None
+        for id, cdata in zip(ids, self.repository_uncached.get_many(ids)):
+            _, data = self.repo_objs.parse(id, cdata)
+            self.chunk_cache.put(id, data)
+            if result is None:
+                result = data
+        return result
+
     # note: we can't have a generator (with yield) and not a generator (async) in the same method
     if has_pyfuse3:
 
@@ -1,8 +1,12 @@
 from collections import namedtuple
 
+from .helpers.fs import MappedFile
+
 cimport cython
 from libc.stdint cimport uint32_t, UINT32_MAX, uint64_t
+from libc.stdlib cimport malloc, free, qsort
 from libc.string cimport memcpy
+from cpython.array cimport array, clone
 from cpython.buffer cimport PyBUF_SIMPLE, PyObject_GetBuffer, PyBuffer_Release
 from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_CheckExact, PyBytes_GET_SIZE, PyBytes_AS_STRING
 
@@ -24,10 +28,12 @@ cdef extern from "_hashindex.c":
     int hashindex_size(HashIndex *index)
     void hashindex_write(HashIndex *index, object file_py, int legacy) except *
     unsigned char *hashindex_get(HashIndex *index, unsigned char *key)
+    void hashindex_prefetch(HashIndex *index, unsigned char *key)
     unsigned char *hashindex_next_key(HashIndex *index, unsigned char *key)
     int hashindex_delete(HashIndex *index, unsigned char *key)
     int hashindex_set(HashIndex *index, unsigned char *key, void *value)
     uint64_t hashindex_compact(HashIndex *index)
+    int hashindex_buckets_buffered(HashIndex *index)
     uint32_t _htole32(uint32_t v)
     uint32_t _le32toh(uint32_t v)
 
@@ -42,7 +48,7 @@ cdef extern from "cache_sync/cache_sync.c":
     const char *cache_sync_error(const CacheSyncCtx *ctx)
     uint64_t cache_sync_num_files_totals(const CacheSyncCtx *ctx)
     uint64_t cache_sync_size_totals(const CacheSyncCtx *ctx)
-    int cache_sync_feed(CacheSyncCtx *ctx, void *data, uint32_t length)
+    int cache_sync_feed(CacheSyncCtx *ctx, void *data, uint32_t length) nogil
     void cache_sync_free(CacheSyncCtx *ctx)
 
     uint32_t _MAX_VALUE
@@ -69,6 +75,19 @@ assert UINT32_MAX == 2**32-1
 
 assert _MAX_VALUE % 2 == 1
 
+# the *_many methods return their results in arrays of this type
+cdef array uint32_array = array('I')
+assert uint32_array.itemsize == 4
+
+# how many keys ahead the *_many methods prefetch the buckets
+cdef Py_ssize_t PREFETCH_DISTANCE = 8
+
+
+cdef int _compare_pointers(const void *a, const void *b) noexcept nogil:
+    cdef size_t x = <size_t>(<void **>a)[0]
+    cdef size_t y = <size_t>(<void **>b)[0]
+    return (x > y) - (x < y)
+
 
 def hashindex_variant(fn):
     """peek into an index file and find out what it is"""
@@ -78,6 +97,8 @@ def hashindex_variant(fn):
         return 1  # legacy
     if magic == b'BORK2IDX':
         return 2
+    if magic == b'BORKDIDX':
+        return 3  # changes to a variant 2 index, see repository.IndexChanges
     if magic == b'12345678':  # used by unit tests
         return 2  # just return the current variant
     raise ValueError(f'unknown hashindex magic: {magic!r}')
@@ -94,11 +115,11 @@ cdef class IndexBase:
     MAX_LOAD_FACTOR = HASH_MAX_LOAD
     MAX_VALUE = _MAX_VALUE
 
-    def __cinit__(self, capacity=0, path=None, permit_compact=False, usable=None):
+    def __cinit__(self, capacity=0, path=None, permit_compact=False, usable=None, mmap=False):
         self.key_size = self._key_size
         if path:
             if isinstance(path, (str, bytes)):
-                with open(path, 'rb') as fd:
+                with (MappedFile(path, copy_on_write=True) if mmap else open(path, 'rb')) as fd:
                     self.index = hashindex_read(fd, permit_compact, self.legacy)
             else:
                 self.index = hashindex_read(path, permit_compact, self.legacy)
@@ -115,8 +136,14 @@ cdef class IndexBase:
             hashindex_free(self.index)
 
     @classmethod
-    def read(cls, path, permit_compact=False):
-        return cls(path=path, permit_compact=permit_compact)
+    def read(cls, path, permit_compact=False, mmap=False):
+        """
+        Read the index from *path* (a file name or a file object).
+
+        With *mmap*, the buckets are not read into memory, but memory-mapped (copy-on-write) from the file.
+        Alternatively, pass a MappedFile (or a file object wrapping one) as *path*.
+        """
+        return cls(path=path, permit_compact=permit_compact, mmap=mmap)
 
     def write(self, path):
         if isinstance(path, (str, bytes)):
@@ -162,6 +189,46 @@ cdef class IndexBase:
                 return default
             raise
 
+    cdef uint32_t **_lookup_many(self, Py_buffer *keys_buffer, Py_ssize_t *count) except NULL:
+        """
+        Look up the concatenated keys in *keys_buffer*, return their values (NULL for missing keys) in an array to free().
+        """
+        cdef Py_ssize_t i, n
+        cdef unsigned char *key
+        cdef uint32_t **values
+        if keys_buffer.len % self.key_size:
+            raise ValueError('keys must be a concatenation of %d byte keys' % self.key_size)
+        n = keys_buffer.len // self.key_size
+        values = <uint32_t **>malloc(max(n, 1) * sizeof(uint32_t *))
+        if not values:
+            raise MemoryError
+        key = <unsigned char *>keys_buffer.buf
+        for i in range(n):
+            if i + PREFETCH_DISTANCE < n:
+                hashindex_prefetch(self.index, key + PREFETCH_DISTANCE * self.key_size)
+            values[i] = <uint32_t *>hashindex_get(self.index, key)
+            key += self.key_size
+        count[0] = n
+        return values
+
+    def contains_many(self, keys):
+        """
+        Return a bytearray telling for each of the concatenated *keys* whether it is in the index (1) or not (0).
+        """
+        cdef Py_buffer keys_buffer
+        cdef Py_ssize_t i, n
+        cdef uint32_t **values = NULL
+        PyObject_GetBuffer(keys, &keys_buffer, PyBUF_SIMPLE)
+        try:
+            values = self._lookup_many(&keys_buffer, &n)
+            result = bytearray(n)
+            for i in range(n):
+                result[i] = 1 if values[i] != NULL else 0
+        finally:
+            free(values)
+            PyBuffer_Release(&keys_buffer)
+        return result
+
     def __len__(self):
         return hashindex_len(self.index)
 
@@ -463,6 +530,113 @@ cdef class ChunkIndex(IndexBase):
         data[0] = _htole32(refcount)
         return refcount, _le32toh(data[1])
 
+    def get_many(self, keys):
+        """
+        Return arrays of the refcounts and of the sizes of the concatenated *keys*.
+
+        Keys not in the index get a refcount and size of 0.
+        """
+        cdef Py_buffer keys_buffer
+        cdef Py_ssize_t i, n
+        cdef uint32_t **values = NULL
+        cdef uint32_t refcount
+        cdef array refcounts, sizes
+        PyObject_GetBuffer(keys, &keys_buffer, PyBUF_SIMPLE)
+        try:
+            values = self._lookup_many(&keys_buffer, &n)
+            refcounts = clone(uint32_array, n, zero=True)
+            sizes = clone(uint32_array, n, zero=True)
+            for i in range(n):
+                if values[i]:
+                    refcount = _le32toh(values[i][0])
+                    assert refcount <= _MAX_VALUE, "invalid reference count"
+                    refcounts.data.as_uints[i] = refcount
+                    sizes.data.as_uints[i] = _le32toh(values[i][1])
+        finally:
+            free(values)
+            PyBuffer_Release(&keys_buffer)
+        return refcounts, sizes
+
+    def incref_many(self, keys):
+        """
+        Increase the refcounts of the concatenated *keys*, return an array of their sizes.
+
+        Like incref() for each key, but if a key is missing, KeyError is raised before any refcount was changed.
+        """
+        cdef Py_buffer keys_buffer
+        cdef Py_ssize_t i, n
+        cdef uint32_t **values = NULL
+        cdef uint32_t refcount
+        cdef array sizes
+        PyObject_GetBuffer(keys, &keys_buffer, PyBUF_SIMPLE)
+        try:
+            values = self._lookup_many(&keys_buffer, &n)
+            for i in range(n):
+                if not values[i]:
+                    raise KeyError(PyBytes_FromStringAndSize(<char *>keys_buffer.buf + i * self.key_size, self.key_size))
+                assert _le32toh(values[i][0]) <= _MAX_VALUE, "invalid reference count"
+            sizes = clone(uint32_array, n, zero=False)
+            for i in range(n):
+                refcount = _le32toh(values[i][0])
+                if refcount != _MAX_VALUE:
+                    refcount += 1
+                values[i][0] = _htole32(refcount)
+                sizes.data.as_uints[i] = _le32toh(values[i][1])
+        finally:
+            free(values)
+            PyBuffer_Release(&keys_buffer)
+        return sizes
+
+    def decref_many(self, keys):
+        """
+        Decrease the refcounts of the concatenated *keys*, return arrays of their new refcounts and of their sizes.
+
+        Like decref() for each key, but if a key is missing, KeyError is raised before any refcount was changed.
+        Entries reaching a refcount of 0 are not deleted.
+        """
+        cdef Py_buffer keys_buffer
+        cdef Py_ssize_t i, j, n
+        cdef uint32_t **values = NULL
+        cdef uint32_t **sorted_values = NULL
+        cdef uint32_t refcount
+        cdef array refcounts, sizes
+        PyObject_GetBuffer(keys, &keys_buffer, PyBUF_SIMPLE)
+        try:
+            values = self._lookup_many(&keys_buffer, &n)
+            for i in range(n):
+                if not values[i]:
+                    raise KeyError(PyBytes_FromStringAndSize(<char *>keys_buffer.buf + i * self.key_size, self.key_size))
+            # the same key might be given more than once, its refcount must suffice for all of them.
+            # sorting the value pointers puts the occurrences of a key next to each other.
+            if n:
+                sorted_values = <uint32_t **>malloc(n * sizeof(uint32_t *))
+                if not sorted_values:
+                    raise MemoryError
+                memcpy(sorted_values, values, n * sizeof(uint32_t *))
+                qsort(sorted_values, n, sizeof(uint32_t *), _compare_pointers)
+            i = 0
+            while i < n:
+                j = i + 1
+                while j < n and sorted_values[j] == sorted_values[i]:
+                    j += 1
+                refcount = _le32toh(sorted_values[i][0])
+                assert refcount <= _MAX_VALUE and (refcount == _MAX_VALUE or refcount >= j - i), "invalid reference count"
+                i = j
+            refcounts = clone(uint32_array, n, zero=False)
+            sizes = clone(uint32_array, n, zero=False)
+            for i in range(n):
+                refcount = _le32toh(values[i][0])
+                if refcount != _MAX_VALUE:
+                    refcount -= 1
+                values[i][0] = _htole32(refcount)
+                refcounts.data.as_uints[i] = refcount
+                sizes.data.as_uints[i] = _le32toh(values[i][1])
+        finally:
+            free(sorted_values)
+            free(values)
+            PyBuffer_Release(&keys_buffer)
+        return refcounts, sizes
+
     def iteritems(self, marker=None):
         cdef const unsigned char *key
         iter = ChunkKeyIterator(self.key_size)
@@ -565,6 +739,40 @@ cdef class ChunkIndex(IndexBase):
                 break
             self._add(key, <uint32_t*> (key + self.key_size))
 
+    def subtract(self, ChunkIndex other):
+        """
+        Subtract the reference counts of *other* from this index (the inverse of merge).
+
+        Entries whose reference count drops to zero are removed. Reference counts fixed to
+        MAX_VALUE are not decreased (see decref).
+
+        *other* must be a subset of this index (with lower or equal reference counts).
+        """
+        cdef unsigned char *key = NULL
+        cdef uint32_t *values
+        cdef uint32_t refcount1, refcount2
+
+        while True:
+            key = hashindex_next_key(other.index, key)
+            if not key:
+                break
+            values = <uint32_t*> hashindex_get(self.index, key)
+            if not values:
+                raise ValueError('subtract: key contained in other but not in self.')
+            refcount1 = _le32toh(values[0])
+            refcount2 = _le32toh((<uint32_t*> (key + self.key_size))[0])
+            assert refcount1 <= _MAX_VALUE, "invalid reference count"
+            assert refcount2 <= _MAX_VALUE, "invalid reference count"
+            if refcount1 == _MAX_VALUE:
+                continue
+            if refcount2 > refcount1:
+                raise ValueError('subtract: reference count in other is higher than in self.')
+            if refcount1 == refcount2:
+                if not hashindex_delete(self.index, key):
+                    raise Exception('hashindex_delete failed')
+            else:
+                values[0] = _htole32(refcount1 - refcount2)
+
 
 cdef class ChunkKeyIterator:
     cdef ChunkIndex idx
@@ -601,6 +809,12 @@ cdef Py_buffer ro_buffer(object data) except *:
 
 
 cdef class CacheSynchronizer:
+    """
+    Feeds item metadata into a ChunkIndex, adding a reference for every content chunk.
+
+    Not thread-safe, but feed() releases the GIL while parsing if possible, so different
+    CacheSynchronizer instances (using different ChunkIndex instances) can work in parallel.
+    """
     cdef ChunkIndex chunks
     cdef CacheSyncCtx *sync
 
@@ -617,7 +831,12 @@ cdef class CacheSynchronizer:
     def feed(self, chunk):
         cdef Py_buffer chunk_buf = ro_buffer(chunk)
         cdef int rc
-        rc = cache_sync_feed(self.sync, chunk_buf.buf, chunk_buf.len)
+        if hashindex_buckets_buffered(self.chunks.index):
+            # resizing the index would release the python buffer backing the buckets, this needs the GIL.
+            rc = cache_sync_feed(self.sync, chunk_buf.buf, chunk_buf.len)
+        else:
+            with nogil:
+                rc = cache_sync_feed(self.sync, chunk_buf.buf, chunk_buf.len)
         PyBuffer_Release(&chunk_buf)
         if not rc:
             error = cache_sync_error(self.sync)
@@ -0,0 +1,222 @@
+import os
+import shutil
+import struct
+import tempfile
+from collections import OrderedDict
+
+from ..checksums import xxh64
+from ..hashindex import ChunkIndex
+from ..logger import create_logger
+from .fs import safe_unlink
+from .parseformat import bin_to_hex
+
+logger = create_logger()
+
+
+class ChunkCache:
+    """
+    Cache for (decrypted) chunk data, limited by a budget of *size* bytes.
+
+    If *disk_size* is given, chunks evicted from memory are spilled to a disk tier in a
+    temporary directory (created in *disk_dir*), which is limited to *disk_size* bytes.
+    Chunks found in the disk tier are moved back into memory when they are accessed.
+    Least recently used chunks are evicted first in both tiers.
+    """
+
+    # 64 bit (8 byte) xxh64 of the chunk data stored in a disk tier file
+    header_fmt = struct.Struct("=8s")
+
+    def __init__(self, size, *, disk_size=0, disk_dir=None):
+        self.size_limit = size
+        self.size = 0
+        self.chunks = OrderedDict()  # id -> data
+        self.disk_size_limit = disk_size
+        self.disk_size = 0
+        self.disk_chunks = OrderedDict()  # id -> size of disk tier file
+        self.basedir = tempfile.mkdtemp(prefix="bork-chunks-", dir=disk_dir) if disk_size else None
+        # Instrumentation
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, id):
+        return id in self.chunks or id in self.disk_chunks
+
+    def __len__(self):
+        return len(self.chunks) + len(self.disk_chunks)
+
+    def get(self, id):
+        """Return the data of chunk *id* or None if it is not cached."""
+        try:
+            data = self.chunks[id]
+        except KeyError:
+            data = self._read_disk(id)
+            if data is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self.put(id, data)
+            return data
+        else:
+            self.hits += 1
+            self.chunks.move_to_end(id)
+            return data
+
+    def put(self, id, data):
+        """Add (or refresh) the data of chunk *id*."""
+        if id in self.chunks:
+            self.chunks.move_to_end(id)
+            return
+        if len(data) > self.size_limit:
+            return  # would evict everything else and still not fit
+        self.chunks[id] = data
+        self.size += len(data)
+        while self.size > self.size_limit:
+            evicted_id, evicted_data = self.chunks.popitem(last=False)
+            self.size -= len(evicted_data)
+            self._write_disk(evicted_id, evicted_data)
+
+    def _filename(self, id):
+        return os.path.join(self.basedir, bin_to_hex(id))
+
+    def _read_disk(self, id):
+        try:
+            file_size = self.disk_chunks.pop(id)
+        except KeyError:
+            return None
+        self.disk_size -= file_size
+        filename = self._filename(id)
+        try:
+            with open(filename, "rb") as fd:
+                data = fd.read()
+        except OSError as err:
+            logger.warning("chunk cache: could not read cached chunk %s (%s), fetching it again.", bin_to_hex(id), err)
+            data = None
+        try:
+            safe_unlink(filename)
+        except FileNotFoundError:
+            pass
+        if data is None:
+            return None
+        data = memoryview(data)
+        checksum = bytes(data[: self.header_fmt.size])
+        data = bytes(data[self.header_fmt.size :])
+        if len(checksum) != self.header_fmt.size or checksum != xxh64(data):
+            # the disk tier is just a cache, treat a corrupted entry like a cache miss.
+            logger.warning("chunk cache: detected corrupted cached chunk %s, fetching it again.", bin_to_hex(id))
+            return None
+        return data
+
+    def _write_disk(self, id, data):
+        file_size = self.header_fmt.size + len(data)
+        if self.basedir is None or file_size > self.disk_size_limit:
+            self.evictions += 1
+            return
+        while self.disk_size + file_size > self.disk_size_limit:
+            evicted_id, evicted_size = self.disk_chunks.popitem(last=False)
+            self.disk_size -= evicted_size
+            safe_unlink(self._filename(evicted_id))
+            self.evictions += 1
+        filename = self._filename(id)
+        try:
+            with open(filename, "wb") as fd:
+                fd.write(self.header_fmt.pack(xxh64(data)))
+                fd.write(data)
+        except OSError:
+            # e.g. ENOSPC - the disk tier is just a cache, so forget about this chunk.
+            try:
+                safe_unlink(filename)
+            except FileNotFoundError:
+                pass  # open() could have failed as well
+            self.evictions += 1
+        else:
+            self.disk_chunks[id] = file_size
+            self.disk_size += file_size
+
+    def clear(self):
+        self.chunks.clear()
+        self.size = 0
+        for id in self.disk_chunks:
+            safe_unlink(self._filename(id))
+        self.disk_chunks.clear()
+        self.disk_size = 0
+
+    def close(self):
+        self.clear()
+        if self.basedir is not None:
+            shutil.rmtree(self.basedir)
+            self.basedir = None
+
+
+class ExtractChunkCache:
+    """
+    Cache for (decrypted) chunk data used while extracting, limited by a budget of *size* bytes.
+
+    The references to chunks which will be extracted are counted in advance (see add_refs), so a
+    chunk is only kept while it is still referenced later and it is dropped as soon as its last
+    reference was used. If the budget is exceeded, the least recently used chunks are evicted.
+    """
+
+    def __init__(self, size):
+        self.size_limit = size
+        self.size = 0
+        self.chunks = OrderedDict()  # id -> data
+        self.refs = ChunkIndex()  # id -> (number of references not used yet, 0)
+        # Instrumentation
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, id):
+        return id in self.chunks
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add_refs(self, ids):
+        """Count a (future) reference to each chunk of *ids*."""
+        for id in ids:
+            self.refs.add(id, 1, 0)
+
+    def get(self, id):
+        """Return the data of chunk *id* or None if it is not cached. This does not use a reference."""
+        data = self.chunks.get(id)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def use(self, id, data):
+        """
+        Use a reference to chunk *id* and keep its *data* cached if it is referenced again later.
+
+        *data* might be None if the chunk was not needed after all.
+        """
+        entry = self.refs.get(id)
+        if entry is None or entry.refcount <= 1:
+            # no more references, this chunk is not needed any more.
+            if entry is not None:
+                del self.refs[id]
+            data = self.chunks.pop(id, None)
+            if data is not None:
+                self.size -= len(data)
+            return
+        self.refs.decref(id)
+        if id in self.chunks:
+            self.chunks.move_to_end(id)
+            return
+        if data is None or len(data) > self.size_limit:
+            return  # nothing to cache or would evict everything else and still not fit
+        self.chunks[id] = data
+        self.size += len(data)
+        while self.size > self.size_limit:
+            evicted_id, evicted_data = self.chunks.popitem(last=False)
+            self.size -= len(evicted_data)
+            self.evictions += 1
+
+    def clear(self):
+        self.chunks.clear()
+        self.size = 0
+        self.refs.clear()
@@ -38,3 +38,7 @@ class IntegrityError(ErrorWithTraceback, IntegrityErrorBase):
 
 class DecompressionError(IntegrityError):
     """Decompression error: {}"""
+
+
+class DictionaryMissingError(DecompressionError):
+    """Decompression error: zstd dictionary {} is missing."""
@@ -1,5 +1,6 @@
 import errno
 import hashlib
+import mmap
 import os
 import posixpath
 import re
@@ -427,6 +428,73 @@ def safe_unlink(path):
             os.unlink(path)
 
 
+class MappedFile:
+    """
+    Read-only, file-like access to a memory-mapped file.
+
+    read() returns memoryviews into the mapping instead of copying the data into new bytes objects.
+    Only the pages actually accessed are read from disk. The memoryviews stay valid after close(),
+    the mapping goes away with the last one. The file must not be rewritten in place meanwhile.
+
+    With *copy_on_write*, the memoryviews are writable. Changes are private, they never reach the file.
+    """
+
+    def __init__(self, filename, *, copy_on_write=False):
+        access = mmap.ACCESS_COPY if copy_on_write else mmap.ACCESS_READ
+        with open(filename, "rb") as fd:
+            self.size = os.fstat(fd.fileno()).st_size
+            # note: empty files can't be mapped.
+            self.mmap = mmap.mmap(fd.fileno(), 0, access=access) if self.size else None
+        self.view = memoryview(self.mmap if self.mmap is not None else b"")
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.view.release()
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # there are still memoryviews of the data somewhere, the mapping goes away with the last one.
+                pass
+            self.mmap = None
+
+    def cursor(self):
+        """
+        Return a new MappedFile for the same mapping, with its own position.
+
+        The cursor keeps the mapping alive on its own, it stays usable after this MappedFile is closed.
+        """
+        cursor = object.__new__(type(self))
+        cursor.size = self.size
+        cursor.mmap = None  # closing the cursor must not close the mapping
+        cursor.view = self.view[:]
+        cursor.pos = 0
+        return cursor
+
+    def read(self, size=-1):
+        start = min(self.pos, self.size)
+        end = self.size if size is None or size < 0 else min(start + size, self.size)
+        self.pos = end
+        return self.view[start:end]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
 def dash_open(path, mode):
     assert "+" not in mode  # the streams are either r or w, but never both
     if path == "-":
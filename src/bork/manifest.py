@@ -13,7 +13,8 @@
 from .helpers.datastruct import StableDict
 from .helpers.parseformat import bin_to_hex
 from .helpers.time import parse_timestamp, calculate_relative_offset, archive_ts_now
-from .helpers.errors import Error
+from .helpers.errors import Error, IntegrityErrorBase
+from .compress import add_zstd_dict
 from .patterns import get_regex_from_pattern
 from .repoobj import RepoObj
 
@@ -216,7 +217,10 @@ class Operation(enum.Enum):
 
     NO_OPERATION_CHECK: Sequence[Operation] = tuple()
 
-    SUPPORTED_REPO_FEATURES: frozenset[str] = frozenset([])
+    # the items metadata stream chunks might be compressed using a zstd dictionary, see add_metadata_dict.
+    METADATA_DICT_FEATURE = "zstd-metadata-dict"
+
+    SUPPORTED_REPO_FEATURES: frozenset[str] = frozenset([METADATA_DICT_FEATURE])
 
     MANIFEST_ID = b"\0" * 32
 
@@ -264,8 +268,43 @@ def load(cls, repository, operations, key=None, *, ro_cls=RepoObj):
         manifest.item_keys |= frozenset(m.config.get("item_keys", []))  # new location of item_keys since bork2
         manifest.item_keys |= frozenset(m.get("item_keys", []))  # legacy: bork 1.x: item_keys not in config yet
         manifest.check_repository_compatibility(operations)
+        manifest.load_metadata_dicts()
         return manifest
 
+    def load_metadata_dicts(self):
+        """Load the zstd dictionaries for the items metadata stream chunks referenced by the config."""
+        from .repository import Repository
+
+        # all dictionaries ever used are kept for decompression, the most recent one is used for compression.
+        for id in self.config.get("metadata_dicts", []):
+            try:
+                _, data = self.repo_objs.parse(id, self.repository.get(id))
+                self.repo_objs.metadata_dict = add_zstd_dict(data)
+            except (Repository.ObjectNotFound, IntegrityErrorBase, ValueError) as err:
+                logger.error("Could not load metadata dictionary %s: %r", bin_to_hex(id), err)
+
+    def add_metadata_dict(self, data, id=None):
+        """
+        Use the zstd dictionary *data* for compressing the items metadata stream chunks from now on.
+
+        The dictionary is stored as a repository object, unless its *id* is given (it is already stored).
+        As older clients can not read the items compressed using it, this adds a mandatory feature for all
+        operations (older clients must neither add archives nor delete anything, as they would consider the
+        dictionary an orphan). The manifest needs to be written afterwards.
+        """
+        metadata_dict = add_zstd_dict(data)
+        if id is None:
+            id = self.repo_objs.id_hash(data)
+            self.repository.put(id, self.repo_objs.format(id, {}, data))
+        self.config["metadata_dicts"] = list(self.config.get("metadata_dicts", [])) + [id]
+        feature_flags = self.config.setdefault("feature_flags", {})
+        for operation in self.Operation:
+            requirements = feature_flags.setdefault(operation.value, {})
+            mandatory = list(requirements.get("mandatory", []))
+            if self.METADATA_DICT_FEATURE not in mandatory:
+                requirements["mandatory"] = mandatory + [self.METADATA_DICT_FEATURE]
+        self.repo_objs.metadata_dict = metadata_dict
+
     def check_repository_compatibility(self, operations):
         for operation in operations:
             assert isinstance(operation, self.Operation)
@@ -16,6 +16,7 @@
     from .linux import acl_get, acl_set
     from .linux import set_flags, get_flags
     from .linux import SyncFile
+    from .linux import clone_file
     from .posix import process_alive, local_pid_alive
     from .posix import swidth
     from .posix import get_errno
@@ -26,6 +27,7 @@
     from .freebsd import acl_get, acl_set
     from .base import set_flags, get_flags
     from .base import SyncFile
+    from .base import clone_file
     from .posix import process_alive, local_pid_alive
     from .posix import swidth
     from .posix import get_errno
@@ -36,6 +38,7 @@
     from .darwin import acl_get, acl_set
     from .base import set_flags, get_flags
     from .base import SyncFile
+    from .base import clone_file
     from .posix import process_alive, local_pid_alive
     from .posix import swidth
     from .posix import get_errno
@@ -47,6 +50,7 @@
     from .base import acl_get, acl_set
     from .base import set_flags, get_flags
     from .base import SyncFile
+    from .base import clone_file
     from .posix import process_alive, local_pid_alive
     from .posix import swidth
     from .posix import get_errno
@@ -58,6 +62,7 @@
     from .base import acl_get, acl_set
     from .base import set_flags, get_flags
     from .base import SyncFile
+    from .base import clone_file
     from .windows import process_alive, local_pid_alive
     from .base import swidth
     from .windows import uid2user, user2uid, gid2group, group2gid, getosusername
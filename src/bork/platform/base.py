@@ -113,6 +113,23 @@ def sync_dir(path):
         os.close(fd)
 
 
+def clone_file(src_fd, dst_fd, size):
+    """
+    Copy the first *size* bytes of file *src_fd* into the empty file *dst_fd* (within the kernel).
+
+    Platform implementations may share the data blocks of both files (reflink) instead of copying them.
+    Raises OSError if this is not supported, *dst_fd* might have been partially written then.
+    """
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.EOPNOTSUPP, "copy_file_range is not supported")
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+        if copied == 0:
+            raise OSError(errno.EIO, "source file is shorter than expected")
+        offset += copied
+
+
 def safe_fadvise(fd, offset, len, advice):
     if hasattr(os, "posix_fadvise"):
         advice = getattr(os, "POSIX_FADV_" + advice)
@@ -175,6 +192,40 @@ def __exit__(self, exc_type, exc_val, exc_tb):
     def write(self, data):
         self.f.write(data)
 
+    def copy_range(self, src_fd, offset, size):
+        """
+        Append *size* bytes at *offset* of the file *src_fd*, byte-for-byte.
+
+        The data is copied within the kernel (copy_file_range) if supported, otherwise it is read and written.
+        """
+        self.f.flush()
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(src_fd, self.fd, size - copied, offset + copied)
+                    if n == 0:
+                        raise OSError(errno.EIO, "source file is shorter than expected")
+                    copied += n
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+        # the file position was moved by copy_file_range, let the python file object know about it.
+        self.f.seek(0, os.SEEK_END)
+        while copied < size:
+            os.lseek(src_fd, offset + copied, os.SEEK_SET)
+            data = os.read(src_fd, min(size - copied, 16 * 1024 * 1024))
+            if not data:
+                raise OSError(errno.EIO, "source file is shorter than expected")
+            self.f.write(data)
+            copied += len(data)
+
+    def flush(self):
+        """
+        Make everything written so far visible to readers of the file. This does not make it durable, see sync().
+        """
+        self.f.flush()
+
     def sync(self):
         """
         Synchronize file contents. Everything written prior to sync() must become durable before anything written
@@ -8,6 +8,7 @@ from ..helpers import workarounds
 from ..helpers import safe_decode, safe_encode
 from .base import SyncFile as BaseSyncFile
 from .base import safe_fadvise
+from .base import clone_file as base_clone_file
 from .xattr import _listxattr_inner, _getxattr_inner, _setxattr_inner, split_string0
 try:
     from .syncfilerange import sync_file_range, SYNC_FILE_RANGE_WRITE, SYNC_FILE_RANGE_WAIT_BEFORE, SYNC_FILE_RANGE_WAIT_AFTER
@@ -57,6 +58,7 @@ cdef extern from "linux/fs.h":
     # ioctls
     int FS_IOC_SETFLAGS
     int FS_IOC_GETFLAGS
+    int FICLONE
 
     # inode flags
     int FS_NODUMP_FL
@@ -176,6 +178,15 @@ def get_flags(path, st, fd=None):
     return bsd_flags
 
 
+def clone_file(src_fd, dst_fd, size):
+    """
+    Like base.clone_file, but first try to share the data blocks (reflink, e.g. on btrfs or xfs).
+    """
+    if ioctl(dst_fd, FICLONE, <int>src_fd) == 0:
+        return
+    base_clone_file(src_fd, dst_fd, size)
+
+
 def acl_use_local_uid_gid(acl):
     """Replace the user/group field with the local uid/gid if possible
     """
@@ -345,6 +356,14 @@ else:
 
         def write(self, data):
             self.offset += self.f.write(data)
+            self._write_out()
+
+        def copy_range(self, src_fd, offset, size):
+            super().copy_range(src_fd, offset, size)
+            self.offset += size
+            self._write_out()
+
+        def _write_out(self):
             offset = self.offset & ~PAGE_MASK
             if offset >= self.last_sync + self.write_window:
                 self.f.flush()
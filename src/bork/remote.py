@@ -13,8 +13,11 @@
 import sys
 import tempfile
 import textwrap
+import threading
 import time
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from subprocess import Popen, PIPE
 
 import bork.logger
@@ -42,7 +45,12 @@
 BORK_VERSION = parse_version(__version__)
 MSGID, MSG, ARGS, RESULT, LOG = "i", "m", "a", "r", "l"
 
-MAX_INFLIGHT = 100
+MAX_INFLIGHT = 100  # max. number of requests in flight, minimum for get requests
+MAX_INFLIGHT_GET = 10000  # max. number of get requests in flight
+MAX_INFLIGHT_GET_BYTES = 256 * 1024 * 1024  # max. expected size of the responses to get requests in flight
+GET_MANY_BATCH = 100  # max. number of ids in a get_many request
+SERVE_THREADS = 8  # max. number of read-only requests the server executes concurrently
+SERVE_QUEUED = 4 * SERVE_THREADS  # max. number of read-only requests the server takes in before they are done
 
 RATELIMIT_PERIOD = 0.1
 
@@ -113,6 +121,12 @@ def __init__(self, data):
 # to be added.
 # When parameters are removed, they need to be preserved as defaulted parameters on the client stubs so that older
 # servers still get compatible input.
+#
+# Batched calls (get_many) are expanded into the single calls they stand for by RepositoryServer.expand_call, the
+# client only sends them if the server version is recent enough.
+#
+# Responses may arrive in a different order than the calls were sent: read-only calls are executed concurrently by the
+# server (see RepositoryServer.concurrent_call), the client must match the responses to the calls by msgid.
 
 
 class RepositoryServer:  # pragma: no cover
@@ -150,6 +164,7 @@ def __init__(self, restrict_to_paths, restrict_to_repositories, append_only, sto
         self.append_only = append_only
         self.storage_quota = storage_quota
         self.client_version = None  # we update this after client sends version information
+        self.send_lock = threading.Lock()
         if use_socket is False:
             self.socket_path = None
         elif use_socket is True:  # --socket
@@ -170,8 +185,80 @@ def send_queued_log(self):
             except queue.Empty:
                 break
             else:
-                msg = msgpack.packb({LOG: lr_dict})
-                os_write(self.stdout_fd, msg)
+                self.send(msgpack.packb({LOG: lr_dict}))
+
+    def send(self, msg):
+        # responses of concurrent calls are sent by the I/O threads, do not let the messages interleave.
+        with self.send_lock:
+            os_write(self.stdout_fd, msg)
+
+    def concurrent_call(self, method, args):
+        """
+        Return whether the call only reads from the repository and may be executed by an I/O thread.
+
+        The index must be open already (calls open it lazily), flags must not be set and a scan is only
+        continued (starting a scan checks the transaction).
+        """
+        if self.repository is None or not self.repository.index:
+            return False
+        if method in ("get", "list"):
+            return True
+        if method in ("flags", "flags_many"):
+            return args.get("value") is None
+        if method == "scan":
+            return args.get("state") is not None
+        return False
+
+    def execute(self, msgid, f, args):
+        """Execute the call f(**args) and send the response (or the exception) for *msgid*."""
+        try:
+            res = f(**args)
+        except BaseException as e:
+            self.send(self.pack_exception(msgid, e))
+        else:
+            self.send(msgpack.packb({MSGID: msgid, RESULT: res}))
+
+    def pack_exception(self, msgid, e):
+        ex_short = traceback.format_exception_only(e.__class__, e)
+        ex_full = traceback.format_exception(*sys.exc_info())
+        ex_trace = True
+        if isinstance(e, Error):
+            ex_short = [e.get_message()]
+            ex_trace = e.traceback
+        if isinstance(e, (Repository.DoesNotExist, Repository.AlreadyExists, PathNotAllowed)):
+            # These exceptions are reconstructed on the client end in
+            # RemoteRepository.call_many(), and will be handled just like locally raised
+            # exceptions. Suppress the remote traceback for these, except
+            # ErrorWithTraceback, which should always display a traceback.
+            pass
+        else:
+            logging.debug("\n".join(ex_full))
+
+        sys_info = sysinfo()
+        try:
+            return msgpack.packb(
+                {
+                    MSGID: msgid,
+                    "exception_class": e.__class__.__name__,
+                    "exception_args": e.args,
+                    "exception_full": ex_full,
+                    "exception_short": ex_short,
+                    "exception_trace": ex_trace,
+                    "sysinfo": sys_info,
+                }
+            )
+        except TypeError:
+            return msgpack.packb(
+                {
+                    MSGID: msgid,
+                    "exception_class": e.__class__.__name__,
+                    "exception_args": [x if isinstance(x, (str, bytes, int)) else None for x in e.args],
+                    "exception_full": ex_full,
+                    "exception_short": ex_short,
+                    "exception_trace": ex_trace,
+                    "sysinfo": sys_info,
+                }
+            )
 
     def serve(self):
         def inner_serve():
@@ -182,89 +269,68 @@ def inner_serve():
 
             unpacker = get_limited_unpacker("server")
             shutdown_serve = False
-            while True:
-                # before processing any new RPCs, send out all pending log output
-                self.send_queued_log()
-
-                if shutdown_serve:
-                    # shutdown wanted! get out of here after sending all log output.
-                    assert self.repository is None
-                    return
-
-                # process new RPCs
-                r, w, es = select.select([self.stdin_fd], [], [], 10)
-                if r:
-                    data = os.read(self.stdin_fd, BUFSIZE)
-                    if not data:
+            # read-only calls are executed by the I/O threads, their responses are sent as soon as they are done,
+            # so they may arrive out of order (the client matches them by msgid). all other calls are executed
+            # here after the calls in flight are done, so they never run concurrently with anything else.
+            inflight = set()
+
+            def finish(futures):
+                for future in futures:
+                    inflight.discard(future)
+                    future.result()  # errors other than those sent as a response end the server
+
+            with ThreadPoolExecutor(max_workers=SERVE_THREADS, thread_name_prefix="serve") as executor:
+                while True:
+                    # before processing any new RPCs, send out all pending log output
+                    self.send_queued_log()
+
+                    if shutdown_serve:
+                        # shutdown wanted! get out of here after sending all log output.
+                        finish(wait(inflight).done)
+                        assert self.repository is None
+                        return
+
+                    # process new RPCs
+                    r, w, es = select.select([self.stdin_fd], [], [], 10)
+                    if r:
+                        data = os.read(self.stdin_fd, BUFSIZE)
+                        if not data:
+                            shutdown_serve = True
+                            continue
+                        unpacker.feed(data)
+                        for unpacked in unpacker:
+                            if isinstance(unpacked, dict):
+                                msgid = unpacked[MSGID]
+                                method = unpacked[MSG]
+                                args = unpacked[ARGS]
+                            else:
+                                finish(wait(inflight).done)
+                                if self.repository is not None:
+                                    self.repository.close()
+                                raise UnexpectedRPCDataFormatFromClient(__version__)
+                            # a batched call gets expanded into the calls it stands for
+                            for msgid, method, args in self.expand_call(msgid, method, args):
+                                try:
+                                    if method not in self.rpc_methods:
+                                        raise InvalidRPCMethod(method)
+                                    try:
+                                        f = getattr(self, method)
+                                    except AttributeError:
+                                        f = getattr(self.repository, method)
+                                    args = self.filter_args(f, args)
+                                except BaseException as e:
+                                    self.send(self.pack_exception(msgid, e))
+                                    continue
+                                if self.concurrent_call(method, args):
+                                    if len(inflight) >= SERVE_QUEUED:
+                                        finish(wait(inflight, return_when=FIRST_COMPLETED).done)
+                                    inflight.add(executor.submit(self.execute, msgid, f, args))
+                                else:
+                                    finish(wait(inflight).done)
+                                    self.execute(msgid, f, args)
+                    if es:
                         shutdown_serve = True
                         continue
-                    unpacker.feed(data)
-                    for unpacked in unpacker:
-                        if isinstance(unpacked, dict):
-                            msgid = unpacked[MSGID]
-                            method = unpacked[MSG]
-                            args = unpacked[ARGS]
-                        else:
-                            if self.repository is not None:
-                                self.repository.close()
-                            raise UnexpectedRPCDataFormatFromClient(__version__)
-                        try:
-                            if method not in self.rpc_methods:
-                                raise InvalidRPCMethod(method)
-                            try:
-                                f = getattr(self, method)
-                            except AttributeError:
-                                f = getattr(self.repository, method)
-                            args = self.filter_args(f, args)
-                            res = f(**args)
-                        except BaseException as e:
-                            ex_short = traceback.format_exception_only(e.__class__, e)
-                            ex_full = traceback.format_exception(*sys.exc_info())
-                            ex_trace = True
-                            if isinstance(e, Error):
-                                ex_short = [e.get_message()]
-                                ex_trace = e.traceback
-                            if isinstance(e, (Repository.DoesNotExist, Repository.AlreadyExists, PathNotAllowed)):
-                                # These exceptions are reconstructed on the client end in RemoteRepository.call_many(),
-                                # and will be handled just like locally raised exceptions. Suppress the remote traceback
-                                # for these, except ErrorWithTraceback, which should always display a traceback.
-                                pass
-                            else:
-                                logging.debug("\n".join(ex_full))
-
-                            sys_info = sysinfo()
-                            try:
-                                msg = msgpack.packb(
-                                    {
-                                        MSGID: msgid,
-                                        "exception_class": e.__class__.__name__,
-                                        "exception_args": e.args,
-                                        "exception_full": ex_full,
-                                        "exception_short": ex_short,
-                                        "exception_trace": ex_trace,
-                                        "sysinfo": sys_info,
-                                    }
-                                )
-                            except TypeError:
-                                msg = msgpack.packb(
-                                    {
-                                        MSGID: msgid,
-                                        "exception_class": e.__class__.__name__,
-                                        "exception_args": [
-                                            x if isinstance(x, (str, bytes, int)) else None for x in e.args
-                                        ],
-                                        "exception_full": ex_full,
-                                        "exception_short": ex_short,
-                                        "exception_trace": ex_trace,
-                                        "sysinfo": sys_info,
-                                    }
-                                )
-                            os_write(self.stdout_fd, msg)
-                        else:
-                            os_write(self.stdout_fd, msgpack.packb({MSGID: msgid, RESULT: res}))
-                if es:
-                    shutdown_serve = True
-                    continue
 
         if self.socket_path:  # server for socket:// connections
             try:
@@ -302,6 +368,18 @@ def inner_serve():
             self.stdout_fd = sys.stdout.fileno()
             inner_serve()
 
+    def expand_call(self, msgid, method, args):
+        """
+        Return the (msgid, method, args) tuples of the calls a received call stands for.
+
+        A get_many call with N ids stands for N get calls using the msgids msgid .. msgid + N - 1,
+        so the client gets the same responses as if it had sent these calls.
+        """
+        if method == "get_many" and isinstance(args, dict) and isinstance(args.get("ids"), (list, tuple)):
+            read_data = args.get("read_data", True)
+            return [(msgid + i, "get", {"id": id, "read_data": read_data}) for i, id in enumerate(args["ids"])]
+        return [(msgid, method, args)]
+
     def negotiate(self, client_data):
         if isinstance(client_data, dict):
             self.client_version = client_data["client_version"]
@@ -421,6 +499,46 @@ def write(self, fd, to_send):
         return written
 
 
+class InflightWindow:
+    """
+    Adaptive limit for the number of get requests in flight (sent, but not answered yet).
+
+    To keep the connection busy, the responses in flight need to fill the bandwidth-delay product
+    of the connection. This is estimated from the minimum round trip time and the maximum delivery
+    rate observed for get requests, like TCP BBR does it.
+    """
+
+    def __init__(self, minimum=MAX_INFLIGHT, maximum=MAX_INFLIGHT_GET, max_bytes=MAX_INFLIGHT_GET_BYTES):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_bytes = max_bytes
+        self.size = minimum
+        self.sent_at = {}  # msgid -> (monotonic time, rx_bytes) when the request was sent
+        self.min_rtt = None
+        self.max_rate = 0.0  # bytes/s
+        self.avg_response_size = None
+
+    def sent(self, msgid, rx_bytes):
+        self.sent_at[msgid] = time.monotonic(), rx_bytes
+
+    def received(self, msgid, rx_bytes, response_size):
+        try:
+            sent_time, sent_rx_bytes = self.sent_at.pop(msgid)
+        except KeyError:
+            return  # not a get request
+        rtt = max(time.monotonic() - sent_time, 1e-6)
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.max_rate = max(self.max_rate, (rx_bytes - sent_rx_bytes) / rtt)
+        if self.avg_response_size is None:
+            self.avg_response_size = response_size
+        else:
+            self.avg_response_size = 0.9 * self.avg_response_size + 0.1 * response_size
+        response_size = max(self.avg_response_size, 1024)
+        # twice the bandwidth-delay product, so the connection does not idle when the rate increases.
+        size = min(2 * self.max_rate * self.min_rtt, self.max_bytes) / response_size
+        self.size = max(self.minimum, min(self.maximum, int(size)))
+
+
 def api(*, since, **kwargs_decorator):
     """Check version requirements and use self.call to do the remote method call.
 
@@ -533,7 +651,7 @@ def __init__(
         args=None,
     ):
         self.location = self._location = location
-        self.preload_ids = []
+        self.preload_ids = deque()
         self.msgid = 0
         self.rx_bytes = 0
         self.tx_bytes = 0
@@ -545,6 +663,7 @@ def __init__(
         self.responses = {}
         self.async_responses = {}
         self.shutdown_time = None
+        self.inflight = InflightWindow()
         self.ratelimit = SleepingBandwidthLimiter(args.upload_ratelimit * 1024 if args and args.upload_ratelimit else 0)
         self.upload_buffer_size_limit = args.upload_buffer * 1024 * 1024 if args and args.upload_buffer else 0
         self.unpacker = get_limited_unpacker("client")
@@ -739,11 +858,27 @@ def send_buffer():
                         raise
 
         def pop_preload_msgid(chunkid):
-            msgid = self.chunkid_to_msgids[chunkid].pop(0)
+            msgid = self.chunkid_to_msgids[chunkid].popleft()
             if not self.chunkid_to_msgids[chunkid]:
                 del self.chunkid_to_msgids[chunkid]
             return msgid
 
+        def send_get(ids, read_data=True):
+            # send get requests for ids, return their msgids.
+            # newer servers get one get_many request, they respond like to consecutive get requests.
+            msgids = range(self.msgid + 1, self.msgid + 1 + len(ids))
+            self.msgid += len(ids)
+            if batched_get:
+                args = {"ids": list(ids), "read_data": read_data}
+                self.to_send.push_back(msgpack.packb({MSGID: msgids[0], MSG: "get_many", ARGS: args}))
+            else:
+                for msgid, id in zip(msgids, ids):
+                    args = {"id": id, "read_data": read_data}
+                    self.to_send.push_back(msgpack.packb({MSGID: msgid, MSG: "get", ARGS: args}))
+            for msgid in msgids:
+                self.inflight.sent(msgid, self.rx_bytes)
+            return msgids
+
         def handle_error(unpacked):
             if "exception_class" not in unpacked:
                 return
@@ -770,8 +905,11 @@ def handle_error(unpacked):
             else:
                 raise self.RPCError(unpacked)
 
-        calls = list(calls)
-        waiting_for = []
+        calls = deque(calls)
+        waiting_for = deque()
+        # get_many was added in 2.0.0b8
+        batched_get = self.server_version is not None and self.server_version >= parse_version("2.0.0b8")
+        max_inflight = MAX_INFLIGHT
         maximum_to_send = 0 if wait else self.upload_buffer_size_limit
         send_buffer()  # Try to send data, as some cases (async_response) will never try to send data otherwise.
         while wait or calls:
@@ -787,7 +925,7 @@ def handle_error(unpacked):
             while waiting_for:
                 try:
                     unpacked = self.responses.pop(waiting_for[0])
-                    waiting_for.pop(0)
+                    waiting_for.popleft()
                     handle_error(unpacked)
                     yield unpacked[RESULT]
                     if not waiting_for and not calls:
@@ -808,7 +946,9 @@ def handle_error(unpacked):
                     else:
                         handle_error(unpacked)
                         yield unpacked[RESULT]
-            if self.to_send or ((calls or self.preload_ids) and len(waiting_for) < MAX_INFLIGHT):
+            if cmd == "get":
+                max_inflight = self.inflight.size
+            if self.to_send or ((calls or self.preload_ids) and len(waiting_for) < max_inflight):
                 w_fds = [self.stdin_fd]
             else:
                 w_fds = []
@@ -835,6 +975,8 @@ def handle_error(unpacked):
                             continue
 
                         msgid = unpacked[MSGID]
+                        result = unpacked.get(RESULT)
+                        self.inflight.received(msgid, self.rx_bytes, len(result) if isinstance(result, bytes) else 0)
                         if msgid in self.ignore_responses:
                             self.ignore_responses.remove(msgid)
                             # async methods never return values, but may raise exceptions.
@@ -872,27 +1014,38 @@ def handle_error(unpacked):
                 while (
                     (len(self.to_send) <= maximum_to_send)
                     and (calls or self.preload_ids)
-                    and len(waiting_for) < MAX_INFLIGHT
+                    and len(waiting_for) < max_inflight
                 ):
                     if calls:
                         if is_preloaded:
                             assert cmd == "get", "is_preload is only supported for 'get'"
                             if calls[0]["id"] in self.chunkid_to_msgids:
-                                waiting_for.append(pop_preload_msgid(calls.pop(0)["id"]))
-                        else:
-                            args = calls.pop(0)
-                            if cmd == "get" and args["id"] in self.chunkid_to_msgids:
-                                waiting_for.append(pop_preload_msgid(args["id"]))
+                                waiting_for.append(pop_preload_msgid(calls.popleft()["id"]))
+                        elif cmd == "get":
+                            if calls[0]["id"] in self.chunkid_to_msgids:
+                                waiting_for.append(pop_preload_msgid(calls.popleft()["id"]))
                             else:
-                                self.msgid += 1
-                                waiting_for.append(self.msgid)
-                                self.to_send.push_back(msgpack.packb({MSGID: self.msgid, MSG: cmd, ARGS: args}))
+                                # request the following gets (that were not preloaded) at once
+                                read_data = calls[0].get("read_data", True)
+                                batch_size = min(GET_MANY_BATCH if batched_get else 1, max_inflight - len(waiting_for))
+                                ids = []
+                                while calls and len(ids) < batch_size:
+                                    args = calls[0]
+                                    if args["id"] in self.chunkid_to_msgids or args.get("read_data", True) != read_data:
+                                        break
+                                    ids.append(calls.popleft()["id"])
+                                waiting_for.extend(send_get(ids, read_data))
+                        else:
+                            args = calls.popleft()
+                            self.msgid += 1
+                            waiting_for.append(self.msgid)
+                            self.to_send.push_back(msgpack.packb({MSGID: self.msgid, MSG: cmd, ARGS: args}))
                     if not self.to_send and self.preload_ids:
-                        chunk_id = self.preload_ids.pop(0)
-                        args = {"id": chunk_id}
-                        self.msgid += 1
-                        self.chunkid_to_msgids.setdefault(chunk_id, []).append(self.msgid)
-                        self.to_send.push_back(msgpack.packb({MSGID: self.msgid, MSG: "get", ARGS: args}))
+                        ids = [self.preload_ids.popleft()]
+                        while batched_get and self.preload_ids and len(ids) < GET_MANY_BATCH:
+                            ids.append(self.preload_ids.popleft())
+                        for chunk_id, msgid in zip(ids, send_get(ids)):
+                            self.chunkid_to_msgids.setdefault(chunk_id, deque()).append(msgid)
 
                 send_buffer()
         self.ignore_responses |= set(waiting_for)  # we lose order here
@@ -911,16 +1064,21 @@ def open(
     def info(self):
         """actual remoting is done via self.call in the @api decorator"""
 
-    @api(since=parse_version("1.0.0"), max_duration={"since": parse_version("1.2.0a4"), "previously": 0})
-    def check(self, repair=False, max_duration=0):
+    @api(
+        since=parse_version("1.0.0"),
+        max_duration={"since": parse_version("1.2.0a4"), "previously": 0},
+        workers={"since": parse_version("2.0.0b8"), "previously": 1, "dontcare": True},
+    )
+    def check(self, repair=False, max_duration=0, workers=1):
         """actual remoting is done via self.call in the @api decorator"""
 
     @api(
         since=parse_version("1.0.0"),
         compact={"since": parse_version("1.2.0a0"), "previously": True, "dontcare": True},
         threshold={"since": parse_version("1.2.0a8"), "previously": 0.1, "dontcare": True},
+        max_duration={"since": parse_version("2.0.0b8"), "previously": 0, "dontcare": True},
     )
-    def commit(self, compact=True, threshold=0.1):
+    def commit(self, compact=True, threshold=0.1, max_duration=0):
         """actual remoting is done via self.call in the @api decorator"""
 
     @api(since=parse_version("1.0.0"))
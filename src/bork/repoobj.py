@@ -1,7 +1,7 @@
 from struct import Struct
 
 from .helpers import msgpack, workarounds
-from .compress import Compressor, LZ4_COMPRESSOR, get_compressor
+from .compress import Compressor, LZ4_COMPRESSOR, ZSTD, Auto, get_compressor
 
 # workaround for lost passphrase or key in "authenticated" or "authenticated-blake2" mode
 AUTHENTICATED_NO_KEY = "authenticated_no_key" in workarounds
@@ -22,6 +22,24 @@ def __init__(self, key):
         # Some commands write new chunks (e.g. rename) but don't take a --compression argument. This duplicates
         # the default used by those commands who do take a --compression argument.
         self.compressor = LZ4_COMPRESSOR
+        # zstd dictionary (ZstdDict) for the items metadata stream chunks, set by the Manifest.
+        self.metadata_dict = None
+
+    @property
+    def metadata_zstd(self):
+        """the ZSTD compressor used (also if used by auto), None if zstd is not used"""
+        compressor = self.compressor
+        if isinstance(compressor, Auto):
+            compressor = compressor.compressor
+        return compressor if isinstance(compressor, ZSTD) else None
+
+    @property
+    def metadata_compressor(self):
+        """the compressor for the items metadata stream chunks, None if the usual compressor is used"""
+        compressor = self.metadata_zstd
+        if compressor is None or self.metadata_dict is None:
+            return None
+        return get_compressor("zstd", level=compressor.level, zstd_dict=self.metadata_dict)
 
     def id_hash(self, data: bytes) -> bytes:
         return self.key.id_hash(data)
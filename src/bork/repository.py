@@ -1,13 +1,18 @@
 import errno
+import io
 import mmap
 import os
 import shutil
 import stat
 import struct
+import sys
+import threading
 import time
 from binascii import unhexlify
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from functools import partial
 from itertools import islice
@@ -18,13 +23,14 @@
 from .helpers import Location
 from .helpers import ProgressIndicatorPercent
 from .helpers import bin_to_hex
-from .helpers import secure_erase, safe_unlink
+from .helpers import secure_erase, safe_unlink, MappedFile
 from .helpers import msgpack
 from .helpers.lrucache import LRUCache
 from .locking import Lock, LockError, LockErrorT
 from .logger import create_logger
 from .manifest import Manifest
 from .platform import SaveFile, SyncFile, sync_dir, safe_fadvise
+from .platformflags import is_win32
 from .repoobj import RepoObj
 from .checksums import crc32, StreamingXXH64
 from .crypto.file_integrity import IntegrityCheckedFile, FileIntegrityError
@@ -63,6 +69,52 @@ def header_size(tag):
     return size
 
 
+INDEX_DELTA_MAGIC = b"BORKDIDX"
+# magic, transaction id of the index file the delta is based on, number of changed and of deleted entries
+index_delta_header_fmt = struct.Struct("<8sQQQ")
+# changed entries: id, segment, offset, size, flags (deleted entries: id)
+index_delta_entry_fmt = struct.Struct("<32sIIII")
+
+
+class IndexChanges:
+    """
+    Track the ids changed in a repository index since it was read from (or written to) the index files.
+
+    *chain* is a list of (transaction_id, file_size) of the index files making up the on-disk index,
+    starting with the full index file, followed by the deltas based on it. Ids are only tracked if
+    a delta can be written for them (see INDEX_DELTA_MIN_SIZE and INDEX_DELTA_MAX_*).
+    """
+
+    def __init__(self, index=None, chain=None):
+        self.index = index
+        self.chain = chain
+        self.ids = None
+        if index is not None and chain is not None:
+            full_size = chain[0][1]
+            deltas_size = sum(size for _, size in chain[1:])
+            max_size = full_size * INDEX_DELTA_MAX_RATIO - deltas_size - index_delta_header_fmt.size
+            if full_size >= INDEX_DELTA_MIN_SIZE and len(chain) <= INDEX_DELTA_MAX_COUNT and max_size > 0:
+                self.max_count = int(max_size // index_delta_entry_fmt.size)
+                self.ids = set()
+
+    def add(self, id):
+        if self.ids is not None:
+            self.ids.add(id)
+            if len(self.ids) > self.max_count:
+                # the delta would get too big, a full index will be written.
+                self.ids = None
+
+    def in_sync(self, index, transaction_id):
+        """Return whether *index* is the one read from (or written to) index.<transaction_id>."""
+        return index is self.index and self.chain is not None and self.chain[-1][0] == transaction_id
+
+    def delta_base(self, index):
+        """Return the transaction id of the index file a delta for *index* can be based on (or None)."""
+        if self.ids is None or index is not self.index:
+            return None
+        return self.chain[-1][0]
+
+
 class Repository:
     """
     Filesystem based transactional key value store
@@ -191,6 +243,8 @@ def __init__(
         self.io = None  # type: LoggedIO
         self.lock = None
         self.index = None
+        self.index_changes = IndexChanges()
+        self._committed_index = None
         # This is an index of shadowed log entries during this transaction. Consider the following sequence:
         # segment_n PUT A, segment_x DELETE A
         # After the "DELETE A" in segment_x the shadow index will contain "A -> [n]".
@@ -210,7 +264,8 @@ def __init__(
         # v2 is the default repo version for bork 2.0
         # v1 repos must only be used in a read-only way, e.g. for
         # --other-repo=V1_REPO with bork init and bork transfer!
-        self.acceptable_repo_versions = (1, 2)
+        # v3 is v2 with index deltas (see write_index), older versions must not open these repos.
+        self.acceptable_repo_versions = (1, 2, 3)
 
     def __del__(self):
         if self.lock:
@@ -467,7 +522,11 @@ def open(self, path, exclusive, lock_wait=None, lock=True):
             # self.storage_quota is None => no explicit storage_quota was specified, use repository setting.
             self.storage_quota = parse_file_size(self.config.get("repository", "storage_quota", fallback=0))
         self.id = unhexlify(self.config.get("repository", "id").strip())
-        self.io = LoggedIO(self.path, self.max_segment_size, self.segments_per_dir)
+        # opt-in, as index deltas make the repository unreadable for older versions (see write_index)
+        self.index_deltas = self.config.getboolean("repository", "index_deltas", fallback=False)
+        # on windows, mapped files can't be deleted, on 32bit platforms, there is not enough address space.
+        map_budget = SEGMENT_MAP_BUDGET if not is_win32 and sys.maxsize > 2**32 else 0
+        self.io = LoggedIO(self.path, self.max_segment_size, self.segments_per_dir, map_budget=map_budget)
 
     def _load_hints(self):
         if (transaction_id := self.get_transaction_id()) is None:
@@ -491,10 +550,11 @@ def close(self):
             if self.io:
                 self.io.close()
             self.io = None
+            self._committed_index = None
             self.lock.release()
             self.lock = None
 
-    def commit(self, compact=True, threshold=0.1):
+    def commit(self, compact=True, threshold=0.1, max_duration=0):
         """Commit transaction"""
         if self.transaction_doomed:
             exception = self.transaction_doomed
@@ -505,9 +565,13 @@ def commit(self, compact=True, threshold=0.1):
         self.segments.setdefault(segment, 0)
         self.compact[segment] += LoggedIO.header_fmt.size
         if compact and not self.append_only:
-            self.compact_segments(threshold)
+            self.compact_segments(threshold, max_duration=max_duration)
         self.write_index()
+        # the index is in sync with the index files now. if nobody else can change the repository, keep it
+        # for the next transaction, so it does not need to be read again (see open_index).
+        committed_index = self.index if self.lock is not None and self.lock.got_exclusive_lock() else None
         self.rollback()
+        self._committed_index = committed_index
 
     def _read_integrity(self, transaction_id, key):
         integrity_file = "integrity.%d" % transaction_id
@@ -525,15 +589,15 @@ def _read_integrity(self, transaction_id, key):
     def open_index(self, transaction_id, auto_recover=True):
         if transaction_id is None:
             return NSIndex()
+        if self._committed_index is not None and self.index_changes.in_sync(self._committed_index, transaction_id):
+            index, self._committed_index = self._committed_index, None
+            return index
         index_path = os.path.join(self.path, "index.%d" % transaction_id)
         variant = hashindex_variant(index_path)
-        integrity_data = self._read_integrity(transaction_id, "index")
         try:
-            with IntegrityCheckedFile(index_path, write=False, integrity_data=integrity_data) as fd:
-                if variant == 2:
-                    return NSIndex.read(fd)
-                if variant == 1:  # legacy
-                    return NSIndex1.read(fd)
+            index, chain = self._read_index(transaction_id, variant)
+            self.index_changes = IndexChanges(index, chain)
+            return index
         except (ValueError, OSError, FileIntegrityError) as exc:
             logger.warning("Repository index missing or corrupted, trying to recover from: %s", exc)
             os.unlink(index_path)
@@ -544,6 +608,57 @@ def open_index(self, transaction_id, auto_recover=True):
             self.commit(compact=False)
             return self.open_index(self.get_transaction_id())
 
+    def _read_index(self, transaction_id, variant):
+        """
+        Read index.<transaction_id>, return the index and the chain of index files it consists of (see IndexChanges).
+
+        An index delta is applied to the index it is based on (which might be a delta itself).
+        """
+        index_path = os.path.join(self.path, "index.%d" % transaction_id)
+        integrity_data = self._read_integrity(transaction_id, "index")
+        # the index is mapped instead of read into memory, so the bucket array is not copied to the heap,
+        # only the pages changed later are (copy-on-write, see MappedFile).
+        with MappedFile(index_path, copy_on_write=True) as mapped, IntegrityCheckedFile(
+            index_path, write=False, integrity_data=integrity_data, override_fd=mapped
+        ) as fd:
+            if variant == 3:
+                header = fd.read(index_delta_header_fmt.size)
+                if len(header) != index_delta_header_fmt.size:
+                    raise ValueError(f"index delta {transaction_id} has an invalid size")
+                _, base, changed, deleted = index_delta_header_fmt.unpack(header)
+                if base >= transaction_id:
+                    raise ValueError(f"index delta {transaction_id} is based on a newer index {base}")
+                index, chain = self._read_index(base, hashindex_variant(os.path.join(self.path, "index.%d" % base)))
+                if chain is None:
+                    raise ValueError(f"index delta {transaction_id} is based on a legacy index")
+                data = fd.read(changed * index_delta_entry_fmt.size)
+                ids = bytes(fd.read(deleted * 32))
+                if len(data) != changed * index_delta_entry_fmt.size or len(ids) != deleted * 32 or fd.read(1):
+                    raise ValueError(f"index delta {transaction_id} has an invalid size")
+                for id, segment, offset, size, flags in index_delta_entry_fmt.iter_unpack(data):
+                    index[id] = NSIndexEntry(segment, offset, size)
+                    if flags:
+                        index.flags(id, value=flags)
+                for i in range(0, len(ids), 32):
+                    index.pop(ids[i : i + 32], None)
+                return index, chain + [(transaction_id, index_delta_header_fmt.size + len(data) + len(ids))]
+            if variant == 2:
+                return NSIndex.read(fd), [(transaction_id, os.path.getsize(index_path))]
+            if variant == 1:  # legacy
+                return NSIndex1.read(fd), None
+
+    def _write_index_delta(self, fd, base, ids):
+        changed, deleted = [], []
+        for id in ids:
+            entry = self.index.get(id)
+            if entry is None:
+                deleted.append(id)
+            else:
+                changed.append(index_delta_entry_fmt.pack(id, *entry, self.index.flags(id)))
+        fd.write(index_delta_header_fmt.pack(INDEX_DELTA_MAGIC, base, len(changed), len(deleted)))
+        fd.write(b"".join(changed))
+        fd.write(b"".join(deleted))
+
     def _unpack_hints(self, transaction_id):
         hints_path = os.path.join(self.path, "hints.%d" % transaction_id)
         integrity_data = self._read_integrity(transaction_id, "hints")
@@ -660,12 +775,26 @@ def rename_tmp(file):
             flush_and_sync(fd)
         integrity["hints"] = fd.integrity_data
 
-        # Write repository index
+        # Write repository index, or only the changes since the index file it is based on
         index_name = "index.%d" % transaction_id
         index_file = os.path.join(self.path, index_name)
+        base = self.index_changes.delta_base(self.index) if self.index_deltas else None
+        if base is not None and (
+            base >= transaction_id or not os.path.exists(os.path.join(self.path, "index.%d" % base))
+        ):
+            base = None
+        if base is not None and self.config.getint("repository", "version") == 2:
+            # older versions can not read index deltas, the new repository version makes them refuse to open
+            # the repository (instead of failing to read its index).
+            self.set_config_version(3)
         with IntegrityCheckedFile(index_file + ".tmp", filename=index_name, write=True) as fd:
             # XXX: Consider using SyncFile for index write-outs.
-            self.index.write(fd)
+            if base is not None:
+                self._write_index_delta(fd, base, self.index_changes.ids)
+                chain = self.index_changes.chain + [(transaction_id, fd.tell())]
+            else:
+                self.index.write(fd)
+                chain = [(transaction_id, fd.tell())]
             flush_and_sync(fd)
         integrity["index"] = fd.integrity_data
 
@@ -684,15 +813,24 @@ def rename_tmp(file):
         rename_tmp(index_file)
         sync_dir(self.path)
 
-        # Remove old auxiliary files
-        current = ".%d" % transaction_id
+        self.index_changes = IndexChanges(self.index, chain)
+
+        # Remove old auxiliary files, but keep the ones of the index files the current index delta is based on
+        # (the index can only be read with them, and the segments can be replayed from each of them).
+        current = {".%d" % transaction_id for transaction_id, _ in chain}
         for name in os.listdir(self.path):
             if not name.startswith(("index.", "hints.", "integrity.")):
                 continue
-            if name.endswith(current):
+            if name[name.index(".") :] in current:
                 continue
             os.unlink(os.path.join(self.path, name))
-        self.index = None
+        if base is None and not self.index_deltas and self.config.getint("repository", "version") == 3:
+            # index deltas were disabled and there are none left, older versions can use the repository again.
+            self.set_config_version(2)
+
+    def set_config_version(self, version):
+        self.config.set("repository", "version", str(version))
+        self.save_config(self.path, self.config)
 
     def check_free_space(self):
         """Pre-commit check for sufficient free space necessary to perform the commit."""
@@ -753,8 +891,14 @@ def check_free_space(self):
             formatted_free = format_file_size(free_space)
             raise self.InsufficientFreeSpaceError(formatted_required, formatted_free)
 
-    def compact_segments(self, threshold):
-        """Compact sparse segments by copying data into new segments"""
+    def compact_segments(self, threshold, max_duration=0):
+        """
+        Compact sparse segments by copying data into new segments
+
+        Segments are compacted in the order of their benefit (the freeable space per byte that needs to be
+        copied), so a compaction limited to *max_duration* seconds frees as much space as possible. The other
+        segments are compacted by a later compaction.
+        """
         if not self.compact:
             logger.debug("Nothing to do: compact empty")
             return
@@ -782,16 +926,35 @@ def complete_xfer(intermediate=True):
                 del self.compact[segment]
             unused = []
 
-        logger.debug("Compaction started (threshold is %i%%).", threshold * 100)
-        pi = ProgressIndicatorPercent(
-            total=len(self.compact), msg="Compacting segments %3.0f%%", step=1, msgid="repository.compact_segments"
-        )
+        run = []  # adjacent still used PUT2 entries (key, offset, size) of a segment, copied as one block
+
+        def copy_run(segment, segment_size):
+            # copy the entries of the run byte-for-byte, their headers were already verified by iter_objects.
+            nonlocal run
+            if not run:
+                return
+            start = run[0][1]
+            end = run[-1][1] + LoggedIO.HEADER_ID_SIZE + LoggedIO.ENTRY_HASH_SIZE + run[-1][2]
+            if end > segment_size:
+                raise IntegrityError(f"Segment entry data short read [segment {segment}, offset {run[-1][1]}]")
+            try:
+                new_segment, new_offset = self.io.write_raw(segment, start, end - start, raise_full=True)
+            except LoggedIO.SegmentFull:
+                complete_xfer()
+                new_segment, new_offset = self.io.write_raw(segment, start, end - start)
+            for key, offset, size in run:
+                self.index[key] = NSIndexEntry(new_segment, new_offset + offset - start, size)
+                self.index_changes.add(key)
+            segments.setdefault(new_segment, 0)
+            segments[new_segment] += len(run)
+            segments[segment] -= len(run)
+            run = []
+
+        candidates = []
         for segment, freeable_space in sorted(self.compact.items()):
             if not self.io.segment_exists(segment):
                 logger.warning("Segment %d not found, but listed in compaction data", segment)
                 del self.compact[segment]
-                pi.show()
-                self._send_log()
                 continue
             segment_size = self.io.segment_size(segment)
             freeable_ratio = 1.0 * freeable_space / segment_size
@@ -804,9 +967,18 @@ def complete_xfer(intermediate=True):
                     freeable_ratio * 100.0,
                     freeable_space,
                 )
-                pi.show()
-                self._send_log()
                 continue
+            # benefit: freed bytes per copied byte
+            benefit = freeable_space / max(segment_size - freeable_space, 1)
+            candidates.append((benefit, segment, segment_size, freeable_ratio, freeable_space))
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+
+        logger.debug("Compaction started (threshold is %i%%).", threshold * 100)
+        pi = ProgressIndicatorPercent(
+            total=len(candidates), msg="Compacting segments %3.0f%%", step=1, msgid="repository.compact_segments"
+        )
+        t_start = time.monotonic()
+        for _, segment, segment_size, freeable_ratio, freeable_space in candidates:
             segments.setdefault(segment, 0)
             logger.debug(
                 "Compacting segment %d with usage count %d (maybe freeable: %2.2f%% [%d bytes])",
@@ -815,18 +987,29 @@ def complete_xfer(intermediate=True):
                 freeable_ratio * 100.0,
                 freeable_space,
             )
-            for tag, key, offset, _, data in self.io.iter_objects(segment):
+            for tag, key, offset, size, _ in self.io.iter_objects(segment, read_data=False):
                 if tag == TAG_COMMIT:
                     continue
                 in_index = self.index.get(key)
                 is_index_object = in_index and (in_index.segment, in_index.offset) == (segment, offset)
-                if tag in (TAG_PUT2, TAG_PUT) and is_index_object:
+                if run and not (tag == TAG_PUT2 and is_index_object and offset == run_end):
+                    copy_run(segment, segment_size)
+                if tag == TAG_PUT2 and is_index_object and key != Manifest.MANIFEST_ID:
+                    # PUT2 entries do not depend on their position, so they are copied as they are.
+                    # the target segment shall be full after the same entry as when writing the entries one by one.
+                    run_end = offset + header_size(tag) + size
+                    run.append((key, offset, size))
+                    if (self.io.offset or MAGIC_LEN) + run_end - run[0][1] > self.io.limit:
+                        copy_run(segment, segment_size)
+                elif tag in (TAG_PUT2, TAG_PUT) and is_index_object:
+                    data = self.io.read(segment, offset, key)
                     try:
                         new_segment, offset = self.io.write_put(key, data, raise_full=True)
                     except LoggedIO.SegmentFull:
                         complete_xfer()
                         new_segment, offset = self.io.write_put(key, data)
                     self.index[key] = NSIndexEntry(new_segment, offset, len(data))
+                    self.index_changes.add(key)
                     segments.setdefault(new_segment, 0)
                     segments[new_segment] += 1
                     segments[segment] -= 1
@@ -842,7 +1025,7 @@ def complete_xfer(intermediate=True):
                         # do not remove entry with empty shadowed_segments list here,
                         # it is needed for shadowed_put_exists code (see below)!
                         pass
-                    self.storage_quota_use -= header_size(tag) + len(data)
+                    self.storage_quota_use -= header_size(tag) + size
                 elif tag == TAG_DELETE and not in_index:
                     # If the shadow index doesn't contain this key, then we can't say if there's a shadowed older tag,
                     # therefore we do not drop the delete, but write it to a current segment.
@@ -912,10 +1095,16 @@ def complete_xfer(intermediate=True):
                         if not self.shadow_index[key]:
                             # shadowed segments list is empty -> remove it
                             del self.shadow_index[key]
+            copy_run(segment, segment_size)
             assert segments[segment] == 0, "Corrupted segment reference count - corrupted index or hints"
             unused.append(segment)
             pi.show()
             self._send_log()
+            if max_duration and time.monotonic() > t_start + max_duration:
+                logger.info(
+                    "Compaction stopped after %d seconds, compacting the remaining segments later.", max_duration
+                )
+                break
         pi.finish()
         self._send_log()
         complete_xfer(intermediate=False)
@@ -928,6 +1117,8 @@ def replay_segments(self, index_transaction_id, segments_transaction_id):
         # fake an old client, so that in case we do not have an exclusive lock yet, prepare_txn will upgrade the lock:
         remember_exclusive = self.exclusive
         self.exclusive = None
+        # the segments are replayed onto the index of index_transaction_id, not onto an index we might have already.
+        self.index = None
         self.prepare_txn(index_transaction_id, do_cleanup=False)
         try:
             segment_count = sum(1 for _ in self.io.segment_iterator())
@@ -963,6 +1154,7 @@ def _update_index(self, segment, objects, report=None):
                 except KeyError:
                     pass
                 self.index[key] = NSIndexEntry(segment, offset, size)
+                self.index_changes.add(key)
                 self.segments[segment] += 1
                 self.storage_quota_use += header_size(tag) + size
             elif tag == TAG_DELETE:
@@ -972,6 +1164,7 @@ def _update_index(self, segment, objects, report=None):
                 except KeyError:
                     pass
                 else:
+                    self.index_changes.add(key)
                     if self.io.segment_exists(in_index.segment):
                         # the old index is not necessarily valid for this transaction (e.g. compaction); if the segment
                         # is already gone, then it was already compacted.
@@ -1013,11 +1206,14 @@ def _rebuild_sparse(self, segment):
                 # The outcome of the DELETE has been recorded in the PUT branch already.
                 self.compact[segment] += header_size(tag) + size
 
-    def check(self, repair=False, max_duration=0):
+    def check(self, repair=False, max_duration=0, workers=1):
         """Check repository consistency
 
         This method verifies all segment checksums and makes sure
         the index is consistent with the data stored in the segments.
+
+        With workers > 1, segments are read and verified by that many threads, but the
+        index is still rebuilt in segment order.
         """
         if self.append_only and repair:
             raise ValueError(self.path + " is in append-only mode")
@@ -1030,6 +1226,7 @@ def report_error(msg):
 
         logger.info("Starting repository check")
         assert not self._active_txn
+        self._committed_index = None  # check the index files
         try:
             transaction_id = self.get_transaction_id()
             current_index = self.open_index(transaction_id)
@@ -1072,34 +1269,65 @@ def report_error(msg):
         pi = ProgressIndicatorPercent(
             total=segment_count, msg="Checking segments %3.1f%%", step=0.1, msgid="repository.check"
         )
-        segment = -1  # avoid uninitialized variable if there are no segment files at all
-        for i, (segment, filename) in enumerate(self.io.segment_iterator()):
-            pi.show(i)
-            self._send_log()
-            if segment <= last_segment_checked:
-                continue
-            if segment > transaction_id:
-                continue
-            logger.debug("Checking segment file %s...", filename)
+
+        def read_segment(segment, filename):
+            # this might run in a worker thread, so do not use the (not thread-safe) fd cache of self.io.
+            # _update_index does not need the data, so do not keep whole segments in memory.
             try:
-                objects = list(self.io.iter_objects(segment))
+                with MappedSegment(filename) if self.io.map_budget else open(filename, "rb") as fd:
+                    objects = [obj[:4] + (None,) for obj in self.io.iter_objects(segment, fd=fd)]
             except IntegrityError as err:
-                report_error(str(err))
-                objects = []
-                if repair:
-                    self.io.recover_segment(segment, filename)
-                    objects = list(self.io.iter_objects(segment))
-            if not partial:
-                self._update_index(segment, objects, report_error)
-            if partial and time.monotonic() > t_start + max_duration:
-                logger.info("Finished partial segment check, last segment checked is %d", segment)
-                self.config.set("repository", "last_segment_checked", str(segment))
+                return None, err
+            return objects, None
+
+        def read_segments():
+            # yields (i, segment, filename, (objects, error)) in segment order
+            segments = (
+                (i, segment, filename)
+                for i, (segment, filename) in enumerate(self.io.segment_iterator())
+                if last_segment_checked < segment <= transaction_id
+            )
+            if executor is None:
+                for i, segment, filename in segments:
+                    yield i, segment, filename, read_segment(segment, filename)
+                return
+            reading = deque()  # (i, segment, filename, future), in segment order
+            for i, segment, filename in segments:
+                reading.append((i, segment, filename, executor.submit(read_segment, segment, filename)))
+                while len(reading) > 2 * workers:
+                    i, segment, filename, future = reading.popleft()
+                    yield i, segment, filename, future.result()
+            while reading:
+                i, segment, filename, future = reading.popleft()
+                yield i, segment, filename, future.result()
+
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="check") if workers > 1 else None
+        segment = -1  # avoid uninitialized variable if there are no segment files at all
+        try:
+            for i, segment, filename, (objects, err) in read_segments():
+                pi.show(i)
+                self._send_log()
+                logger.debug("Checking segment file %s...", filename)
+                if err is not None:
+                    report_error(str(err))
+                    objects = []
+                    if repair:
+                        self.io.recover_segment(segment, filename)
+                        objects = list(self.io.iter_objects(segment))
+                if not partial:
+                    self._update_index(segment, objects, report_error)
+                if partial and time.monotonic() > t_start + max_duration:
+                    logger.info("Finished partial segment check, last segment checked is %d", segment)
+                    self.config.set("repository", "last_segment_checked", str(segment))
+                    self.save_config(self.path, self.config)
+                    break
+            else:
+                logger.info("Finished segment check at segment %d", segment)
+                self.config.remove_option("repository", "last_segment_checked")
                 self.save_config(self.path, self.config)
-                break
-        else:
-            logger.info("Finished segment check at segment %d", segment)
-            self.config.remove_option("repository", "last_segment_checked")
-            self.save_config(self.path, self.config)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
 
         pi.finish()
         self._send_log()
@@ -1165,7 +1393,9 @@ def scan_low_level(self, segment=None, offset=None):
                 ):
                     if offset is not None and current_offset > offset:
                         break
-                    yield key, data, tag, current_segment, current_offset
+                    yield key, bytes(data) if isinstance(
+                        data, memoryview
+                    ) else data, tag, current_segment, current_offset
             except IntegrityError as err:
                 logger.error(
                     "Segment %d (%s) has IntegrityError(s) [%s] - skipping." % (current_segment, filename, str(err))
@@ -1175,6 +1405,7 @@ def _rollback(self, *, cleanup):
         if cleanup:
             self.io.cleanup(self.io.get_segments_transaction_id())
         self.index = None
+        self._committed_index = None
         self._active_txn = False
         self.transaction_doomed = None
 
@@ -1221,9 +1452,11 @@ def scan(self, limit=None, state=None):
         """
         if limit is not None and limit < 1:
             raise ValueError("please use limit > 0 or limit = None")
-        transaction_id = self.get_transaction_id()
-        if not self.index:
-            self.index = self.open_index(transaction_id)
+        if state is None or not self.index:
+            # continuing a scan does not check the transaction again, so it only reads (see RepositoryServer).
+            transaction_id = self.get_transaction_id()
+            if not self.index:
+                self.index = self.open_index(transaction_id)
         # smallest valid seg is <uint32> 0, smallest valid offs is <uint32> 8
         start_segment, start_offset, end_segment = state if state is not None else (0, 0, transaction_id)
         ids, segment, offset = [], 0, 0
@@ -1234,27 +1467,28 @@ def scan(self, limit=None, state=None):
             # from there. in case the segment file vanished meanwhile, the segment_iterator might never
             # return a segment/filename corresponding to the start_segment and we must start from offset 0 then.
             start_offset = start_offset if segment == start_segment else 0
-            obj_iterator = self.io.iter_objects(segment, start_offset, read_data=False)
-            while True:
-                try:
-                    tag, id, offset, size, _ = next(obj_iterator)
-                except (StopIteration, IntegrityError):
-                    # either end-of-segment or an error - we can not seek to objects at
-                    # higher offsets than one that has an error in the header fields.
-                    break
-                if start_offset > 0:
-                    # we are using a state != None and it points to the last object we have already
-                    # returned in the previous scan() call - thus, we need to skip this one object.
-                    # also, for the next segment, we need to start at offset 0.
-                    start_offset = 0
-                    continue
-                if tag in (TAG_PUT2, TAG_PUT):
-                    in_index = self.index.get(id)
-                    if in_index and (in_index.segment, in_index.offset) == (segment, offset):
-                        # we have found an existing and current object
-                        ids.append(id)
-                        if len(ids) == limit:
-                            return ids, (segment, offset, end_segment)
+            with self.io.reader(segment) as fd:
+                obj_iterator = self.io.iter_objects(segment, start_offset, read_data=False, fd=fd)
+                while True:
+                    try:
+                        tag, id, offset, size, _ = next(obj_iterator)
+                    except (StopIteration, IntegrityError):
+                        # either end-of-segment or an error - we can not seek to objects at
+                        # higher offsets than one that has an error in the header fields.
+                        break
+                    if start_offset > 0:
+                        # we are using a state != None and it points to the last object we have already
+                        # returned in the previous scan() call - thus, we need to skip this one object.
+                        # also, for the next segment, we need to start at offset 0.
+                        start_offset = 0
+                        continue
+                    if tag in (TAG_PUT2, TAG_PUT):
+                        in_index = self.index.get(id)
+                        if in_index and (in_index.segment, in_index.offset) == (segment, offset):
+                            # we have found an existing and current object
+                            ids.append(id)
+                            if len(ids) == limit:
+                                return ids, (segment, offset, end_segment)
         return ids, (segment, offset, end_segment)
 
     def flags(self, id, mask=0xFFFFFFFF, value=None):
@@ -1268,6 +1502,8 @@ def flags(self, id, mask=0xFFFFFFFF, value=None):
         """
         if not self.index:
             self.index = self.open_index(self.get_transaction_id())
+        if value is not None:
+            self.index_changes.add(id)
         return self.index.flags(id, mask, value)
 
     def flags_many(self, ids, mask=0xFFFFFFFF, value=None):
@@ -1283,8 +1519,39 @@ def get(self, id, read_data=True):
             raise self.ObjectNotFound(id, self.path) from None
 
     def get_many(self, ids, read_data=True, is_preloaded=False):
-        for id_ in ids:
-            yield self.get(id_, read_data=read_data)
+        """
+        Like get() for each id, but the ids are looked up in batches and the objects of a batch
+        are read in on-disk order, so that neighbouring objects can be read with a single read call.
+
+        The objects are yielded in the order of *ids*, errors are raised at the position of the failing id.
+        """
+        if not self.index:
+            self.index = self.open_index(self.get_transaction_id())
+        ids = iter(ids)
+        while True:
+            batch = []  # (id, index entry or None if not found)
+            batch_bytes = 0
+            for id_ in ids:
+                try:
+                    in_index = NSIndexEntry(*((self.index[id_] + (None,))[:3]))  # legacy: no size element
+                except KeyError:
+                    in_index = None
+                else:
+                    batch_bytes += in_index.size or 0
+                batch.append((id_, in_index))
+                if len(batch) >= GET_MANY_BATCH_SIZE or batch_bytes >= GET_MANY_BATCH_BYTES:
+                    break
+            if not batch:
+                return
+            requests = [(in_index.segment, in_index.offset, id_, in_index.size) for id_, in_index in batch if in_index]
+            results = iter(self.io.read_many(requests, read_data=read_data))
+            for id_, in_index in batch:
+                if in_index is None:
+                    raise self.ObjectNotFound(id_, self.path)
+                result = next(results)
+                if isinstance(result, IntegrityError):
+                    raise result
+                yield result
 
     def put(self, id, data, wait=True):
         """put a repo object
@@ -1309,6 +1576,7 @@ def put(self, id, data, wait=True):
         self.segments.setdefault(segment, 0)
         self.segments[segment] += 1
         self.index[id] = NSIndexEntry(segment, offset, len(data))
+        self.index_changes.add(id)
         if self.storage_quota and self.storage_quota_use > self.storage_quota:
             self.transaction_doomed = self.StorageQuotaExceeded(
                 format_file_size(self.storage_quota), format_file_size(self.storage_quota_use)
@@ -1327,6 +1595,7 @@ def delete(self, id, wait=True):
             in_index = self.index.pop(id)
         except KeyError:
             raise self.ObjectNotFound(id, self.path) from None
+        self.index_changes.add(id)
         # if we get here, there is an object with this id in the repo,
         # we write a DEL here that shadows the respective PUT.
         # after the delete, the object is not in the repo index any more,
@@ -1358,6 +1627,14 @@ def preload(self, ids):
         """Preload objects (only applies to remote repositories)"""
 
 
+class MappedSegment(MappedFile):
+    """
+    Read-only, file-like access to a memory-mapped segment file (see MappedFile).
+
+    The memoryviews returned by read() are only valid as long as the segment file is not deleted.
+    """
+
+
 class LoggedIO:
     class SegmentFull(Exception):
         """raised when a segment is full, before opening next"""
@@ -1375,20 +1652,38 @@ class SegmentFull(Exception):
     HEADER_ID_SIZE = header_fmt.size + 32
     ENTRY_HASH_SIZE = 8
 
-    def __init__(self, path, limit, segments_per_dir, capacity=90):
+    def __init__(self, path, limit, segments_per_dir, capacity=90, map_budget=0):
         self.path = path
         self.fds = LRUCache(capacity, dispose=self._close_fd)
+        # committed segments are memory-mapped for reading, as long as they fit into map_budget (bytes)
+        self.maps = OrderedDict()  # segment -> (timestamp, MappedSegment), least recently used first
+        self.maps_size = 0
+        self.map_budget = map_budget
         self.segment = 0
         self.limit = limit
         self.segments_per_dir = segments_per_dir
         self.offset = 0
         self._write_fd = None
         self._fds_cleaned = 0
+        self.lock = threading.Lock()  # protects fds and maps if several threads read, see reader()
 
     def close(self):
         self.close_segment()
         self.fds.clear()
         self.fds = None  # Just to make sure we're disabled
+        self.unmap_segments()
+
+    def unmap_segment(self, segment):
+        try:
+            ts, mapped = self.maps.pop(segment)
+        except KeyError:
+            return
+        self.maps_size -= mapped.size
+        mapped.close()
+
+    def unmap_segments(self):
+        for segment in list(self.maps):
+            self.unmap_segment(segment)
 
     def _close_fd(self, ts_fd):
         ts, fd = ts_fd
@@ -1520,8 +1815,35 @@ def get_write_fd(self, no_new=False, want_new=False, raise_full=False):
                 # the cached fd that still refers to the old file, so it will later
                 # get repopulated (on demand) with a fd that refers to the new file.
                 del self.fds[self.segment]
+            self.unmap_segment(self.segment)
         return self._write_fd
 
+    def get_mapped(self, segment):
+        """
+        Return a MappedSegment for *segment*, or None if it should not (or can not) be mapped.
+
+        Only segments which are not written to any more are mapped. Least recently used mappings
+        are closed if the total size of the mapped segments would exceed the map budget.
+        """
+        if not self.map_budget or segment == self.segment and self._write_fd is not None:
+            return None
+        now = time.monotonic()
+        try:
+            ts, mapped = self.maps.pop(segment)
+        except KeyError:
+            try:
+                size = os.path.getsize(self.segment_filename(segment))
+            except FileNotFoundError:
+                return None  # get_fd will raise
+            if not size or size > self.map_budget:
+                return None
+            while self.maps and self.maps_size + size > self.map_budget:
+                self.unmap_segment(next(iter(self.maps)))
+            mapped = MappedSegment(self.segment_filename(segment))
+            self.maps_size += mapped.size
+        self.maps[segment] = (now, mapped)
+        return mapped
+
     def get_fd(self, segment):
         # note: get_fd() returns a fd with undefined file pointer position,
         # so callers must always seek() to desired position afterwards.
@@ -1533,7 +1855,7 @@ def open_fd():
             return fd
 
         def clean_old():
-            # we regularly get rid of all old FDs here:
+            # we regularly get rid of all old FDs (and mappings) here:
             if now - self._fds_cleaned > FD_MAX_AGE // 8:
                 self._fds_cleaned = now
                 for k, ts_fd in list(self.fds.items()):
@@ -1542,11 +1864,18 @@ def clean_old():
                         # we do not want to touch long-unused file handles to
                         # avoid ESTALE issues (e.g. on network filesystems).
                         del self.fds[k]
+                for k, (ts, mapped) in list(self.maps.items()):
+                    if now - ts > FD_MAX_AGE:
+                        self.unmap_segment(k)
 
         clean_old()
-        if self._write_fd is not None:
-            # without this, we have a test failure now
-            self._write_fd.sync()
+        mapped = self.get_mapped(segment)
+        if mapped is not None:
+            return mapped
+        if segment == self.segment and self._write_fd is not None:
+            # reading the segment we are writing to: make sure we read what we wrote (buffered) so far.
+            # it does not need to be durable for that, this only happens in write_commit().
+            self._write_fd.flush()
         try:
             ts, fd = self.fds[segment]
         except KeyError:
@@ -1557,6 +1886,26 @@ def clean_old():
             self.fds.replace(segment, (now, fd))
         return fd
 
+    @contextmanager
+    def reader(self, segment):
+        """
+        Return a context manager giving a file-like object for reading *segment* (at any position).
+
+        Several threads may read at the same time (e.g. in bork serve): a mapped segment is read via a
+        cursor with its own position, outside of the lock. Reads from a cached fd are serialized.
+        """
+        with self.lock:
+            fd = self.get_fd(segment)
+            if not isinstance(fd, MappedSegment):
+                # the file position of a cached fd is shared, keep the other threads out while reading.
+                yield fd
+                return
+            cursor = fd.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
     def close_segment(self):
         # set self._write_fd to None early to guard against reentry from error handling code paths:
         fd, self._write_fd = self._write_fd, None
@@ -1568,6 +1917,7 @@ def close_segment(self):
     def delete_segment(self, segment):
         if segment in self.fds:
             del self.fds[segment]
+        self.unmap_segment(segment)
         try:
             safe_unlink(self.segment_filename(segment))
         except FileNotFoundError:
@@ -1602,15 +1952,19 @@ def get_segment_magic(self, segment):
         fd.seek(0)
         return fd.read(MAGIC_LEN)
 
-    def iter_objects(self, segment, offset=0, read_data=True):
+    def iter_objects(self, segment, offset=0, read_data=True, fd=None):
         """
         Return object iterator for *segment*.
 
         See the _read() docstring about confidence in the returned data.
 
-        The iterator returns five-tuples of (tag, key, offset, size, data).
+        If *fd* is given, read from that file object instead of the cached fd of the segment.
+
+        The iterator returns five-tuples of (tag, key, offset, size, data). If the segment is
+        memory-mapped, data is a memoryview into the mapping (see MappedSegment).
         """
-        fd = self.get_fd(segment)
+        get_fd = self.get_fd if fd is None else lambda segment: fd
+        fd = get_fd(segment)
         fd.seek(offset)
         if offset == 0:
             # we are touching this segment for the first time, check the MAGIC.
@@ -1634,7 +1988,7 @@ def iter_objects(self, segment, offset=0, read_data=True):
             # different segment(s)).
             # by calling get_fd() here again we also make our fd "recently used" so it likely
             # does not get kicked out of self.fds LRUcache.
-            fd = self.get_fd(segment)
+            fd = get_fd(segment)
             fd.seek(offset)
             header = fd.read(self.header_fmt.size)
 
@@ -1642,6 +1996,7 @@ def recover_segment(self, segment, filename):
         logger.info("Attempting to recover " + filename)
         if segment in self.fds:
             del self.fds[segment]
+        self.unmap_segment(segment)
         if os.path.getsize(filename) < MAGIC_LEN + self.header_fmt.size:
             # this is either a zero-byte file (which would crash mmap() below) or otherwise
             # just too small to be a valid non-empty segment file, so do a shortcut here:
@@ -1701,10 +2056,76 @@ def read(self, segment, offset, id, *, read_data=True, expected_size=None):
 
         See the _read() docstring about confidence in the returned data.
         """
-        if segment == self.segment and self._write_fd:
-            self._write_fd.sync()
-        fd = self.get_fd(segment)
-        fd.seek(offset)
+        with self.reader(segment) as fd:
+            fd.seek(offset)
+            data = self._read_entry(fd, segment, offset, id, read_data=read_data, expected_size=expected_size)
+        # do not hand out memoryviews into a mapped segment, the caller might keep the data.
+        return bytes(data) if isinstance(data, memoryview) else data
+
+    def read_many(self, requests, *, read_data=True):
+        """
+        Read the entries of *requests*, a list of (segment, offset, id, expected_size) tuples.
+
+        The entries are read in on-disk order and neighbouring entries of a segment are read with
+        a single read call (if the expected_size is known).
+
+        Returns a list with the data (or the IntegrityError) for each request, in the order of *requests*.
+        """
+        results = [None] * len(requests)
+        order = sorted(range(len(requests)), key=lambda i: requests[i][:2])
+        run, run_start, run_end = [], 0, 0  # neighbouring requests in the same segment, read as one block
+        for i in order:
+            segment, offset, id, expected_size = requests[i]
+            end = None if expected_size is None else offset + header_size(TAG_PUT2) + expected_size
+            if (
+                run
+                and end is not None
+                and segment == requests[run[0]][0]
+                and offset - run_end <= READ_GAP_MAX
+                and end - run_start <= READ_SIZE_MAX
+            ):
+                run.append(i)
+                run_end = max(run_end, end)
+                continue
+            self._read_run(requests, run, run_start, run_end, results, read_data)
+            if end is None:
+                self._read_run(requests, [i], offset, offset, results, read_data)
+                run = []
+            else:
+                run, run_start, run_end = [i], offset, end
+        self._read_run(requests, run, run_start, run_end, results, read_data)
+        return results
+
+    def _read_run(self, requests, run, start, end, results, read_data):
+        if not run:
+            return
+        if len(run) == 1 or not read_data:
+            # nothing to coalesce (or nothing to gain, as the data would not be read).
+            for i in run:
+                segment, offset, id, expected_size = requests[i]
+                try:
+                    results[i] = self.read(segment, offset, id, read_data=read_data, expected_size=expected_size)
+                except IntegrityError as err:
+                    results[i] = err
+            return
+        segment = requests[run[0]][0]
+        with self.reader(segment) as block:
+            if isinstance(block, MappedSegment):
+                start = 0  # no need to read a block, the mapping can be accessed at any offset
+            else:
+                block.seek(start)
+                block = io.BytesIO(block.read(end - start))  # short read at the end is detected by _read_entry
+            for i in run:
+                _, offset, id, expected_size = requests[i]
+                block.seek(offset - start)
+                try:
+                    data = self._read_entry(block, segment, offset, id, expected_size=expected_size)
+                    results[i] = bytes(data) if isinstance(data, memoryview) else data
+                except IntegrityError as err:
+                    results[i] = err
+
+    def _read_entry(self, fd, segment, offset, id, *, read_data=True, expected_size=None):
+        # read the entry at the current position of fd, which is *offset* in *segment*.
         header = fd.read(self.header_fmt.size)
         size, tag, key, data = self._read(fd, header, segment, offset, (TAG_PUT2, TAG_PUT), read_data=read_data)
         if id != key:
@@ -1770,7 +2191,7 @@ def check_crc32(wanted, header, *data):
             # that's all for COMMITs.
         else:
             # all other tags (TAG_PUT2, TAG_DELETE, TAG_PUT) have a key
-            key = fd.read(32)
+            key = bytes(fd.read(32))
             length -= 32
             if len(key) != 32:
                 raise IntegrityError(
@@ -1814,7 +2235,8 @@ def check_crc32(wanted, header, *data):
                                 f"Segment entry meta short read [segment {segment}, offset {offset}]: "
                                 f"expected {ml}, got {len(meta)} bytes"
                             )
-                        data = meta_len + meta  # shortened chunk - enough so the client can decrypt the metadata
+                        # shortened chunk - enough so the client can decrypt the metadata
+                        data = b"".join((meta_len, meta))
                         # we do not have a checksum for this data, but the client's AEAD crypto will check it.
                     # in any case, we see over the remainder of the chunk
                     oldpos = fd.tell()
@@ -1854,6 +2276,19 @@ def write_put(self, id, data, raise_full=False):
         self.offset += size
         return self.segment, offset
 
+    def write_raw(self, segment, offset, size, raise_full=False):
+        """
+        Copy *size* bytes of complete PUT2 entries at *offset* of *segment* byte-for-byte (see SyncFile.copy_range).
+
+        Returns the segment and offset the entries were copied to.
+        """
+        fd = self.get_write_fd(raise_full=raise_full)
+        dst_offset = self.offset
+        with open(self.segment_filename(segment), "rb") as src_fd:
+            fd.copy_range(src_fd.fileno(), offset, size)
+        self.offset += size
+        return self.segment, dst_offset
+
     def write_delete(self, id, raise_full=False):
         fd = self.get_write_fd(want_new=(id == Manifest.MANIFEST_ID), raise_full=raise_full)
         header = self.header_no_crc_fmt.pack(self.HEADER_ID_SIZE, TAG_DELETE)
@@ -15,6 +15,7 @@
 from ..item import Item, ArchiveItem
 from ..manifest import Manifest
 from ..platform import uid2user, gid2group, is_win32
+from ..repoobj import RepoObj
 
 
 @pytest.fixture()
@@ -126,6 +127,7 @@ def async_response(self, wait=True):
     def __init__(self):
         self.objects = {}
         self.repository = self.MockRepo()
+        self.repo_objs = RepoObj(PlaintextKey(None))
 
     def add_chunk(self, id, meta, data, stats=None, wait=True):
         self.objects[id] = data
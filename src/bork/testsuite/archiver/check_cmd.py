@@ -1,11 +1,12 @@
+import os
 import shutil
 from unittest.mock import patch
 
 import pytest
 
-from ...archive import ChunkBuffer
+from ...archive import ArchiveChecker, ChunkBuffer
 from ...constants import *  # NOQA
-from ...helpers import bin_to_hex
+from ...helpers import bin_to_hex, get_security_dir
 from ...manifest import Manifest
 from ...repository import Repository
 from . import cmd, src_file, create_src_archive, open_archive, generate_archiver_tests, RK_ENCRYPTION
@@ -289,6 +290,8 @@ def test_verify_data(archivers, request, init_args):
     cmd(archiver, "check", exit_code=0)
     output = cmd(archiver, "check", "--verify-data", exit_code=1)
     assert bin_to_hex(chunk.id) + ", integrity error" in output
+    output = cmd(archiver, "check", "--verify-data", "--workers=4", exit_code=1)
+    assert bin_to_hex(chunk.id) + ", integrity error" in output
 
     # repair (heal is tested in another test)
     output = cmd(archiver, "check", "--repair", "--verify-data", exit_code=0)
@@ -296,6 +299,46 @@ def test_verify_data(archivers, request, init_args):
     assert f"{src_file}: New missing file chunk detected" in output
 
 
+def test_verify_data_partial(archivers, request):
+    archiver = request.getfixturevalue(archivers)
+    check_cmd_setup(archiver)
+    archive, repository = open_archive(archiver.repository_path, "archive1")
+    with repository:
+        for item in archive.iter_items():
+            if item.path.endswith(src_file):
+                chunk = item.chunks[-1]
+                data = repository.get(chunk.id)
+                data = data[0:100] + b"x" + data[101:]
+                repository.put(chunk.id, data)
+                break
+        repository.commit(compact=False)
+    cmd(archiver, "check", "--verify-data", "--max-duration=3600", exit_code=2)
+    partial_check = ("check", "-v", "--archives-only", "--verify-data", "--max-duration=3600")
+    output = cmd(archiver, *partial_check, exit_code=1)
+    assert bin_to_hex(chunk.id) + ", integrity error" in output
+    assert "Finished partial data verification, all segments verified." in output
+    assert "Archive consistency check complete" not in output
+    # pretend a previous partial verification stopped after the last object
+    with repository:
+        state = None
+        while True:
+            chunk_ids, next_state = repository.scan(limit=100, state=state)
+            if not chunk_ids:
+                break
+            state = next_state
+        state_file = os.path.join(get_security_dir(repository.id_str), "verify-data-state")
+    ArchiveChecker.save_verify_data_state(state_file, state)
+    output = cmd(archiver, *partial_check, exit_code=0)
+    assert "Continuing data verification at segment %d" % state[0] in output
+    assert "verified 0 chunks with 0 integrity errors" in output
+    assert not os.path.exists(state_file)
+    # a full verification always starts from the beginning
+    ArchiveChecker.save_verify_data_state(state_file, state)
+    output = cmd(archiver, "check", "--archives-only", "--verify-data", exit_code=1)
+    assert bin_to_hex(chunk.id) + ", integrity error" in output
+    assert not os.path.exists(state_file)
+
+
 def test_empty_repository(archivers, request):
     archiver = request.getfixturevalue(archivers)
     if archiver.get_kind() == "remote":
@@ -322,6 +322,49 @@ def test_check_cache(archivers, request):
         check_cache(archiver)
 
 
+def test_incremental_cache_sync(archivers, request, monkeypatch):
+    archiver = request.getfixturevalue(archivers)
+    create_regular_file(archiver.input_path, "file1", size=1024 * 80)
+    cmd(archiver, "rcreate", RK_ENCRYPTION)
+    cmd(archiver, "create", "test1", "input")
+    create_regular_file(archiver.input_path, "file2", size=1024 * 80)
+    cmd(archiver, "create", "test2", "input")
+    # force a full cache sync, this caches the archive chunk indexes of test1 and test2
+    cmd(archiver, "rdelete", "--cache-only")
+    cmd(archiver, "rinfo")
+    # another client (using another cache) deletes an archive and creates a new one
+    monkeypatch.setenv("BORK_CACHE_DIR", os.path.join(archiver.tmpdir, "cache2"))
+    cmd(archiver, "delete", "-a", "test1")
+    create_regular_file(archiver.input_path, "file3", size=1024 * 80)
+    cmd(archiver, "create", "test3", "input")
+    monkeypatch.setenv("BORK_CACHE_DIR", archiver.cache_path)
+    out = cmd(archiver, "rinfo", "--info")
+    assert "Updating chunks index: 1 archives added, 1 archives removed." in out
+    check_cache(archiver)
+
+
+def test_cache_sync_workers(archivers, request, monkeypatch):
+    archiver = request.getfixturevalue(archivers)
+    cmd(archiver, "rcreate", RK_ENCRYPTION)
+    for i in range(5):
+        create_regular_file(archiver.input_path, "file%d" % i, size=1024 * 80)
+        cmd(archiver, "create", "test%d" % i, "input")
+    cmd(archiver, "rdelete", "--cache-only")
+    monkeypatch.setenv("BORK_CACHE_SYNC_WORKERS", "3")
+    out = cmd(archiver, "rinfo", "--info")
+    assert "Fetching and building archive index for test4." in out
+    chunks_archive = os.path.join(archiver.cache_path, bin_to_hex(_extract_repository_id(archiver.repository_path)))
+    assert len(os.listdir(os.path.join(chunks_archive, "chunks.archive.d"))) == 10
+    # check_cache compares with a cache built without workers
+    monkeypatch.delenv("BORK_CACHE_SYNC_WORKERS")
+    check_cache(archiver)
+    # invalid values fall back to 1 worker
+    cmd(archiver, "rdelete", "--cache-only")
+    monkeypatch.setenv("BORK_CACHE_SYNC_WORKERS", "many")
+    out = cmd(archiver, "rinfo")
+    assert "BORK_CACHE_SYNC_WORKERS must be an integer, using 1 worker." in out
+
+
 #  Begin manifest TAM tests
 def spoof_manifest(repository):
     with repository:
@@ -18,6 +18,7 @@ def test_config(archivers, request):
     assert "storage_quota" in output
     assert "append_only" in output
     assert "additional_free_space" in output
+    assert "index_deltas = 0" in output
     assert "id" in output
     assert "last_segment_checked" not in output
 
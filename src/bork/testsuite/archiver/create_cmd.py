@@ -12,7 +12,10 @@
 import pytest
 
 from ... import platform
+from ... import compress
+from ...archive import Archive
 from ...constants import *  # NOQA
+from ...helpers import DictionaryMissingError
 from ...manifest import Manifest
 from ...platform import is_cygwin, is_win32, is_darwin
 from ...repository import Repository
@@ -632,6 +635,45 @@ def test_repeated_files(archivers, request):
     cmd(archiver, "create", "test", "input", "input")
 
 
+def test_create_workers(archivers, request):
+    archiver = request.getfixturevalue(archivers)
+    # repeated blocks (dedup within the in-flight chunks), random data and all-zero data
+    contents = randbytes(4096) * 10 + randbytes(100 * 1024) + bytes(64 * 1024)
+    create_regular_file(archiver.input_path, "file1", contents=contents)
+    create_regular_file(archiver.input_path, "file2", contents=contents[::-1])
+    create_regular_file(archiver.input_path, "file3", contents=b"X" * 50000)
+    # the buzhash chunker refills its read buffer while the workers still process chunks of it
+    create_regular_file(archiver.input_path, "file4", contents=randbytes(20 * 1024 * 1024))
+    cmd(archiver, "rcreate", RK_ENCRYPTION)
+    params = "--chunker-params=fixed,4096", "--compression=auto,zstd"
+    cmd(archiver, "create", *params, "--workers=4", "test", "input")
+    cmd(archiver, "create", *params, "--files-cache=disabled", "test2", "input")
+    list_format = "--format={path} {num_chunks} {sha256}{NL}"
+    assert cmd(archiver, "list", "test", list_format) == cmd(archiver, "list", "test2", list_format)
+    cmd(archiver, "create", "--compression=auto,zstd", "--files-cache=disabled", "--workers=4", "test3", "input")
+    cmd(archiver, "check", "--verify-data")
+    for name in "test", "test3":
+        with changedir("output"):
+            cmd(archiver, "extract", name)
+        assert_dirs_equal("input", "output/input")
+        shutil.rmtree("output/input")
+
+
+def test_create_workers_item_order(archivers, request):
+    archiver = request.getfixturevalue(archivers)
+    for i in range(5):
+        for j in range(40):
+            create_regular_file(archiver.input_path, f"dir{i}/file{j}", size=j)
+    create_regular_file(archiver.input_path, "dir1/excluded", size=10)
+    cmd(archiver, "rcreate", RK_ENCRYPTION)
+    cmd(archiver, "create", "--exclude=input/dir1/excluded", "test", "input")
+    cmd(archiver, "create", "--exclude=input/dir1/excluded", "--workers=3", "test2", "input")
+    list_format = "--format={mode} {path} {size}{NL}"
+    output = cmd(archiver, "list", "test2", list_format)
+    assert "excluded" not in output
+    assert output == cmd(archiver, "list", "test", list_format)
+
+
 @pytest.mark.skipif("BORK_TESTS_IGNORE_MODES" in os.environ, reason="modes unreliable")
 @pytest.mark.skipif(is_win32, reason="modes unavailable on Windows")
 def test_umask(archivers, request):
@@ -653,6 +695,45 @@ def test_create_dry_run(archivers, request):
     assert len(manifest.archives) == 0
 
 
+def test_create_metadata_dict(archivers, request):
+    archiver = request.getfixturevalue(archivers)
+    files = ["dir%d/file%d" % (i // 100, i) for i in range(METADATA_DICT_MIN_SAMPLES)]
+    for name in files:
+        create_regular_file(archiver.input_path, name, contents=b"1")
+    cmd(archiver, "rcreate", RK_ENCRYPTION)
+    # training a dictionary is opt-in
+    cmd(archiver, "create", "--compression=zstd", "test0", "input")
+    with Repository(archiver.repository_path) as repository:
+        manifest = Manifest.load(repository, Manifest.NO_OPERATION_CHECK)
+    assert "metadata_dicts" not in manifest.config
+    cmd(archiver, "create", "--compression=zstd", "--metadata-dict", "test1", "input")
+    with Repository(archiver.repository_path) as repository:
+        manifest = Manifest.load(repository, Manifest.NO_OPERATION_CHECK)
+    dict_ids = manifest.config["metadata_dicts"]
+    assert len(dict_ids) == 1
+    for operation in Manifest.Operation:
+        assert Manifest.METADATA_DICT_FEATURE in manifest.config["feature_flags"][operation.value]["mandatory"]
+    for name in files:
+        create_regular_file(archiver.input_path, name, contents=b"22")
+    cmd(archiver, "create", "--compression=auto,zstd,6", "test2", "input")
+    with Repository(archiver.repository_path) as repository:
+        manifest = Manifest.load(repository, Manifest.NO_OPERATION_CHECK)
+        assert manifest.config["metadata_dicts"] == dict_ids
+        archive = Archive(manifest, "test2")
+        compress._zstd_dicts.clear()
+        # the items metadata stream of the second archive was compressed using the dictionary
+        for id in archive.metadata.items:
+            with pytest.raises(DictionaryMissingError):
+                manifest.repo_objs.parse(id, repository.get(id))
+    output = cmd(archiver, "list", "test2", "--short")
+    assert len(output.splitlines()) == METADATA_DICT_MIN_SAMPLES + 11
+    output = cmd(archiver, "check", "--repair", exit_code=0)
+    assert "orphaned" not in output
+    with changedir(archiver.output_path):
+        cmd(archiver, "extract", "test2")
+    assert_dirs_equal(archiver.input_path, os.path.join(archiver.output_path, "input"))
+
+
 def test_progress_on(archivers, request):
     archiver = request.getfixturevalue(archivers)
     create_regular_file(archiver.input_path, "file1", size=1024 * 80)
@@ -120,6 +120,19 @@ def test_directory_timestamps3(archivers, request):
     assert same_ts_ns(sti.st_mtime_ns, sto.st_mtime_ns)
 
 
+def test_extract_workers(archivers, request):
+    archiver = request.getfixturevalue(archivers)
+    for i in range(20):
+        create_regular_file(archiver.input_path, f"dir{i % 3}/sub{i % 2}/file{i}", size=i * 1000)
+    create_regular_file(archiver.input_path, "big", size=EXTRACT_ASYNC_MAX_SIZE + 1)
+    cmd(archiver, "rcreate", RK_ENCRYPTION)
+    cmd(archiver, "create", "test", "input")
+    with changedir("output"):
+        cmd(archiver, "extract", "test", "--workers=4")
+    # also compares the timestamps, so the directory attributes must be restored after writing their files
+    assert_dirs_equal("input", "output/input")
+
+
 @pytest.mark.skipif(not is_utime_fully_supported(), reason="cannot properly setup and execute test without utime")
 def test_atime(archivers, request):
     archiver = request.getfixturevalue(archivers)
@@ -496,6 +509,102 @@ def test_extract_progress(archivers, request):
         assert "Extracting:" in output
 
 
+def test_extract_progress_single_pass(archivers, request):
+    archiver = request.getfixturevalue(archivers)
+    if archiver.EXE:
+        pytest.skip("Skipping binary test due to patch objects")
+    cmd(archiver, "rcreate", RK_ENCRYPTION)
+    create_regular_file(archiver.input_path, "file1", size=1024 * 80)
+    create_regular_file(archiver.input_path, "file2", size=1024 * 20)
+    create_regular_file(archiver.input_path, "skipped", size=1024 * 10)
+    cmd(archiver, "create", "test", "input")
+
+    from ...archive import DownloadPipeline
+
+    unpack_many = DownloadPipeline.unpack_many
+    calls = []
+
+    def patched_unpack_many(self, ids, **kwargs):
+        calls.append(ids)
+        return unpack_many(self, ids, **kwargs)
+
+    with changedir("output"):
+        with patch.object(DownloadPipeline, "unpack_many", patched_unpack_many):
+            output = cmd(archiver, "extract", "test", "--progress", "--exclude", "input/skipped")
+        assert "Extracting:" in output
+    # the item metadata stream was only unpacked once for computing the total size and extracting
+    assert len(calls) == 1
+    assert sorted(os.listdir("output/input")) == ["file1", "file2"]
+    with open("output/input/file1", "rb") as fd1, open("input/file1", "rb") as fd2:
+        assert fd1.read() == fd2.read()
+
+
+def test_extract_chunk_cache(archivers, request):
+    archiver = request.getfixturevalue(archivers)
+    if archiver.EXE:
+        pytest.skip("Skipping binary test due to patch objects")
+    cmd(archiver, "rcreate", RK_ENCRYPTION)
+    data = os.urandom(1024 * 80)
+    for name in ("file1", "file2", "file3"):
+        create_regular_file(archiver.input_path, name, contents=data)
+    create_regular_file(archiver.input_path, "other", size=1024 * 20)
+    cmd(archiver, "create", "test", "input")
+
+    from ...archive import DownloadPipeline
+
+    _fetch_many = DownloadPipeline._fetch_many
+    fetched = []
+
+    def patched_fetch_many(self, ids, **kwargs):
+        fetched.extend(ids)
+        return _fetch_many(self, ids, **kwargs)
+
+    with changedir("output"):
+        with patch.object(DownloadPipeline, "_fetch_many", patched_fetch_many):
+            cmd(archiver, "extract", "test")
+    # the identical files share their chunk, it was only fetched once.
+    assert len(fetched) == len(set(fetched))
+    for name in ("file1", "file2", "file3"):
+        with open(os.path.join("output/input", name), "rb") as fd:
+            assert fd.read() == data
+
+
+@pytest.mark.parametrize("supported", [True, False])
+def test_extract_clone_files(archivers, request, supported):
+    archiver = request.getfixturevalue(archivers)
+    if archiver.EXE:
+        pytest.skip("Skipping binary test due to patch objects")
+    cmd(archiver, "rcreate", RK_ENCRYPTION)
+    data = os.urandom(1024 * 100)
+    for name in ("file1", "file2", "file3"):
+        create_regular_file(archiver.input_path, name, contents=data)
+    create_regular_file(archiver.input_path, "small1", contents=b"x" * 100)
+    create_regular_file(archiver.input_path, "small2", contents=b"x" * 100)
+    cmd(archiver, "create", "test", "input")
+
+    from ... import archive
+
+    calls = []
+
+    def patched_clone_file(src_fd, dst_fd, size):
+        calls.append(size)
+        if not supported:
+            raise OSError(errno.EOPNOTSUPP, "not supported")
+        # like the copy_file_range fallback, works on all file systems
+        os.write(dst_fd, os.pread(src_fd, size, 0))
+
+    with changedir("output"):
+        with patch.object(archive, "clone_file", patched_clone_file):
+            cmd(archiver, "extract", "test")
+    # file2 and file3 were cloned from file1, the small files were written.
+    # if cloning is not supported, it is not tried again after the first failure.
+    assert calls == ([len(data)] * 2 if supported else [len(data)])
+    for name in ("file1", "file2", "file3"):
+        with open(os.path.join("output/input", name), "rb") as fd:
+            assert fd.read() == data
+    assert_dirs_equal("input", "output/input")
+
+
 def test_extract_pattern_opt(archivers, request):
     archiver = request.getfixturevalue(archivers)
     cmd(archiver, "rcreate", RK_ENCRYPTION)
@@ -248,6 +248,26 @@ def test_fuse_mount_options(archivers, request):
         assert sorted(os.listdir(os.path.join(mountpoint))) == []
 
 
+@pytest.mark.skipif(not llfuse, reason="llfuse not installed")
+def test_fuse_chunk_cache_options(archivers, request):
+    archiver = request.getfixturevalue(archivers)
+    cmd(archiver, "rcreate", RK_ENCRYPTION)
+    contents = os.urandom(1024 * 1024 * 3)
+    create_regular_file(archiver.input_path, "file1", contents=contents)
+    cmd(archiver, "create", "--chunker-params=fixed,65536", "archive", "input")
+    mountpoint = os.path.join(archiver.tmpdir, "mountpoint")
+    # a memory budget for a few chunks only, so the disk tier and the eviction get used
+    options = "-o", "chunk_cache_size=200K,chunk_cache_disk_size=1M,readahead=8"
+    with fuse_mount(archiver, mountpoint, "-a", "archive", *options):
+        path = os.path.join(mountpoint, "archive", "input", "file1")
+        with open(path, "rb") as fd:
+            assert fd.read() == contents
+            # random access, backwards
+            for offset in range(len(contents) - 100000, 0, -300000):
+                fd.seek(offset)
+                assert fd.read(100000) == contents[offset : offset + 100000]
+
+
 @pytest.mark.skipif(not llfuse, reason="llfuse not installed")
 def test_migrate_lock_alive(archivers, request):
     """Both old_id and new_id must not be stale during lock migration / daemonization."""
@@ -226,3 +226,22 @@ def test_existing_incref_after_add_chunk(self, cache):
         """This case occurs with part files, see Archive.chunk_file."""
         assert cache.add_chunk(H(1), {}, b"5678", stats=Statistics()) == (H(1), 4)
         assert cache.chunk_incref(H(1), Statistics()) == (H(1), 4)
+
+    def test_chunks_incref_decref(self, cache, repository):
+        assert list(cache.seen_chunks([H(1), H(5)])) == [ChunkIndex.MAX_VALUE, 0]
+        cache.add_chunk(H(5), {}, b"1010", stats=Statistics())
+        # like seen_chunk, this remembers the size of existing chunks
+        assert list(cache.seen_chunks([H(1), H(5)], [4, 4])) == [ChunkIndex.MAX_VALUE, 1]
+        stats = Statistics()
+        assert cache.chunks_incref([H(1), H(5)], stats) == [(H(1), 4), (H(5), 4)]
+        assert stats.osize == 8
+        with pytest.raises(KeyError):
+            cache.chunks_incref([H(5), H(6)], stats)
+        assert cache.seen_chunk(H(5)) == 2
+        stats = Statistics()
+        cache.chunks_decref([H(5), H(1), H(5)], stats)
+        assert (stats.osize, stats.usize) == (-12, -4)
+        assert not cache.seen_chunk(H(5))
+        with pytest.raises(Repository.ObjectNotFound):
+            repository.get(H(5))
+        assert repository.get(H(1)) == b"1234"
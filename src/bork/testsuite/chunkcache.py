@@ -0,0 +1,94 @@
+import os
+
+from ..helpers.chunkcache import ChunkCache, ExtractChunkCache
+from .hashindex import H
+
+
+def test_memory_budget():
+    cache = ChunkCache(100)
+    for i in range(10):
+        cache.put(H(i), bytes(20))
+    assert len(cache) == 5
+    assert cache.size == 100
+    assert cache.get(H(4)) is None
+    assert cache.get(H(5)) == bytes(20)
+    cache.put(H(10), bytes(20))  # evicts the least recently used chunk
+    assert H(6) not in cache
+    assert H(5) in cache
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 6)
+    cache.put(H(11), bytes(101))  # too big, not cached
+    assert H(11) not in cache
+    cache.close()
+
+
+def test_disk_tier(tmpdir):
+    cache = ChunkCache(100, disk_size=200, disk_dir=str(tmpdir))
+    data = [os.urandom(20) for i in range(20)]
+    for i in range(20):
+        cache.put(H(i), data[i])
+    assert cache.size == 100
+    assert cache.disk_size == 7 * 28  # 8 byte checksum per file
+    assert len(cache) == 5 + 7
+    assert cache.get(H(7)) is None
+    # chunks from the disk tier move back into memory
+    assert cache.get(H(8)) == data[8]
+    assert cache.get(H(19)) == data[19]
+    assert (cache.hits, cache.disk_hits, cache.misses) == (1, 1, 1)
+    assert cache.size == 100
+    assert len(os.listdir(cache.basedir)) == 7
+    basedir = cache.basedir
+    cache.close()
+    assert not os.path.exists(basedir)
+
+
+def test_disk_tier_corruption(tmpdir):
+    cache = ChunkCache(10, disk_size=100, disk_dir=str(tmpdir))
+    cache.put(H(1), bytes(10))
+    cache.put(H(2), bytes(10))
+    filename = os.path.join(cache.basedir, os.listdir(cache.basedir)[0])
+    with open(filename, "r+b") as fd:
+        fd.seek(-1, os.SEEK_END)
+        fd.write(b"X")
+    misses = cache.misses
+    assert cache.get(H(1)) is None
+    assert cache.misses == misses + 1
+    assert H(1) not in cache
+    assert os.listdir(cache.basedir) == []
+    cache.close()
+
+
+def test_extract_cache_refs():
+    cache = ExtractChunkCache(100)
+    cache.add_refs([H(1), H(2), H(1), H(3), H(1)])
+    for i in (1, 2, 3):
+        assert cache.get(H(i)) is None
+        cache.use(H(i), bytes(20))
+    # only chunks which are referenced again are kept
+    assert H(1) in cache
+    assert H(2) not in cache and H(3) not in cache
+    assert cache.get(H(1)) == bytes(20)
+    cache.use(H(1), bytes(20))
+    assert H(1) in cache
+    assert cache.get(H(1)) == bytes(20)
+    cache.use(H(1), bytes(20))  # last reference
+    assert H(1) not in cache
+    assert cache.size == 0
+    assert len(cache.refs) == 0
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 3, 0)
+
+
+def test_extract_cache_budget():
+    cache = ExtractChunkCache(100)
+    cache.add_refs([H(i) for i in range(10)] * 2)
+    for i in range(10):
+        cache.use(H(i), bytes(20))
+    assert len(cache) == 5
+    assert cache.size == 100
+    assert H(4) not in cache
+    assert H(5) in cache
+    assert cache.evictions == 5
+    cache.add_refs([H(11)] * 2)
+    cache.use(H(11), bytes(101))  # too big, not cached
+    assert H(11) not in cache
+    cache.clear()
+    assert len(cache) == 0 and cache.size == 0
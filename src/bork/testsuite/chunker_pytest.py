@@ -178,3 +178,17 @@ def test_buzhash_chunksize_distribution():
     # most chunks should be cut due to buzhash triggering, not due to clipping at min/max size:
     assert min_count < 10
     assert max_count < 10
+
+
+@pytest.mark.parametrize("use_fh", [False, True])
+def test_buzhash_chunks_stay_valid(tmpdir, use_fh):
+    data = os.urandom(4 * 1048576)
+    fn = str(tmpdir / "file")
+    with open(fn, "wb") as fd:
+        fd.write(data)
+    chunker = Chunker(0, 12, 16, 14, 4095)  # read buffer: 64kiB
+    with open(fn, "rb") as fd:
+        chunks = list(chunker.chunkify(fd, fd.fileno() if use_fh else -1))
+    # the chunks are read-only views of the read buffer, still valid after the chunker read all the data.
+    assert all(chunk.data.readonly for chunk in chunks)
+    assert b"".join(chunk.data for chunk in chunks) == data
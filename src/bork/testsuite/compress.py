@@ -5,6 +5,9 @@
 import pytest
 
 from ..compress import get_compressor, Compressor, CompressionSpec, CNONE, ZLIB, LZ4, LZMA, ZSTD, Auto
+from ..compress import CompressionMemo, add_zstd_dict, train_zstd_dict
+from ..helpers import DictionaryMissingError
+from .. import compress
 
 DATA = b"fooooooooobaaaaaaaar" * 10
 params = dict(name="zlib", level=6)
@@ -115,6 +118,50 @@ def test_auto():
     assert meta["csize"] == len(compressed)
 
 
+def test_auto_sampling():
+    compressor = CompressionSpec("auto,zstd,3").compressor
+    random_data = os.urandom(Auto.SAMPLE_MIN_SIZE)
+    meta, compressed = compressor.compress({}, random_data)
+    assert meta["ctype"] == CNONE.ID
+    assert compressed == random_data
+    # the samples do not compress, thus the data is not compressed although most of it would.
+    data = bytearray(Auto.SAMPLE_MIN_SIZE)
+    step = (len(data) - Auto.SAMPLE_SIZE) // (Auto.SAMPLE_COUNT - 1)
+    for i in range(Auto.SAMPLE_COUNT):
+        data[i * step : i * step + Auto.SAMPLE_SIZE] = os.urandom(Auto.SAMPLE_SIZE)
+    meta, compressed = compressor.compress({}, bytes(data))
+    assert meta["ctype"] == CNONE.ID
+    # small chunks are not sampled.
+    meta, compressed = compressor.compress({}, bytes(data[: Auto.SAMPLE_MIN_SIZE // 2]))
+    assert meta["ctype"] == ZSTD.ID
+
+
+def test_auto_memo(monkeypatch):
+    compressor = CompressionSpec("auto,zstd,3").compressor
+    calls = []
+    _decide = Auto._decide
+    monkeypatch.setattr(Auto, "_decide", lambda self, meta, data: calls.append(data) or _decide(self, meta, data))
+    memo = CompressionMemo()
+    random_data = os.urandom(1000)
+    for i in range(Auto.MEMO_CHUNKS + Auto.MEMO_CHECK):
+        meta, compressed = compressor.compress({}, random_data, memo=memo)
+        assert meta["ctype"] == CNONE.ID
+        assert meta["csize"] == len(random_data)
+    # only every MEMO_CHECK-th chunk is checked after MEMO_CHUNKS incompressible chunks.
+    assert len(calls) == Auto.MEMO_CHUNKS + 1
+    # compressible chunks are also stored uncompressed until the next check.
+    for i in range(Auto.MEMO_CHECK - 1):
+        meta, compressed = compressor.compress({}, bytes(1000), memo=memo)
+        assert meta["ctype"] == CNONE.ID
+    # a compressible chunk resets the memo
+    meta, compressed = compressor.compress({}, bytes(1000), memo=memo)
+    assert meta["ctype"] != CNONE.ID
+    assert memo.incompressible == memo.skipped == 0
+    meta, compressed = compressor.compress({}, bytes(1000), memo=memo)
+    assert meta["ctype"] != CNONE.ID
+    assert len(calls) == Auto.MEMO_CHUNKS + 1 + 2
+
+
 @pytest.mark.parametrize(
     "specs, c_type, result_range, obfuscation_factor",
     [
@@ -210,3 +257,20 @@ def test_specified_compression_level(c_type, c_name, c_levels):
 def test_invalid_compression_level(invalid_spec):
     with pytest.raises(argparse.ArgumentTypeError):
         CompressionSpec(invalid_spec)
+
+
+def test_zstd_dict():
+    samples = [b"%d: {path: home/user/file%d.txt, mode: 33188, user: user, group: user}" % (i, i) for i in range(1000)]
+    zstd_dict = add_zstd_dict(train_zstd_dict(samples, 4096))
+    data = b"".join(samples[:100])
+    meta, compressed = get_compressor("zstd", level=3).compress({}, data)
+    meta_dict, compressed_dict = get_compressor("zstd", level=3, zstd_dict=zstd_dict).compress({}, data)
+    assert meta_dict["ctype"] == ZSTD.ID
+    assert len(compressed_dict) < len(compressed)
+    # the dictionary is found by its id for decompression
+    assert Compressor("lz4").decompress(meta_dict, compressed_dict) == (meta_dict, data)
+    del compress._zstd_dicts[zstd_dict.id]
+    with pytest.raises(DictionaryMissingError):
+        Compressor("lz4").decompress(meta_dict, compressed_dict)
+    with pytest.raises(ValueError):
+        train_zstd_dict(samples[:2], 4096)
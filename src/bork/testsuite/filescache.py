@@ -0,0 +1,222 @@
+import os
+
+import pytest
+
+from .hashindex import H
+from ..filescache import FilesCache, FileCacheEntry, MAX_AGE
+
+
+def entry(i, age=0, nchunks=2):
+    return FileCacheEntry(
+        age=age, inode=i, size=i * 10, cmtime=i * 1000, chunk_ids=[H(i * 100 + n) for n in range(nchunks)]
+    )
+
+
+def write(files, path, ttl=MAX_AGE + 1, newest_cmtime=2**63 - 1):
+    with open(path, "wb") as fd:
+        return files.write(fd, ttl, newest_cmtime)
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join("files"))
+
+
+def test_empty(path):
+    open(path, "wb").close()
+    files = FilesCache(path)
+    assert len(files) == 0
+    assert files.get(H(1)) is None
+    assert write(files, path + ".new") == 0
+    files.close()
+    files = FilesCache(path + ".new")
+    assert len(files) == 0
+    assert files.get(H(1)) is None
+    files.close()
+
+
+def test_write_read(path):
+    files = FilesCache()
+    for i in range(1000):
+        files.put(H(i), entry(i, nchunks=i % 5))
+    assert len(files) == 1000
+    assert write(files, path) == 1000
+    files = FilesCache(path)
+    assert len(files) == 1000
+    for i in range(1000):
+        # not seen in this backup -> one generation older
+        assert files.get(H(i)) == entry(i, age=1, nchunks=i % 5)
+    assert files.get(H(1000)) is None
+    assert [key for key, _ in files.items()] == sorted(H(i) for i in range(1000))
+    files.close()
+    files = FilesCache(path, aging=False)
+    assert files.get(H(42)) == entry(42, nchunks=2)
+    files.close()
+
+
+def test_update(path):
+    files = FilesCache()
+    for i in range(100):
+        files.put(H(i), entry(i))
+    write(files, path)
+    files = FilesCache(path)
+    files.touch(H(1), inode=4711)  # known and unchanged
+    assert files.get(H(1)) == entry(1)._replace(inode=4711)
+    files.put(H(2), entry(200))  # changed
+    assert files.get(H(2)) == entry(200)
+    files.put(H(100), entry(100))  # new
+    assert len(files) == 101
+    with pytest.raises(KeyError):
+        files.touch(H(101), inode=1)
+    # in-place updates do not modify the file
+    assert FilesCache(path).get(H(1)) == entry(1, age=1)
+    assert write(files, path + ".new", ttl=1) == 3
+    files.close()
+    files = FilesCache(path + ".new")
+    assert len(files) == 3
+    assert files.get(H(1)) == entry(1, age=1)._replace(inode=4711)
+    assert files.get(H(2)) == entry(200, age=1)
+    assert files.get(H(100)) == entry(100, age=1)
+    assert files.get(H(3)) is None
+    files.close()
+
+
+def test_invalid(path):
+    with open(path, "wb") as fd:
+        fd.write(os.urandom(100))
+    with pytest.raises(ValueError):
+        FilesCache(path)
+
+
+def test_random_keys(path):
+    keys = [os.urandom(32) for i in range(10000)]
+    files = FilesCache()
+    for i, key in enumerate(keys):
+        files.put(key, entry(i, nchunks=1))
+    write(files, path)
+    files = FilesCache(path)
+    assert len(files) == len(keys)
+    for i, key in enumerate(keys):
+        assert files.get(key) == entry(i, age=1, nchunks=1)
+    assert files.get(os.urandom(32)) is None
+    files.close()
+
+
+def test_spill(path, tmpdir):
+    # spill after every few entries, so entries are in memory, in multiple runs and in the mapped table
+    files = FilesCache(tmp_dir=str(tmpdir), max_new_size=2000)
+    for i in range(0, 1000, 2):
+        files.put(H(i), entry(i))
+    assert files.runs
+    assert len(files.runs) < 10  # runs of similar size got merged
+    assert len(files) == 500
+    write(files, path)
+    files = FilesCache(path, tmp_dir=str(tmpdir), max_new_size=2000)
+    for i in range(1, 1000, 2):
+        files.put(H(i), entry(i, nchunks=3))  # new
+    for i in range(0, 1000, 10):
+        files.put(H(i), entry(i + 1000))  # changed, was in the mapped table
+    for i in range(1, 1000, 10):
+        files.put(H(i), entry(i + 2000))  # changed, spilled before
+    files.touch(H(2), inode=4711)  # known and unchanged, mapped table
+    files.touch(H(3), inode=4712)  # spilled before
+    assert files.runs
+    assert len(files) == 1000
+    assert files.get(H(2)) == entry(2)._replace(inode=4711)
+    assert files.get(H(3)) == entry(3, nchunks=3)._replace(inode=4712)
+    assert files.get(H(10)) == entry(1010)
+    assert files.get(H(11)) == entry(2011)
+    assert files.get(H(4)) == entry(4, age=1)
+    assert files.get(H(1000)) is None
+    assert [key for key, _ in files.items()] == sorted(H(i) for i in range(1000))
+    assert write(files, path + ".new") == 1000
+    files.close()
+    files = FilesCache(path + ".new", aging=False)
+    assert files.get(H(2)) == entry(2)._replace(inode=4711)
+    assert files.get(H(3)) == entry(3, nchunks=3)._replace(inode=4712)
+    assert files.get(H(10)) == entry(1010)
+    assert files.get(H(11)) == entry(2011)
+    assert files.get(H(4)) == entry(4, age=1)
+    files.close()
+
+
+def test_delta(path):
+    files = FilesCache()
+    for i in range(1000):
+        files.put(H(i), entry(i, nchunks=i % 3))
+    write(files, path)
+    files = FilesCache(path)
+    for i in range(0, 1000, 2):
+        files.touch(H(i), inode=i + 1)  # known and unchanged
+    files.put(H(1), entry(2001))  # changed
+    files.put(H(1000), entry(1000))  # new
+    # few entries are new or changed: the table is copied and aged in bulk, the others go to the delta
+    assert write(files, path + ".1", ttl=2) == 1001
+    files.close()
+    files = FilesCache(path + ".1", aging=False)
+    assert files.delta_len == 2
+    assert len(files) == 1001
+    assert files.get(H(0)) == entry(0, nchunks=0)._replace(inode=1)
+    assert files.get(H(1)) == entry(2001)
+    assert files.get(H(3)) == entry(3, age=1, nchunks=0)
+    assert files.get(H(1000)) == entry(1000)
+    assert [key for key, _ in files.items()] == sorted(H(i) for i in range(1001))
+    files.put(H(1000), entry(3000))  # changed, was in the delta
+    files.touch(H(1), inode=4711)  # known and unchanged, in the delta
+    assert write(files, path + ".2", ttl=2) == 1001
+    files.close()
+    files = FilesCache(path + ".2")
+    assert files.delta_len == 2
+    for i in range(0, 1000, 2):
+        files.touch(H(i), inode=i + 1)
+    # the entries not seen in the last two backups expire
+    assert write(files, path + ".3", ttl=2) == 500 + 2
+    files.close()
+    files = FilesCache(path + ".3", aging=False)
+    assert files.delta_len == 2
+    assert files.get(H(0)) == entry(0, nchunks=0)._replace(inode=1)
+    assert files.get(H(1)) == entry(2001, age=1)._replace(inode=4711)
+    assert files.get(H(3)) is None
+    assert files.get(H(1000)) == entry(3000, age=1)
+    assert [key for key, _ in files.items()] == sorted([H(i) for i in range(0, 1000, 2)] + [H(1), H(1000)])
+    files.close()
+
+
+def test_delta_merged(path):
+    files = FilesCache()
+    for i in range(100):
+        files.put(H(i), entry(i))
+    write(files, path)
+    files = FilesCache(path)
+    for i in range(100, 120):
+        files.put(H(i), entry(i))
+    # too many new entries for the delta: everything gets merged into a new table
+    assert write(files, path + ".1") == 120
+    files.close()
+    files = FilesCache(path + ".1")
+    assert files.delta_len == 0
+    assert files.get(H(110)) == entry(110, age=1)
+    files.touch(H(50), inode=4711)
+    files.put(H(120), entry(120))
+    # the touched entry is not older than the newest cmtime: it needs to be dropped, so it can't be aged in bulk
+    assert write(files, path + ".2", newest_cmtime=50 * 1000) == 119
+    files.close()
+    files = FilesCache(path + ".2", aging=False)
+    assert files.delta_len == 0
+    assert files.get(H(50)) is None
+    assert files.get(H(120)) is None
+    assert files.get(H(49)) == entry(49, age=2)
+    files.touch(H(60), inode=4711)
+    assert write(files, path + ".3") == 119
+    files.close()
+    files = FilesCache(path + ".3", aging=False)
+    assert files.get(H(60)) == entry(60)._replace(inode=4711)
+    files.put(H(121), entry(121))
+    # entries of age 0 written using a newer cmtime limit might need to be dropped now
+    assert write(files, path + ".4", newest_cmtime=60 * 1000) == 118
+    files.close()
+    files = FilesCache(path + ".4")
+    assert files.delta_len == 0
+    assert files.get(H(60)) is None
+    assert files.get(H(61)) == entry(61, age=3)
+    files.close()
@@ -10,6 +10,7 @@
 
 from ..hashindex import NSIndex, ChunkIndex
 from ..crypto.file_integrity import IntegrityCheckedFile, FileIntegrityError
+from ..helpers import MappedFile
 from . import BaseTestCase, unopened_tempfile
 
 
@@ -111,6 +112,29 @@ def test_resize(self):
             idx.write(filepath)
             self.assert_equal(initial_size, os.path.getsize(filepath))
 
+    def test_read_mmap(self):
+        with unopened_tempfile() as filepath:
+            idx = NSIndex()
+            for x in range(100):
+                idx[H(x)] = x, x, x
+            idx.write(filepath)
+            with open(filepath, "rb") as fd:
+                sha = hashlib.sha256(fd.read()).hexdigest()
+            idx = NSIndex.read(filepath, mmap=True)
+            self.assert_equal(len(idx), 100)
+            for x in range(100):
+                self.assert_equal(idx[H(x)], (x, x, x))
+            # changes are copy-on-write, also if they resize the hash table
+            for x in range(50):
+                del idx[H(x)]
+            for x in range(100, 2000):
+                idx[H(x)] = x, x, x
+            self.assert_equal(len(idx), 1950)
+            self.assert_equal(idx[H(1999)], (1999, 1999, 1999))
+            with open(filepath, "rb") as fd:
+                self.assert_equal(hashlib.sha256(fd.read()).hexdigest(), sha)
+            del idx
+
     def test_iteritems(self):
         idx = NSIndex()
         for x in range(100):
@@ -141,6 +165,40 @@ def test_chunkindex_merge(self):
         assert idx1[H(3)] == (3, 300)
         assert idx1[H(4)] == (6, 400)
 
+    def test_chunkindex_subtract(self):
+        idx1 = ChunkIndex()
+        idx1[H(1)] = 5, 100
+        idx1[H(2)] = 7, 200
+        idx1[H(3)] = 3, 300
+        idx1[H(4)] = ChunkIndex.MAX_VALUE, 400
+        idx2 = ChunkIndex()
+        idx2[H(1)] = 4, 100
+        idx2[H(2)] = 7, 200
+        # no H(3) entry
+        idx2[H(4)] = 6, 400
+        idx1.subtract(idx2)
+        assert idx1[H(1)] == (1, 100)
+        assert H(2) not in idx1
+        assert idx1[H(3)] == (3, 300)
+        assert idx1[H(4)] == (ChunkIndex.MAX_VALUE, 400)
+        idx2 = ChunkIndex()
+        idx2[H(1)] = 2, 100
+        self.assert_raises(ValueError, idx1.subtract, idx2)
+        idx2 = ChunkIndex()
+        idx2[H(5)] = 1, 500
+        self.assert_raises(ValueError, idx1.subtract, idx2)
+
+    def test_chunkindex_merge_subtract(self):
+        master = ChunkIndex()
+        master[H(1)] = 1, 100
+        idx = ChunkIndex()
+        idx[H(1)] = 2, 100
+        idx[H(2)] = 1, 200
+        master.merge(idx)
+        master.subtract(idx)
+        assert len(master) == 1
+        assert master[H(1)] == (1, 100)
+
     def test_chunkindex_summarize(self):
         idx = ChunkIndex()
         idx[H(1)] = 1, 1000
@@ -350,6 +408,39 @@ def test_incref_decref(self):
         idx1.decref(H(1))
         assert idx1[H(1)] == (5, 6)
 
+    def test_many(self):
+        idx1 = ChunkIndex()
+        idx1[H(1)] = 1, 6
+        idx1[H(2)] = ChunkIndex.MAX_VALUE, 7
+        idx1[H(3)] = 0, 8
+        keys = H(1) + H(2) + H(3) + H(4)
+        assert idx1.contains_many(keys) == bytearray([1, 1, 1, 0])
+        refcounts, sizes = idx1.get_many(keys)
+        assert list(refcounts) == [1, ChunkIndex.MAX_VALUE, 0, 0]
+        assert list(sizes) == [6, 7, 8, 0]
+        assert list(idx1.incref_many(H(1) + H(2) + H(1))) == [6, 7, 6]
+        assert idx1[H(1)] == (3, 6)
+        assert idx1[H(2)] == (ChunkIndex.MAX_VALUE, 7)
+        refcounts, sizes = idx1.decref_many(H(1) + H(2) + H(1))
+        assert list(refcounts) == [2, ChunkIndex.MAX_VALUE, 1]
+        assert list(sizes) == [6, 7, 6]
+        # nothing is changed if a key is missing
+        with self.assert_raises(KeyError):
+            idx1.incref_many(H(1) + H(4))
+        with self.assert_raises(KeyError):
+            idx1.decref_many(H(1) + H(4))
+        assert idx1[H(1)] == (1, 6)
+        with self.assert_raises(AssertionError):
+            idx1.decref_many(H(3))
+        # ... or if a key is given more often than its refcount
+        with self.assert_raises(AssertionError):
+            idx1.decref_many(H(1) + H(2) + H(1))
+        assert idx1[H(1)] == (1, 6)
+        assert list(idx1.decref_many(H(2) + H(1) + H(2))[0]) == [ChunkIndex.MAX_VALUE, 0, ChunkIndex.MAX_VALUE]
+        with self.assert_raises(ValueError):
+            idx1.contains_many(H(1)[:-1])
+        assert idx1.contains_many(b"") == bytearray()
+
     def test_setitem_raises(self):
         idx1 = ChunkIndex()
         with self.assert_raises(AssertionError):
@@ -437,6 +528,28 @@ def test_integrity_checked_file(self):
                 with IntegrityCheckedFile(path=file, write=False, integrity_data=integrity_data) as fd:
                     ChunkIndex.read(fd)
 
+    def test_integrity_checked_mapped_file(self):
+        # the mapped data is hashed when reading through an IntegrityCheckedFile
+        with unopened_tempfile() as filepath:
+            idx = NSIndex()
+            for x in range(100):
+                idx[H(x)] = x, x, x
+            with IntegrityCheckedFile(path=filepath, write=True) as fd:
+                idx.write(fd)
+            integrity_data = fd.integrity_data
+            with MappedFile(filepath, copy_on_write=True) as mapped, IntegrityCheckedFile(
+                path=filepath, write=False, integrity_data=integrity_data, override_fd=mapped
+            ) as fd:
+                self.assert_equal(len(NSIndex.read(fd)), 100)
+            with open(filepath, "r+b") as fd:
+                fd.seek(-1, io.SEEK_END)
+                fd.write(b"!")
+            with self.assert_raises(FileIntegrityError):
+                with MappedFile(filepath, copy_on_write=True) as mapped, IntegrityCheckedFile(
+                    path=filepath, write=False, integrity_data=integrity_data, override_fd=mapped
+                ) as fd:
+                    NSIndex.read(fd)
+
 
 class HashIndexCompactTestCase(HashIndexDataTestCase):
     def index(self, num_entries, num_buckets, num_empty):
@@ -6,6 +6,7 @@
 from ..platformflags import is_darwin, is_freebsd, is_linux, is_win32
 from ..platform import acl_get, acl_set
 from ..platform import get_process_id, process_alive
+from ..platform import clone_file
 from . import unopened_tempfile
 from .locking import free_pid  # NOQA
 
@@ -80,3 +81,17 @@ def test_process_id():
     assert len(hostname) > 0
     assert pid > 0
     assert get_process_id() == (hostname, pid, tid)
+
+
+def test_clone_file(tmpdir):
+    data = os.urandom(300000)
+    src_path, dst_path = str(tmpdir.join("src")), str(tmpdir.join("dst"))
+    with open(src_path, "wb") as fd:
+        fd.write(data)
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        try:
+            clone_file(src.fileno(), dst.fileno(), len(data))
+        except OSError as err:
+            pytest.skip("cloning files is not supported here: %s" % err)
+    with open(dst_path, "rb") as fd:
+        assert fd.read() == data
@@ -6,7 +6,7 @@
 
 import pytest
 
-from ..remote import SleepingBandwidthLimiter, RepositoryCache, cache_if_remote
+from ..remote import SleepingBandwidthLimiter, InflightWindow, RepositoryCache, cache_if_remote
 from ..repository import Repository
 from ..crypto.key import PlaintextKey
 from ..helpers import IntegrityError
@@ -70,6 +70,36 @@ def test_write(self, monkeypatch):
         it.write(5, b"1")
 
 
+class TestInflightWindow:
+    def test_window(self, monkeypatch):
+        now = 0.0
+        monkeypatch.setattr(time, "monotonic", lambda: now)
+        window = InflightWindow(minimum=10, maximum=1000, max_bytes=10 * 1024 * 1024)
+        assert window.size == 10
+        window.received(1, 0, 1000)  # unknown msgid
+        assert window.min_rtt is None
+        # 100ms round trip time, 10MB/s: the bandwidth-delay product is 1MB
+        for msgid in range(1, 11):
+            window.sent(msgid, 0)
+        now = 0.1
+        for msgid in range(1, 11):
+            window.received(msgid, msgid * 100000, 100000)
+        assert window.min_rtt == pytest.approx(0.1)
+        assert window.max_rate == pytest.approx(10 * 100000 / 0.1)
+        assert window.size == 20  # twice the BDP / response size
+        assert not window.sent_at
+        # the window is limited by max_bytes
+        window.sent(11, 1000000)
+        now = 0.2
+        window.received(11, 101000000, 100000)
+        assert window.size == 10 * 1024 * 1024 // 100000
+        # and never gets smaller than minimum
+        window = InflightWindow(minimum=10, maximum=1000, max_bytes=10 * 1024 * 1024)
+        window.sent(1, 0)
+        window.received(1, 10, 10)
+        assert window.size == 10
+
+
 class TestRepositoryCache:
     @pytest.fixture
     def repository(self, tmpdir):
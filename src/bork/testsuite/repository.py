@@ -1,20 +1,25 @@
 import logging
 import os
+import random
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 from typing import Optional
 from unittest.mock import patch
 
 import pytest
 
-from ..hashindex import NSIndex
+from ..hashindex import NSIndex, hashindex_variant
 from ..helpers import Location
 from ..helpers import IntegrityError
 from ..helpers import msgpack
 from ..locking import Lock, LockFailed
+from ..platform import SyncFile
 from ..platformflags import is_win32
 from ..remote import RemoteRepository, InvalidRPCMethod, PathNotAllowed
 from ..repository import Repository, LoggedIO, MAGIC, MAX_DATA_SIZE, TAG_DELETE, TAG_PUT2, TAG_PUT, TAG_COMMIT
 from ..repoobj import RepoObj
+from ..version import parse_version
 from .hashindex import H
 
 
@@ -158,6 +163,104 @@ def test_read_data(repo_fixtures, request):
         assert repository.get(H(0), read_data=False) == chunk_short
 
 
+def test_get_many(repository):
+    with repository:
+        ids = [H(x) for x in range(300)]
+        for id in ids:
+            repository.put(id, fchunk(id))
+        repository.commit(compact=False)
+        # in on-disk order, reversed and random order, neighbouring objects are read in one go
+        assert [pdchunk(chunk) for chunk in repository.get_many(ids)] == ids
+        assert [pdchunk(chunk) for chunk in repository.get_many(ids[::-1])] == ids[::-1]
+        shuffled = random.sample(ids, len(ids))
+        assert [pdchunk(chunk) for chunk in repository.get_many(shuffled)] == shuffled
+        assert [pdchunk(chunk) for chunk in repository.get_many(iter(ids[:5] * 2))] == ids[:5] * 2
+        assert [chunk for chunk in repository.get_many(ids[:3], read_data=False)] == [
+            repository.get(id, read_data=False) for id in ids[:3]
+        ]
+        # errors are raised at the position of the failing id
+        result = repository.get_many([ids[0], H(1000), ids[1]])
+        assert pdchunk(next(result)) == ids[0]
+        with pytest.raises(Repository.ObjectNotFound):
+            next(result)
+    corrupt_object(repository.path, 150)
+    with reopen(repository) as repository:
+        result = repository.get_many(ids[148:153])
+        assert [pdchunk(next(result)) for _ in range(2)] == ids[148:150]
+        with pytest.raises(IntegrityError):
+            next(result)
+        assert [pdchunk(chunk) for chunk in repository.get_many(ids[151:153])] == ids[151:153]
+
+
+def test_mapped_segments(repository):
+    with repository:
+        repository.put(H(0), fchunk(b"foo"))
+        repository.commit(compact=False)
+        repository.put(H(1), fchunk(b"bar"))
+        # committed segments are read via a mapping, the segment we write to is not mapped
+        assert pdchunk(repository.get(H(0))) == b"foo"
+        assert pdchunk(repository.get(H(1))) == b"bar"
+        segment = repository.index[H(0)].segment
+        assert segment in repository.io.maps
+        assert repository.index[H(1)].segment not in repository.io.maps
+        assert isinstance(repository.get(H(0)), bytes)
+        repository.delete(H(0))
+        repository.commit(compact=True)
+        # compaction deleted the segment and its mapping
+        assert segment not in repository.io.maps
+        assert not repository.io.segment_exists(segment)
+        assert pdchunk(repository.get(H(1))) == b"bar"
+        for i in range(2, 5):
+            repository.put(H(i), fchunk(b"x" * 1000))
+            repository.commit(compact=False)
+        segments = []
+        for i in range(1, 5):
+            repository.io.unmap_segments()
+            repository.get(H(i))
+            segments.extend(repository.io.maps)
+        # the least recently used mappings are closed when exceeding the budget
+        repository.io.map_budget = max(repository.io.segment_size(segment) for segment in segments) * 2
+        for i in range(1, 5):
+            repository.get(H(i))
+        assert list(repository.io.maps) == segments[-2:]
+        assert repository.io.maps_size <= repository.io.map_budget
+
+
+def test_concurrent_reads(repository):
+    with repository:
+        ids = [H(x) for x in range(100)]
+        for id in ids:
+            repository.put(id, fchunk(id))
+        repository.commit(compact=False)
+        # bork serve reads from several threads, while nothing else changes the repository
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            assert list(executor.map(lambda id: pdchunk(repository.get(id)), ids * 4)) == ids * 4
+            ids_scanned, state = repository.scan(limit=10)
+            assert executor.submit(repository.scan, state=state).result()[0] == ids[10:]
+            # the same for segments which are not mapped, these reads are serialized
+            repository.io.unmap_segments()
+            repository.io.map_budget = 0
+            assert list(executor.map(lambda id: pdchunk(repository.get(id)), ids * 4)) == ids * 4
+            assert executor.submit(repository.scan, state=state).result()[0] == ids[10:]
+
+
+def test_read_write_segment(repository, monkeypatch):
+    with repository:
+        repository.put(H(0), fchunk(b"foo"))
+        repository.commit(compact=False)
+        repository.put(H(1), fchunk(b"bar"))
+        write_fd = repository.io._write_fd
+        syncs = []
+        sync = write_fd.sync
+        monkeypatch.setattr(write_fd, "sync", lambda: syncs.append(None) or sync())
+        # reading objects we just wrote does not need to make them durable
+        assert pdchunk(repository.get(H(1))) == b"bar"
+        assert [pdchunk(chunk) for chunk in repository.get_many([H(0), H(1), H(0)])] == [b"foo", b"bar", b"foo"]
+        assert syncs == []
+        repository.commit(compact=False)
+        assert syncs
+
+
 def test_consistency(repo_fixtures, request):
     with get_repository_from_fixture(repo_fixtures, request) as repository:
         repository.put(H(0), fchunk(b"foo"))
@@ -546,6 +649,70 @@ def test_shadowed_entries_are_preserved(repository):
         assert H(1) not in repository
 
 
+def test_compact_segments_raw_copy(repository, monkeypatch):
+    copied = []
+    copy_range = SyncFile.copy_range
+
+    def copy_range_logged(self, src_fd, offset, size):
+        copied.append(size)
+        copy_range(self, src_fd, offset, size)
+
+    monkeypatch.setattr(SyncFile, "copy_range", copy_range_logged)
+    with repository:
+        for i in range(6):
+            repository.put(H(i), fchunk(b"data%d" % i * 100))
+        repository.commit(compact=False)
+        segment = repository.io.get_latest_segment() - 1
+        repository.delete(H(1))
+        repository.delete(H(4))
+        repository.commit(compact=True)
+        assert not repository.io.segment_exists(segment)
+        # adjacent entries are copied as one block: [0], [2, 3], [5]
+        entry_size = LoggedIO.HEADER_ID_SIZE + LoggedIO.ENTRY_HASH_SIZE + len(fchunk(b"data0" * 100))
+        assert copied == [entry_size, 2 * entry_size, entry_size]
+    with reopen(repository) as repository:
+        assert repository.check()
+        for i in (0, 2, 3, 5):
+            assert pdchunk(repository.get(H(i))) == b"data%d" % i * 100
+        assert H(1) not in repository and H(4) not in repository
+
+
+def test_compact_segments_max_duration(repository, monkeypatch):
+    with repository:
+        repository.put(H(0), fchunk(b"0" * 1000))
+        repository.put(H(1), fchunk(b"1" * 1000))
+        repository.commit(compact=False)
+        segment_a = repository.io.get_latest_segment() - 1
+        repository.put(H(2), fchunk(b"2" * 1000))
+        repository.put(H(3), fchunk(b"3" * 1000))
+        repository.put(H(4), fchunk(b"4" * 1000))
+        repository.commit(compact=False)
+        segment_b = repository.io.get_latest_segment() - 1
+        # segment b frees 2 entries per copied entry, segment a only 1.
+        repository.delete(H(0))
+        repository.delete(H(2))
+        repository.delete(H(3))
+        repository.commit(compact=False)
+        repository.put(H(5), fchunk(b"5"))
+        # only look at segments a and b (not at the segments with the deletes and commits)
+        for segment in list(repository.compact):
+            if segment not in (segment_a, segment_b):
+                del repository.compact[segment]
+        # the time budget is exhausted after compacting the first segment
+        monotonic = iter(range(0, 1000000, 1000))
+        monkeypatch.setattr("bork.repository.time", SimpleNamespace(monotonic=lambda: next(monotonic)))
+        repository.commit(compact=True, max_duration=1)
+        assert not repository.io.segment_exists(segment_b)
+        assert repository.io.segment_exists(segment_a)
+        assert segment_a in repository.compact
+        monkeypatch.undo()
+        repository.put(H(6), fchunk(b"6"))
+        repository.commit(compact=True)
+        assert not repository.io.segment_exists(segment_a)
+        for i in (1, 4):
+            assert pdchunk(repository.get(H(i))) == b"%d" % i * 1000
+
+
 def test_shadow_index_rollback(repository):
     with repository:
         repository.put(H(1), fchunk(b"1"))
@@ -837,8 +1004,8 @@ def list_indices(repo_path):
     return [name for name in os.listdir(repo_path) if name.startswith("index.")]
 
 
-def check(repository, repo_path, repair=False, status=True):
-    assert repository.check(repair=repair) == status
+def check(repository, repo_path, repair=False, status=True, workers=1):
+    assert repository.check(repair=repair, workers=workers) == status
     # Make sure no tmp files are left behind
     tmp_files = [name for name in os.listdir(repo_path) if "tmp" in name]
     assert tmp_files == [], "Found tmp files"
@@ -908,6 +1075,19 @@ def test_repair_corrupted_segment(repo_fixtures, request):
         assert {1, 2, 3, 4, 6} == list_objects(repository)
 
 
+def test_check_workers(repo_fixtures, request):
+    with get_repository_from_fixture(repo_fixtures, request) as repository:
+        repo_path = get_path(repository)
+        add_objects(repository, [[1, 2, 3], [4, 5], [6], [7, 8], [9], [10, 11, 12]])
+        check(repository, repo_path, status=True, workers=3)
+        corrupt_object(repo_path, 5)
+        corrupt_object(repo_path, 11)
+        check(repository, repo_path, status=False, workers=3)
+        check(repository, repo_path, repair=True, status=True, workers=3)
+        check(repository, repo_path, status=True)
+        assert {1, 2, 3, 4, 6, 7, 8, 9, 10, 12} == list_objects(repository)
+
+
 def test_repair_missing_segment(repository):
     # only test on local repo - files in RemoteRepository cannot be deleted
     with repository:
@@ -973,6 +1153,80 @@ def test_repair_missing_index(repo_fixtures, request):
         assert {1, 2, 3, 4, 5, 6} == list_objects(repository)
 
 
+def set_index_deltas(repository, enabled):
+    repository.config.set("repository", "index_deltas", str(int(enabled)))
+    repository.save_config(repository.path, repository.config)
+    repository.index_deltas = enabled
+
+
+def config_version(repository):
+    return repository.config.getint("repository", "version")
+
+
+def test_index_delta(repository, monkeypatch):
+    monkeypatch.setattr("bork.repository.INDEX_DELTA_MIN_SIZE", 0)
+    monkeypatch.setattr("bork.repository.INDEX_DELTA_MAX_COUNT", 2)
+    repo_path = repository.path
+    with repository:
+        add_objects(repository, [[1, 2, 3]])
+        # index deltas are opt-in
+        add_objects(repository, [[4]])
+        assert list_indices(repo_path) == ["index.3"]
+        repository.delete(H(4))
+        repository.commit(compact=False)
+        set_index_deltas(repository, True)
+        assert config_version(repository) == 2
+        assert list_indices(repo_path) == ["index.5"]
+        repository.delete(H(2))
+        repository.put(H(4), fchunk(b"data"))
+        repository.flags(H(1), value=0x1)
+        repository.commit(compact=False)
+        # only the changes were written, based on index.5
+        assert sorted(list_indices(repo_path)) == ["index.5", "index.7"]
+        assert hashindex_variant(os.path.join(repo_path, "index.7")) == 3
+        assert os.path.getsize(os.path.join(repo_path, "index.7")) < os.path.getsize(os.path.join(repo_path, "index.5"))
+        # older versions refuse to open a repository with index deltas
+        assert config_version(repository) == 3
+    older = Repository(repo_path, exclusive=True)
+    older.acceptable_repo_versions = (1, 2)
+    with pytest.raises(Repository.InvalidRepositoryConfig):
+        with older:
+            pass
+    with reopen(repository) as repository:
+        assert {1, 3, 4} == list_objects(repository)
+        assert repository.flags(H(1)) == 0x1
+        check(repository, repo_path, status=True)
+        add_objects(repository, [[5], [6]])
+        # too many deltas, a full index was written again
+        assert list_indices(repo_path) == ["index.11"]
+        assert hashindex_variant(os.path.join(repo_path, "index.11")) == 2
+        add_objects(repository, [[7]])
+        assert sorted(list_indices(repo_path)) == ["index.11", "index.13"]
+        # after disabling index deltas, the next commit writes a full index, older versions can read it again
+        set_index_deltas(repository, False)
+        add_objects(repository, [[8]])
+        assert list_indices(repo_path) == ["index.15"]
+        assert hashindex_variant(os.path.join(repo_path, "index.15")) == 2
+        assert config_version(repository) == 2
+    with reopen(repository) as repository:
+        assert {1, 3, 4, 5, 6, 7, 8} == list_objects(repository)
+        assert repository.flags(H(1)) == 0x1
+
+
+def test_index_delta_missing_base(repository, monkeypatch):
+    monkeypatch.setattr("bork.repository.INDEX_DELTA_MIN_SIZE", 0)
+    repo_path = repository.path
+    with repository:
+        set_index_deltas(repository, True)
+        add_objects(repository, [[1, 2, 3], [4]])
+        assert sorted(list_indices(repo_path)) == ["index.1", "index.3"]
+    os.unlink(os.path.join(repo_path, "index.1"))
+    with reopen(repository) as repository:
+        # the index is rebuilt from the segments
+        assert {1, 2, 3, 4} == list_objects(repository)
+        check(repository, repo_path, status=True)
+
+
 def test_repair_index_too_new(repo_fixtures, request):
     with get_repository_from_fixture(repo_fixtures, request) as repository:
         repo_path = get_path(repository)
@@ -993,7 +1247,7 @@ def test_crash_before_compact(repository):
         # simulate a crash before compact
         with patch.object(Repository, "compact_segments") as compact:
             repository.commit(compact=True)
-            compact.assert_called_once_with(0.1)
+            compact.assert_called_once_with(0.1, max_duration=0)
     with reopen(repository) as repository:
         check(repository, repository.path, repair=True)
         assert pdchunk(repository.get(H(0))) == b"data2"
@@ -1058,6 +1312,30 @@ def test_remote_invalid_rpc(remote_repository):
             remote_repository.call("__init__", {})
 
 
+@pytest.mark.parametrize("server_version", [None, parse_version("2.0.0b7")])
+def test_remote_get_many(remote_repository, server_version):
+    with remote_repository:
+        if server_version is not None:
+            # pretend the server does not support get_many, so single get requests are used
+            remote_repository.server_version = server_version
+        ids = [H(x) for x in range(1000)]
+        for id in ids:
+            remote_repository.put(id, fchunk(id))
+        remote_repository.commit(compact=False)
+        assert [pdchunk(chunk) for chunk in remote_repository.get_many(ids)] == ids
+        assert [pdchunk(chunk) for chunk in remote_repository.get_many(ids[::-1])] == ids[::-1]
+        # responses for a batched get are the same as for single get requests, including exceptions
+        result = remote_repository.get_many([ids[0], H(1000), ids[1]])
+        assert pdchunk(next(result)) == ids[0]
+        with pytest.raises(Repository.ObjectNotFound):
+            next(result)
+        assert [pdchunk(chunk) for chunk in remote_repository.get_many(ids[:10])] == ids[:10]
+        # preloading
+        remote_repository.preload(ids[500:700])
+        assert [pdchunk(chunk) for chunk in remote_repository.get_many(ids[500:700], is_preloaded=True)] == ids[500:700]
+        assert not remote_repository.chunkid_to_msgids
+
+
 def test_remote_rpc_exception_transport(remote_repository):
     with remote_repository:
         s1 = "test string"